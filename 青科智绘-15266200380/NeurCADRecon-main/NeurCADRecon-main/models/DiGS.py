@@ -1,9 +1,12 @@
+import copy
+
 import numpy as np
 import torch
 import torch.nn as nn
 from torch import distributions as dist
 
 from .encoder import SimplePointnet, ResnetPointnet
+from .hessian import value_grad_hessian, supports_analytic
 
 
 class AbsLayer(nn.Module):
@@ -32,6 +35,67 @@ class Decoder(nn.Module):
         res = self.nl(res)
         return res
 
+    def export_inference(self, dtype=None, compile=False):
+        '''
+        Frozen copy of the decoder for grid evaluation (mesh extraction). A plain SIREN FCBlock becomes a
+        SirenInference; any other decoder is deep-copied as is. The copy does not share parameters with the
+        decoder, so it can also serve as a snapshot of the weights.
+        '''
+        if supports_analytic(self):
+            inference = SirenInference(self.fc_block, udf=isinstance(self.nl, AbsLayer), dtype=dtype)
+        else:
+            inference = copy.deepcopy(self)
+            inference.requires_grad_(False)
+        inference.eval()
+        if compile and hasattr(torch, 'compile'):
+            inference = torch.compile(inference, dynamic=True)
+        return inference
+
+
+class SirenInference(nn.Module):
+    '''
+    Fused no-grad SIREN forward for evaluating many points: omega_0 is folded into the weights and biases of the
+    sine layers (sin(w (Wx + b)) = sin((wW)x + wb)), every layer is one addmm followed by an in-place sine, and there
+    is no per-layer modulation loop. With dtype=torch.bfloat16 / torch.float16 the weights are stored and the
+    matmuls run in that precision, values are returned as float32.
+    '''
+
+    def __init__(self, fc_block, udf=False, dtype=None):
+        super().__init__()
+        self.udf = udf
+        self.dtype = dtype
+        weights, biases = [], []
+        for layer in fc_block.net:
+            linear = layer[0]
+            omega = layer[1].omega_0 if len(layer) > 1 else 1.0
+            weight = (omega * linear.weight.detach()).t().contiguous()
+            bias = omega * linear.bias.detach()
+            if dtype is not None:
+                weight, bias = weight.to(dtype), bias.to(dtype)
+            weights.append(weight)
+            biases.append(bias)
+        for i, (weight, bias) in enumerate(zip(weights, biases)):
+            self.register_buffer('weight_{}'.format(i), weight)
+            self.register_buffer('bias_{}'.format(i), bias)
+        self.n_layers = len(weights)
+
+    def export_inference(self, dtype=None, compile=False):
+        return self
+
+    @torch.no_grad()
+    def forward(self, coords, mods=None):
+        shape = coords.shape[:-1]
+        x = coords.reshape(-1, coords.shape[-1])
+        if self.dtype is not None:
+            x = x.to(self.dtype)
+        for i in range(self.n_layers):
+            x = torch.addmm(getattr(self, 'bias_{}'.format(i)), x, getattr(self, 'weight_{}'.format(i)))
+            if i < self.n_layers - 1:
+                x.sin_()
+        if self.udf:
+            x.abs_()
+        return x.float().reshape(shape + (-1,))
+
 
 class Modulator(nn.Module):
     def __init__(self, dim_in, dim_hidden, num_layers):
@@ -61,10 +125,13 @@ class Modulator(nn.Module):
 
 class Network(nn.Module):
     def __init__(self, latent_size=0, in_dim=3, decoder_hidden_dim=256, nl='sine', decoder_n_hidden_layers=4,
-                 init_type='siren', sphere_init_params=[1.6, 1.0], udf=False, vae=False):
+                 init_type='siren', sphere_init_params=[1.6, 1.0], udf=False, vae=False, hessian_engine='autograd'):
         super().__init__()
         self.latent_size = latent_size
         self.vae = vae
+        # 'autograd': MorseLoss differentiates the predictions itself; 'analytic' / 'func' (models/hessian.py):
+        # forward() also returns the gradient and Hessian of the manifold and near point predictions
+        self.hessian_engine = hessian_engine
 
         self.encoder = SimplePointnet(c_dim=latent_size, dim=3) if latent_size > 0 and vae == True else None
         # self.encoder = ResnetPointnet(c_dim=latent_size, dim=3) if latent_size > 0 and vae == True else None
@@ -100,21 +167,31 @@ class Network(nn.Module):
             latent = None
             latent_reg = None
             mods = None
+        derivatives = {}
+        with_derivatives = self.hessian_engine != 'autograd' and mods is None
         if mnfld_pnts is not None and not only_nonmnfld:
-            manifold_pnts_pred = self.decoder(mnfld_pnts, mods)
+            if with_derivatives:
+                manifold_pnts_pred, derivatives['manifold_pnts_grad'], derivatives['manifold_pnts_hessian'] = \
+                    value_grad_hessian(self.decoder, mnfld_pnts, self.hessian_engine)
+            else:
+                manifold_pnts_pred = self.decoder(mnfld_pnts, mods)
         else:
             manifold_pnts_pred = None
         nonmanifold_pnts_pred = self.decoder(non_mnfld_pnts, mods)
 
         near_points_pred = None
         if near_points is not None:
-            near_points_pred = self.decoder(near_points, mods)
+            if with_derivatives:
+                near_points_pred, derivatives['near_points_grad'], derivatives['near_points_hessian'] = \
+                    value_grad_hessian(self.decoder, near_points, self.hessian_engine)
+            else:
+                near_points_pred = self.decoder(near_points, mods)
 
-        return {"manifold_pnts_pred": manifold_pnts_pred,
-                "nonmanifold_pnts_pred": nonmanifold_pnts_pred,
-                'near_points_pred': near_points_pred,
-                "latent_reg": latent_reg,
-                }
+        return dict({"manifold_pnts_pred": manifold_pnts_pred,
+                     "nonmanifold_pnts_pred": nonmanifold_pnts_pred,
+                     'near_points_pred': near_points_pred,
+                     "latent_reg": latent_reg,
+                     }, **derivatives)
 
     def get_latent_mods(self, mnfld_pnts=None, latent=None, rand_predict=True):
         mods = None
@@ -206,9 +283,11 @@ class FCBlock(nn.Module):
 
 
 class Sine(nn.Module):
+    # See SIREN paper sec. 3.2, final paragraph, and supplement Sec. 1.5 for discussion of factor 30
+    omega_0 = 30
+
     def forward(self, input):
-        # See SIREN paper sec. 3.2, final paragraph, and supplement Sec. 1.5 for discussion of factor 30
-        return torch.sin(30 * input)
+        return torch.sin(self.omega_0 * input)
 
 
 ################################# SIREN's initialization ###################################
@@ -0,0 +1,59 @@
+import torch
+
+
+def _symmetric_minors(hessian):
+    # coefficients of g^T adj(H) g = m00 g0^2 + m11 g1^2 + m22 g2^2 + m01 g0 g1 + m02 g0 g2 + m12 g1 g2
+    a, b, c, d, e, f, g, h, i = hessian.reshape(hessian.shape[:-2] + (9,)).unbind(dim=-1)
+    return (e * i - f * h, a * i - c * g, a * e - b * d,
+            c * h - b * i + f * g - d * i, b * f - c * e + d * h - e * g, c * d - a * f + b * g - a * h)
+
+
+class AdjugateQuadraticForm(torch.autograd.Function):
+    '''
+    q = g^T adj(H) g for batches of 3x3 matrices H (..., 3, 3) and vectors g (..., 3), in closed form.
+    This is minus the determinant of the bordered matrix [[H, g], [g^T, 0]] the Morse loss used to build with
+    torch.cat and reduce with torch.det (an LU factorisation per point); here it is a few dozen elementwise products
+    of the nine Hessian entries. The backward pass is written out as well, so only H and g are kept for it instead of
+    every intermediate product.
+    '''
+
+    @staticmethod
+    def forward(ctx, hessian, grad):
+        m00, m11, m22, m01, m02, m12 = _symmetric_minors(hessian)
+        g0, g1, g2 = grad.unbind(dim=-1)
+        ctx.save_for_backward(hessian, grad)
+        return g0 * (g0 * m00 + g1 * m01 + g2 * m02) + g1 * (g1 * m11 + g2 * m12) + g2 * g2 * m22
+
+    @staticmethod
+    def backward(ctx, grad_q):
+        hessian, grad = ctx.saved_tensors
+        g0, g1, g2 = grad.unbind(dim=-1)
+        grad_hessian = grad_grad = None
+        if ctx.needs_input_grad[0]:
+            a, b, c, d, e, f, g, h, i = hessian.reshape(hessian.shape[:-2] + (9,)).unbind(dim=-1)
+            p00, p11, p22, p01, p02, p12 = g0 * g0, g1 * g1, g2 * g2, g0 * g1, g0 * g2, g1 * g2
+            grad_hessian = torch.stack((
+                p11 * i + p22 * e - p12 * (f + h),
+                p02 * f + p12 * g - p22 * d - p01 * i,
+                p01 * h + p12 * d - p11 * g - p02 * e,
+                p02 * h + p12 * c - p22 * b - p01 * i,
+                p00 * i + p22 * a - p02 * (c + g),
+                p01 * g + p02 * b - p00 * h - p12 * a,
+                p01 * f + p12 * b - p11 * c - p02 * e,
+                p01 * c + p02 * d - p00 * f - p12 * a,
+                p00 * e + p11 * a - p01 * (b + d)), dim=-1).reshape(hessian.shape) * grad_q[..., None, None]
+        if ctx.needs_input_grad[1]:
+            m00, m11, m22, m01, m02, m12 = _symmetric_minors(hessian)
+            grad_grad = torch.stack((2 * g0 * m00 + g1 * m01 + g2 * m02,
+                                     2 * g1 * m11 + g0 * m01 + g2 * m12,
+                                     2 * g2 * m22 + g0 * m02 + g1 * m12), dim=-1) * grad_q[..., None]
+        return grad_hessian, grad_grad
+
+
+def adjugate_quadratic_form(hessian, grad):
+    '''g^T adj(H) g per point, H (..., 3, 3) and g (..., 3); other dimensions use the bordered determinant'''
+    if hessian.shape[-1] != 3:
+        bordered = torch.cat((torch.cat((hessian, grad[..., :, None]), dim=-1),
+                              torch.cat((grad[..., None, :], torch.zeros_like(grad[..., :1, None])), dim=-1)), dim=-2)
+        return -torch.det(bordered)
+    return AdjugateQuadraticForm.apply(hessian, grad)
@@ -0,0 +1,109 @@
+import torch
+import torch.nn as nn
+
+# Hessian engines for the Morse loss. 'autograd' is the original path: MorseLoss differentiates the predictions with
+# three extra reverse passes. The other engines return the value, gradient and Hessian of the decoder in one go:
+#   analytic  closed-form forward propagation of the Jacobian and the Hessian through the Linear + Sine layers
+#   func      torch.func jacfwd over grad_and_value, vmapped over the points, for any decoder
+HESSIAN_ENGINES = ('autograd', 'analytic', 'func')
+
+# upper triangle of a symmetric 3x3 matrix: xx, yy, zz, xy, yz, xz
+_PACKED = ((0, 0), (1, 1), (2, 2), (0, 1), (1, 2), (0, 2))
+_UNPACK = (0, 3, 5, 3, 1, 4, 5, 4, 2)
+
+
+def supports_analytic(decoder):
+    '''True if the decoder is a plain SIREN FCBlock: Linear layers with Sine activations and a linear output'''
+    layers = list(decoder.fc_block.net)
+    if not isinstance(layers[-1][0], nn.Linear) or len(layers[-1]) != 1:
+        return False
+    # Sine layers are recognised by their frequency attribute (DiGS.Sine.omega_0)
+    return all(len(layer) == 2 and isinstance(layer[0], nn.Linear) and hasattr(layer[1], 'omega_0')
+               for layer in layers[:-1])
+
+
+def _analytic(decoder, points):
+    '''
+    Propagates the activations h (..., 1, d), their Jacobian dh/dx (..., 3, d) and packed Hessian d2h/dx2 (..., 6, d)
+    through the layers. A Linear layer maps all three with the same weight (the bias only goes to h). A sine layer
+    a = sin(w z) gives  da = w cos(wz) dz  and  d2a = w cos(wz) d2z - w^2 sin(wz) (dz dz^T).
+    The three parts are kept as separate tensors: slicing one stacked tensor would make every slice cost a
+    full-size zero fill in the backward pass.
+    '''
+    first = decoder.fc_block.net[0][0]
+    # first layer: dx/dx = I and d2x/dx2 = 0, so the Jacobian is the weight itself and the Hessian is zero
+    value = torch.matmul(points.unsqueeze(-2), first.weight.t()) + first.bias
+    jac = first.weight.t().expand(points.shape[:-1] + first.weight.t().shape)
+    hess = None
+    for i, layer in enumerate(decoder.fc_block.net):
+        if i > 0:
+            linear = layer[0]
+            value = torch.matmul(value, linear.weight.t()) + linear.bias
+            jac = torch.matmul(jac, linear.weight.t())
+            hess = torch.matmul(hess, linear.weight.t())
+        if len(layer) == 1:
+            continue
+        omega = layer[1].omega_0
+        sin, cos = torch.sin(omega * value), omega * torch.cos(omega * value)
+        j0, j1, j2 = jac.unbind(dim=-2)
+        outer = torch.stack([j0 * j0, j1 * j1, j2 * j2, j0 * j1, j1 * j2, j0 * j2], dim=-2)
+        curvature = (-omega * omega) * sin * outer
+        hess = curvature if hess is None else cos * hess + curvature
+        value, jac = sin, cos * jac
+    return value[..., 0, :], jac[..., 0], hess[..., 0]
+
+
+def _func(decoder, points):
+    from torch.func import grad_and_value, jacfwd, vmap
+
+    def value(x):
+        return decoder(x[None])[0, 0]
+
+    def grad_with_aux(x):
+        grad, f = grad_and_value(value)(x)
+        return grad, (grad, f)
+
+    hess, (grad, f) = vmap(jacfwd(grad_with_aux, has_aux=True))(points.reshape(-1, 3))
+    shape = points.shape[:-1]
+    packed = torch.stack([hess[:, i, j] for i, j in _PACKED], dim=-1)
+    return f.reshape(shape + (1,)), grad.reshape(shape + (3,)), packed.reshape(shape + (6,))
+
+
+def value_grad_hessian(decoder, points, engine='analytic'):
+    '''
+    :param points: (..., 3)
+    :return: decoder value (..., 1), gradient (..., 3) and Hessian (..., 3, 3) w.r.t. the points, all differentiable
+             w.r.t. the decoder parameters
+    '''
+    if engine == 'analytic':
+        f, grad, packed = _analytic(decoder, points)
+        if not isinstance(decoder.nl, nn.Identity):
+            # unsigned distance |f|: derivatives flip with the sign (almost everywhere)
+            sign = torch.sign(f)
+            f, grad, packed = f.abs(), sign * grad, sign * packed
+    elif engine == 'func':
+        f, grad, packed = _func(decoder, points)
+    else:
+        raise ValueError('unknown hessian engine: {}'.format(engine))
+    hessian = packed[..., list(_UNPACK)].reshape(packed.shape[:-1] + (3, 3))
+    return f, grad, hessian
+
+
+def autograd_hessian(decoder, points):
+    '''Reference value, gradient and Hessian with the reverse-mode passes MorseLoss uses'''
+    points = points.detach().requires_grad_()
+    f = decoder(points)
+    grad = torch.autograd.grad(f, points, torch.ones_like(f), create_graph=True)[0]
+    rows = [torch.autograd.grad(grad[..., i], points, torch.ones_like(grad[..., i]), create_graph=True)[0]
+            for i in range(3)]
+    return f, grad, torch.stack(rows, dim=-1)
+
+
+def check_parity(decoder, points, engine):
+    '''Largest deviation of the engine from the autograd path on points, relative to the magnitude of each output'''
+    reference = autograd_hessian(decoder, points)
+    result = value_grad_hessian(decoder, points, engine)
+    errors = []
+    for a, b in zip(reference, result):
+        errors.append(((a - b).abs().max() / (a.abs().max() + 1e-12)).item())
+    return max(errors)
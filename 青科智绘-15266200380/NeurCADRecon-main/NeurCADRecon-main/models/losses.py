@@ -3,6 +3,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import utils.utils as utils
+from .curvature import adjugate_quadratic_form
 from torch.autograd import grad
 import itertools
 
@@ -19,9 +20,9 @@ def eikonal_loss(nonmnfld_grad, mnfld_grad, eikonal_type='abs'):
         all_grads = mnfld_grad
 
     if eikonal_type == 'abs':
-        eikonal_term = ((all_grads.norm(2, dim=2) - 1).abs()).mean()
+        eikonal_term = ((all_grads.norm(2, dim=-1) - 1).abs()).mean(dim=-1).mean()
     else:
-        eikonal_term = ((all_grads.norm(2, dim=2) - 1).square()).mean()
+        eikonal_term = ((all_grads.norm(2, dim=-1) - 1).square()).mean(dim=-1).mean()
     return eikonal_term
 
 
@@ -35,27 +36,24 @@ def latent_rg_loss(latent_reg, device):
     return reg_loss
 
 
-def gaussian_curvature(nonmnfld_hessian_term, morse_nonmnfld_grad):
-    device = morse_nonmnfld_grad.device
-    nonmnfld_hessian_term = torch.cat((nonmnfld_hessian_term, morse_nonmnfld_grad[:, :, :, None]), dim=-1)
-    zero_grad = torch.zeros(
-        (morse_nonmnfld_grad.shape[0], morse_nonmnfld_grad.shape[1], 1, 1),
-        device=device)
-    zero_grad = torch.cat((morse_nonmnfld_grad[:, :, None, :], zero_grad), dim=-1)
-    nonmnfld_hessian_term = torch.cat((nonmnfld_hessian_term, zero_grad), dim=-2)
-    morse_nonmnfld = (-1. / (morse_nonmnfld_grad.norm(dim=-1) ** 2 + 1e-12)) * torch.det(
-        nonmnfld_hessian_term)
+def gaussian_curvature_per_point(nonmnfld_hessian_term, morse_nonmnfld_grad):
+    # -det([[H, g], [g^T, 0]]) = g^T adj(H) g, evaluated in closed form instead of building the bordered 4x4 matrix
+    morse_nonmnfld = adjugate_quadratic_form(nonmnfld_hessian_term, morse_nonmnfld_grad) / (
+            morse_nonmnfld_grad.norm(dim=-1) ** 2 + 1e-12)
+
+    # per-point |K|, (batch_size, n_points)
+    return morse_nonmnfld.abs()
 
-    morse_nonmnfld = morse_nonmnfld.abs()
 
-    morse_loss = morse_nonmnfld.mean()
+def gaussian_curvature(nonmnfld_hessian_term, morse_nonmnfld_grad):
+    morse_loss = gaussian_curvature_per_point(nonmnfld_hessian_term, morse_nonmnfld_grad).mean(dim=-1).mean()
 
     return morse_loss
 
 
 class MorseLoss(nn.Module):
     def __init__(self, weights=None, loss_type='siren_wo_n_w_morse', div_decay='none',
-                 div_type='l1', bidirectional_morse=True, udf=False):
+                 div_type='l1', bidirectional_morse=True, udf=False, track_residuals=False):
         super().__init__()
         if weights is None:
             weights = [3e3, 1e2, 1e2, 5e1, 1e2, 1e1]
@@ -66,8 +64,15 @@ class MorseLoss(nn.Module):
         self.use_morse = True if 'morse' in self.loss_type else False
         self.bidirectional_morse = bidirectional_morse
         self.udf = udf
+        # if true, forward() also leaves a detached per-manifold-point residual (batch_size, n_points) in
+        # self.point_residuals: the weighted |f| plus the weighted |K| at the point and at its near-surface sample
+        self.track_residuals = track_residuals
+        self.point_residuals = None
 
     def forward(self, output_pred, mnfld_points, nonmnfld_points, mnfld_n_gt=None, near_points=None):
+        # all point tensors are (batch_size, n_points, dim) and the predictions (batch_size, n_points, 1);
+        # every term is reduced per sample set first and then averaged over the batch, so a step over B sample
+        # sets has the same scale as a step over one and the loss weights do not depend on the batch size
         dims = mnfld_points.shape[-1]
         device = mnfld_points.device
 
@@ -85,9 +90,12 @@ class MorseLoss(nn.Module):
         normal_term = torch.tensor([0.0], device=mnfld_points.device)
         min_surf_loss = torch.tensor([0.0], device=mnfld_points.device)
 
-        # compute gradients for div (divergence), curl and curv (curvature)
+        # compute gradients for div (divergence), curl and curv (curvature); a network with a forward-mode
+        # Hessian engine (models/hessian.py) already returns the gradients and Hessians of the manifold and near points
         if manifold_pred is not None:
-            mnfld_grad = utils.gradient(mnfld_points, manifold_pred)
+            mnfld_grad = output_pred.get('manifold_pnts_grad')
+            if mnfld_grad is None:
+                mnfld_grad = utils.gradient(mnfld_points, manifold_pred)
         else:
             mnfld_grad = None
 
@@ -95,17 +103,22 @@ class MorseLoss(nn.Module):
 
         morse_nonmnfld_points = None
         morse_nonmnfld_grad = None
+        nonmnfld_hessian_term = None
+        mnfld_hessian_term = output_pred.get('manifold_pnts_hessian')
 
         if self.use_morse and near_points is not None:
             morse_nonmnfld_points = near_points
-            morse_nonmnfld_grad = utils.gradient(near_points, output_pred['near_points_pred'])
+            morse_nonmnfld_grad = output_pred.get('near_points_grad')
+            nonmnfld_hessian_term = output_pred.get('near_points_hessian')
+            if morse_nonmnfld_grad is None:
+                morse_nonmnfld_grad = utils.gradient(near_points, output_pred['near_points_pred'])
 
 
         elif self.use_morse and near_points is None:
             morse_nonmnfld_points = nonmnfld_points
             morse_nonmnfld_grad = nonmnfld_grad
 
-        if self.use_morse:
+        if self.use_morse and (nonmnfld_hessian_term is None or mnfld_hessian_term is None):
             nonmnfld_dx = utils.gradient(morse_nonmnfld_points, morse_nonmnfld_grad[:, :, 0])
             nonmnfld_dy = utils.gradient(morse_nonmnfld_points, morse_nonmnfld_grad[:, :, 1])
 
@@ -121,25 +134,38 @@ class MorseLoss(nn.Module):
                 nonmnfld_hessian_term = torch.stack((nonmnfld_dx, nonmnfld_dy), dim=-1)
                 mnfld_hessian_term = torch.stack((mnfld_dx, mnfld_dy), dim=-1)
 
+        if self.use_morse:
             morse_mnfld = torch.tensor([0.0], device=mnfld_points.device)
             if self.div_type == 'l1':
-                morse_loss = gaussian_curvature(nonmnfld_hessian_term, morse_nonmnfld_grad)
+                morse_nonmnfld_per_point = gaussian_curvature_per_point(nonmnfld_hessian_term, morse_nonmnfld_grad)
+                morse_loss = morse_nonmnfld_per_point.mean(dim=-1).mean()
 
                 if self.bidirectional_morse:
-                    morse_mnfld = gaussian_curvature(mnfld_hessian_term, mnfld_grad)
+                    morse_mnfld_per_point = gaussian_curvature_per_point(mnfld_hessian_term, mnfld_grad)
+                    morse_mnfld = morse_mnfld_per_point.mean(dim=-1).mean()
 
                 morse_loss = 0.5 * (morse_loss + morse_mnfld)
         # latent regulariation for multiple shape learning
         latent_reg_term = latent_rg_loss(latent_reg, device)
 
         # signed distance function term
-        sdf_term = torch.abs(manifold_pred).mean()
+        sdf_term = torch.abs(manifold_pred).flatten(1).mean(dim=-1).mean()
 
         # eikonal term
         eikonal_term = eikonal_loss(morse_nonmnfld_grad, mnfld_grad=mnfld_grad, eikonal_type='abs')
 
         # inter term
-        inter_term = torch.exp(-1e2 * torch.abs(non_manifold_pred)).mean()
+        inter_term = torch.exp(-1e2 * torch.abs(non_manifold_pred)).flatten(1).mean(dim=-1).mean()
+
+        if self.track_residuals:
+            residuals = self.weights[0] * torch.abs(manifold_pred).flatten(1)
+            if self.use_morse and self.div_type == 'l1':
+                # near points are the manifold points plus noise, index-aligned with them
+                if near_points is not None:
+                    residuals = residuals + 0.5 * self.weights[5] * morse_nonmnfld_per_point
+                if self.bidirectional_morse:
+                    residuals = residuals + 0.5 * self.weights[5] * morse_mnfld_per_point
+            self.point_residuals = residuals.detach()
 
         # losses used in the paper
         if self.loss_type == 'siren_wo_n_w_morse':
@@ -149,7 +175,8 @@ class MorseLoss(nn.Module):
         elif self.loss_type == 'siren_w_morse':
             # 计算法向量损失
             if mnfld_n_gt is not None:
-                normal_term = (1 - torch.abs(torch.nn.functional.cosine_similarity(mnfld_grad, mnfld_n_gt, dim=-1))).mean()
+                normal_term = (1 - torch.abs(torch.nn.functional.cosine_similarity(mnfld_grad, mnfld_n_gt,
+                                                                                    dim=-1))).mean(dim=-1).mean()
             else:
                 normal_term = torch.tensor([0.0], device=device)
             
@@ -175,7 +202,8 @@ class MorseLoss(nn.Module):
             assert len(params[1:-1]) % 2 == 0
             self.decay_params_list = list(zip([params[0], *params[1:-1][1::2], params[-1]], [0, *params[1:-1][::2], 1]))
 
-        curr = current_iteration / n_iterations
+        # current_iteration and n_iterations count optimizer steps (not samples), see train_surface_reconstruction
+        curr = min(max(current_iteration / n_iterations, 0.), 1.)
         we, e = min([tup for tup in self.decay_params_list if tup[1] >= curr], key=lambda tup: tup[1])
         w0, s = max([tup for tup in self.decay_params_list if tup[1] <= curr], key=lambda tup: tup[1])
 
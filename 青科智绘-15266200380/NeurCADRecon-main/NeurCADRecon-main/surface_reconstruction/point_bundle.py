@@ -0,0 +1,128 @@
+import os
+import sys
+import zipfile
+import argparse
+
+import numpy as np
+
+from sigma_estimators import estimate_sigmas, file_fingerprint, register_fingerprint
+
+# preprocessed point cloud stored next to its source file as <source>.bundle.npz
+BUNDLE_SUFFIX = '.bundle.npz'
+BUNDLE_VERSION = 1
+
+
+def bundle_path(file_path):
+    return file_path + BUNDLE_SUFFIX
+
+
+def normalize_points(points):
+    # center on the mean and scale into [-1, 1], as ReconDataset has always done
+    cp = points.mean(axis=0)
+    points = points - cp[None, :]
+    scale = np.abs(points).max()
+    return points / scale, cp, scale
+
+
+def read_point_cloud(file_path):
+    # returns float32 points and normals (zeros when the file has none)
+    import open3d as o3d
+    o3d_point_cloud = o3d.io.read_point_cloud(file_path)
+    points = np.asarray(o3d_point_cloud.points, dtype=np.float32)
+    normals = np.asarray(o3d_point_cloud.normals, dtype=np.float32)
+    if normals.shape[0] == 0:
+        normals = np.zeros_like(points)
+    return points, normals
+
+
+def write_point_bundle(path, points, normals, sigmas, cp, scale, **meta):
+    '''
+    Writes an uncompressed .npz so that every member can be memory-mapped in place by load_point_bundle.
+    The file is assembled under a temporary name and renamed, readers never see a partial bundle.
+    '''
+    arrays = {
+        'points': np.ascontiguousarray(points, dtype=np.float32),
+        'mnfld_n': np.ascontiguousarray(normals, dtype=np.float32),
+        'sigmas': np.ascontiguousarray(sigmas, dtype=np.float32).reshape(-1, 1),
+        'cp': np.asarray(cp, dtype=np.float32),
+        'scale': np.asarray(scale, dtype=np.float32),
+        'bbox': np.array([points.min(axis=0), points.max(axis=0)], dtype=np.float32).transpose(),
+        'version': np.asarray(BUNDLE_VERSION),
+    }
+    arrays.update({key: np.asarray(value) for key, value in meta.items()})
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_point_bundle(path, mmap_mode='r'):
+    '''
+    Opens a bundle written by write_point_bundle. Array members are returned as np.memmap views into the file
+    (zero-copy, pages are read on first access); with mmap_mode=None everything is read into memory.
+    '''
+    if mmap_mode is None:
+        with np.load(path) as data:
+            return {key: data[key] for key in data.files}
+
+    bundle = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('compressed bundle member {} cannot be memory-mapped'.format(info.filename))
+            # local file header: 30 bytes + file name + extra field, then the .npy member
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = np.frombuffer(f.read(4), dtype='<u2')
+            f.seek(info.header_offset + 30 + int(name_length) + int(extra_length))
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            key = info.filename[:-len('.npy')]
+            if len(shape) == 0:
+                # scalars and metadata strings are tiny, read them directly
+                bundle[key] = np.frombuffer(f.read(dtype.itemsize), dtype=dtype).reshape(())[()]
+            else:
+                bundle[key] = np.memmap(path, dtype=dtype, mode=mmap_mode, offset=f.tell(), shape=shape,
+                                        order='F' if fortran_order else 'C')
+    return bundle
+
+
+def valid_bundle(file_path, sigma_method=None):
+    '''Returns the bundle of file_path when it exists, matches the file fingerprint and the sigma method, else None'''
+    path = bundle_path(file_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        bundle = load_point_bundle(path)
+        if int(bundle['version']) != BUNDLE_VERSION or str(bundle['source_fingerprint']) != file_fingerprint(file_path):
+            return None
+        if sigma_method is not None and str(bundle['sigma_method']) != sigma_method:
+            return None
+        return bundle
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+
+
+def preprocess_point_cloud(file_path, sigma_method='voxel', output_path=None):
+    '''Parses the point cloud once, normalises it, estimates the sigmas and writes the bundle next to the source'''
+    points, normals = read_point_cloud(file_path)
+    points, cp, scale = normalize_points(points)
+    sigmas = estimate_sigmas(points, sigma_method)
+    output_path = output_path or bundle_path(file_path)
+    write_point_bundle(output_path, points, normals, sigmas, cp, scale,
+                       source_fingerprint=file_fingerprint(file_path), sigma_method=sigma_method)
+    return output_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='preprocess a point cloud into a memory-mappable bundle')
+    parser.add_argument('file_path', type=str)
+    parser.add_argument('--sigma_method', type=str, default='voxel', choices=['kdtree', 'voxel', 'grid'])
+    parser.add_argument('--output', type=str, default=None)
+    parser.add_argument('--sha256', type=str, default=None, help='SHA-256 of file_path if already known')
+    cli_args = parser.parse_args()
+    if cli_args.sha256:
+        register_fingerprint(cli_args.file_path, cli_args.sha256)
+    print('Wrote', preprocess_point_cloud(cli_args.file_path, cli_args.sigma_method, cli_args.output))
+    sys.exit(0)
@@ -0,0 +1,262 @@
+import os
+import json
+import shutil
+import tempfile
+import argparse
+
+import numpy as np
+
+from sigma_estimators import ESTIMATORS, SIGMA_K, file_fingerprint, register_fingerprint
+from point_bundle import read_point_cloud
+
+# on-disk layout of an out-of-core point cloud, by default <source>.chunks/:
+#   index.json          cp, scale, bbox, grid and the point count of every occupied chunk
+#   chunk_<cell>.npy    (n, 7) float32 rows of normalised xyz, normals and sigma of the points inside one grid cell
+#   reservoir.npy       (m, 7) float32 uniform random subset of all the points, small enough to keep in memory
+CHUNKS_VERSION = 1
+PLY_TYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1', 'short': 'i2', 'int16': 'i2',
+             'ushort': 'u2', 'uint16': 'u2', 'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+             'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+
+
+def chunk_dir_path(file_path):
+    return file_path + '.chunks'
+
+
+def _read_ply_header(f):
+    # returns the format, the vertex count and the vertex properties; the vertex element must come first
+    if f.readline().strip() != b'ply':
+        raise ValueError('not a PLY file')
+    fmt, count, properties, element = None, None, [], None
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError('truncated PLY header')
+        words = line.decode('ascii', 'ignore').split()
+        if not words or words[0] in ('comment', 'obj_info'):
+            continue
+        if words[0] == 'end_header':
+            break
+        if words[0] == 'format':
+            fmt = words[1]
+        elif words[0] == 'element':
+            element = words[1]
+            if element == 'vertex':
+                if count is not None or properties:
+                    raise ValueError('duplicate vertex element')
+                count = int(words[2])
+            elif count is None:
+                raise ValueError('streaming PLY reader needs the vertex element first')
+        elif words[0] == 'property' and element == 'vertex':
+            if words[1] == 'list':
+                raise ValueError('list properties on vertices are not supported')
+            properties.append((words[2], PLY_TYPES[words[1]]))
+    if count is None:
+        raise ValueError('PLY file has no vertex element')
+    return fmt, count, properties
+
+
+def iter_point_blocks(file_path, block_size=1 << 20):
+    '''
+    Yields (points, normals) float32 blocks of at most block_size points without holding the whole cloud in memory.
+    Binary PLY vertices are memory-mapped, ASCII PLY is parsed block by block and .npy arrays of (n, 3) or (n, 6)
+    are memory-mapped; any other format is read in one go through open3d. Normals are zero when missing.
+    '''
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == '.npy':
+        array = np.load(file_path, mmap_mode='r')
+        for start in range(0, array.shape[0], block_size):
+            block = np.asarray(array[start:start + block_size], dtype=np.float32)
+            normals = block[:, 3:6] if block.shape[1] >= 6 else np.zeros_like(block[:, :3])
+            yield block[:, :3], normals
+        return
+    if ext != '.ply':
+        points, normals = read_point_cloud(file_path)
+        for start in range(0, points.shape[0], block_size):
+            yield points[start:start + block_size], normals[start:start + block_size]
+        return
+
+    with open(file_path, 'rb') as f:
+        fmt, count, properties = _read_ply_header(f)
+        names = [name for name, _ in properties]
+        has_normals = all(name in names for name in ('nx', 'ny', 'nz'))
+        if fmt == 'ascii':
+            columns = [names.index(name) for name in ('x', 'y', 'z')]
+            if has_normals:
+                columns += [names.index(name) for name in ('nx', 'ny', 'nz')]
+            remaining = count
+            while remaining > 0:
+                rows = min(block_size, remaining)
+                block = np.loadtxt(f, dtype=np.float32, max_rows=rows, usecols=columns, ndmin=2)
+                remaining -= rows
+                yield block[:, :3], block[:, 3:6] if has_normals else np.zeros_like(block[:, :3])
+            return
+        offset = f.tell()
+
+    endian = '<' if fmt == 'binary_little_endian' else '>'
+    vertices = np.memmap(file_path, dtype=np.dtype([(name, endian + kind) for name, kind in properties]),
+                         mode='r', offset=offset, shape=(count,))
+    for start in range(0, count, block_size):
+        block = vertices[start:start + block_size]
+        points = np.stack([block[name] for name in ('x', 'y', 'z')], axis=-1).astype(np.float32)
+        if has_normals:
+            normals = np.stack([block[name] for name in ('nx', 'ny', 'nz')], axis=-1).astype(np.float32)
+        else:
+            normals = np.zeros_like(points)
+        yield points, normals
+
+
+def _cell_ids(points, grid):
+    cells = np.clip(np.floor((points + 1) * 0.5 * grid).astype(np.int64), 0, grid - 1)
+    return (cells[:, 0] * grid + cells[:, 1]) * grid + cells[:, 2]
+
+
+def chunk_file(chunk_dir, cell):
+    return os.path.join(chunk_dir, 'chunk_{:06d}.npy'.format(cell))
+
+
+def build_chunks(file_path, chunk_dir=None, grid=8, sigma_method='voxel', k=SIGMA_K, halo=0.02,
+                 reservoir_size=1000000, block_size=1 << 20, seed=0):
+    '''
+    Splits a point cloud that does not fit in memory into spatial chunks on disk, in three streaming passes:
+    1. center and scale (the mean and the max-abs extent, as ReconDataset normalises) from running sums and bounds
+    2. normalise every block and append its rows to the raw file of their grid cell, while a reservoir sample
+       keeps a uniform subset of (cell, row) positions
+    3. per chunk, estimate the sigmas on the chunk plus a halo of neighbouring points within `halo`, so the k-NN
+       distances of boundary points are not overestimated, and write the final (n, 7) chunk
+    Only one block, or one chunk with its halo, is in memory at a time. Returns the index dict.
+    '''
+    chunk_dir = chunk_dir or chunk_dir_path(file_path)
+    rng = np.random.RandomState(seed)
+
+    # pass 1: normalisation
+    count, total, low, high = 0, np.zeros(3), np.full(3, np.inf), np.full(3, -np.inf)
+    for points, _ in iter_point_blocks(file_path, block_size):
+        count += points.shape[0]
+        total += points.sum(axis=0, dtype=np.float64)
+        low, high = np.minimum(low, points.min(axis=0)), np.maximum(high, points.max(axis=0))
+    if count == 0:
+        raise ValueError('empty point cloud: {}'.format(file_path))
+    cp = total / count
+    scale = max(np.max(high - cp), np.max(cp - low))
+
+    # pass 2: spatial bucketing with a reservoir sample of positions (Algorithm R, vectorised per block)
+    # build in a private directory; a concurrent build of the same cloud (upload preprocessing and a training job)
+    # cannot interfere, and readers only ever see a complete chunk directory
+    parent = os.path.dirname(os.path.abspath(chunk_dir))
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix=os.path.basename(chunk_dir) + '.tmp')
+    counts = np.zeros(grid ** 3, dtype=np.int64)
+    reservoir_size = min(reservoir_size, count)
+    reservoir = np.zeros((reservoir_size, 2), dtype=np.int64)  # (cell, row in the cell)
+    seen = 0
+    for points, normals in iter_point_blocks(file_path, block_size):
+        points = ((points - cp) / scale).astype(np.float32)
+        cells = _cell_ids(points, grid)
+        order = np.argsort(cells, kind='stable')
+        cells, rows = cells[order], np.concatenate([points, normals], axis=1)[order]
+        unique, starts, block_counts = np.unique(cells, return_index=True, return_counts=True)
+        positions = np.empty(len(cells), dtype=np.int64)
+        for cell, start, n in zip(unique, starts, block_counts):
+            with open(os.path.join(tmp_dir, '{:06d}.raw'.format(cell)), 'ab') as f:
+                rows[start:start + n].tofile(f)
+            positions[start:start + n] = counts[cell] + np.arange(n)
+            counts[cell] += n
+
+        index = seen + np.arange(len(cells))
+        slot = np.where(index < reservoir_size, index, (rng.random_sample(len(cells)) * (index + 1)).astype(np.int64))
+        keep = slot < reservoir_size
+        # with repeated slots the last assignment wins, which is the sequential Algorithm R outcome
+        reservoir[slot[keep]] = np.stack([cells[keep], positions[keep]], axis=-1)
+        seen += len(cells)
+
+    # pass 3: per-chunk sigmas with a halo from the neighbouring cells
+    cell_size = 2.0 / grid
+    occupied = np.nonzero(counts)[0]
+    raw = {cell: np.memmap(os.path.join(tmp_dir, '{:06d}.raw'.format(cell)), dtype=np.float32, mode='r',
+                           shape=(counts[cell], 6)) for cell in occupied}
+    for cell in occupied:
+        chunk = np.array(raw[cell])
+        cx, cy, cz = cell // (grid * grid), (cell // grid) % grid, cell % grid
+        box_low = np.array([cx, cy, cz]) * cell_size - 1 - halo
+        box_high = box_low + cell_size + 2 * halo
+        neighbours = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    nx, ny, nz = cx + dx, cy + dy, cz + dz
+                    neighbour = (nx * grid + ny) * grid + nz
+                    if (dx, dy, dz) == (0, 0, 0) or min(nx, ny, nz) < 0 or max(nx, ny, nz) >= grid or \
+                            neighbour not in raw:
+                        continue
+                    points = raw[neighbour][:, :3]
+                    inside = np.all((points >= box_low) & (points <= box_high), axis=1)
+                    neighbours.append(np.asarray(points[inside]))
+        points = np.concatenate([chunk[:, :3]] + neighbours, axis=0)
+        sigmas = ESTIMATORS[sigma_method](points, min(k, points.shape[0]))[:chunk.shape[0]]
+        out = np.lib.format.open_memmap(chunk_file(tmp_dir, cell), mode='w+',
+                                        dtype=np.float32, shape=(chunk.shape[0], 7))
+        out[:, :6] = chunk
+        out[:, 6] = sigmas[:, 0]
+        out.flush()
+        del out
+    for cell in occupied:
+        del raw[cell]
+        os.remove(os.path.join(tmp_dir, '{:06d}.raw'.format(cell)))
+
+    # reservoir rows, gathered chunk by chunk
+    rows = np.zeros((reservoir_size, 7), dtype=np.float32)
+    for cell in np.unique(reservoir[:, 0]):
+        selected = np.nonzero(reservoir[:, 0] == cell)[0]
+        chunk = np.load(chunk_file(tmp_dir, cell), mmap_mode='r')
+        rows[selected] = chunk[reservoir[selected, 1]]
+    np.save(os.path.join(tmp_dir, 'reservoir.npy'), rows)
+
+    bbox = np.stack([(low - cp) / scale, (high - cp) / scale], axis=-1)
+    index = {'version': CHUNKS_VERSION, 'source_fingerprint': file_fingerprint(file_path),
+             'sigma_method': sigma_method, 'grid': grid, 'halo': halo, 'n_points': int(count),
+             'cp': cp.tolist(), 'scale': float(scale), 'bbox': bbox.tolist(),
+             'chunks': {str(cell): int(counts[cell]) for cell in occupied}}
+    with open(os.path.join(tmp_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    existing = load_chunks(file_path, chunk_dir, grid=grid, sigma_method=sigma_method)
+    if existing is not None:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return existing
+    shutil.rmtree(chunk_dir, ignore_errors=True)
+    os.replace(tmp_dir, chunk_dir)
+    return index
+
+
+def load_chunks(file_path, chunk_dir=None, grid=None, sigma_method=None):
+    '''Returns the index of the chunks of file_path when they exist and match the file and the settings, else None'''
+    chunk_dir = chunk_dir or chunk_dir_path(file_path)
+    try:
+        with open(os.path.join(chunk_dir, 'index.json')) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != CHUNKS_VERSION or index.get('source_fingerprint') != file_fingerprint(file_path):
+        return None
+    if (grid is not None and index['grid'] != grid) or (sigma_method is not None and index['sigma_method'] != sigma_method):
+        return None
+    # upload garbage collection removes files one by one, a partially collected directory is rebuilt
+    files = [chunk_file(chunk_dir, int(cell)) for cell in index['chunks']] + [os.path.join(chunk_dir, 'reservoir.npy')]
+    if not all(os.path.exists(path) for path in files):
+        return None
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='split a point cloud into out-of-core spatial chunks')
+    parser.add_argument('file_path', type=str)
+    parser.add_argument('--chunk_dir', type=str, default=None)
+    parser.add_argument('--grid', type=int, default=8)
+    parser.add_argument('--sigma_method', type=str, default='voxel', choices=['kdtree', 'voxel', 'grid'])
+    parser.add_argument('--reservoir_size', type=int, default=1000000)
+    parser.add_argument('--sha256', type=str, default=None, help='SHA-256 of file_path if already known')
+    cli_args = parser.parse_args()
+    if cli_args.sha256:
+        register_fingerprint(cli_args.file_path, cli_args.sha256)
+    result = build_chunks(cli_args.file_path, cli_args.chunk_dir, cli_args.grid, cli_args.sigma_method,
+                          reservoir_size=cli_args.reservoir_size)
+    print('{} points in {} chunks'.format(result['n_points'], len(result['chunks'])))
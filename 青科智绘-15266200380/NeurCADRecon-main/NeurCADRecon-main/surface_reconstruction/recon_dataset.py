@@ -1,50 +1,65 @@
+import os
+import torch
 import torch.utils.data as data
 import numpy as np
-import scipy.spatial as spatial
-import open3d as o3d
 import trimesh
 
+from sigma_estimators import estimate_sigmas
+from point_bundle import read_point_cloud, normalize_points, valid_bundle
+from point_chunks import build_chunks, load_chunks, chunk_dir_path, chunk_file
+from utils.sum_tree import SumTree
+
 
 class ReconDataset(data.Dataset):
     # A class to generate synthetic examples of basic shapes.
     # Generates clean and noisy point clouds sampled  + samples on a grid with their distance to the surface (not used in DiGS paper)
-    def __init__(self, file_path, n_points, n_samples=128, res=128, sample_type='grid', grid_range=1.1):
+    def __init__(self, file_path, n_points, n_samples=128, res=128, sample_type='grid', grid_range=1.1,
+                 sigma_method='kdtree', sigma_cache=False, use_bundle=True):
         self.file_path = file_path
         self.n_points = n_points
         self.n_samples = n_samples
-        # load data
-        self.o3d_point_cloud = o3d.io.read_point_cloud(self.file_path)
+        # sigma estimator: kdtree (exact) | voxel | grid, optionally cached next to the input file
+        self.sigma_method = sigma_method
+        self.sigma_cache = sigma_cache
         self.grid_range = grid_range
+        self._bbox_trimesh = None
 
-        # extract center and scale points and normals
-        self.points, self.mnfld_n = self.get_mnfld_points()
-        self.bbox = np.array([np.min(self.points, axis=0), np.max(self.points, axis=0)]).transpose()
-        self.bbox_trimesh = trimesh.PointCloud(self.points).bounding_box.copy()
+        # a preprocessed bundle (point_bundle.py) next to the input holds the normalised points, normals and sigmas;
+        # its arrays are memory-mapped, so loading skips the point cloud parsing and the sigma estimation
+        bundle = valid_bundle(self.file_path) if use_bundle else None
+        self.from_bundle = bundle is not None
+        if bundle is not None:
+            self.points, self.mnfld_n = bundle['points'], bundle['mnfld_n']
+            self.cp, self.scale, self.bbox = bundle['cp'], float(bundle['scale']), bundle['bbox']
+        else:
+            # load data, extract center and scale points and normals
+            self.points, self.mnfld_n = self.get_mnfld_points()
+            self.bbox = np.array([np.min(self.points, axis=0), np.max(self.points, axis=0)]).transpose()
 
         self.point_idxs = np.arange(self.points.shape[0], dtype=np.int32)
-        # record sigma
-        self.sample_gaussian_noise_around_shape()
+        # record sigma, reusing the bundle ones when they come from the same estimator
+        if bundle is not None and str(bundle['sigma_method']) == self.sigma_method:
+            self.sigmas = bundle['sigmas']
+        else:
+            self.sample_gaussian_noise_around_shape()
 
-    def get_mnfld_points(self):
-        # Returns points on the manifold
-        points = np.asarray(self.o3d_point_cloud.points, dtype=np.float32)
-        normals = np.asarray(self.o3d_point_cloud.normals, dtype=np.float32)
-        if normals.shape[0] == 0:
-            normals = np.zeros_like(points)
-        # center and scale data/point cloud
-        self.cp = points.mean(axis=0)
-        points = points - self.cp[None, :]
-        self.scale = np.abs(points).max()
-        points = points / self.scale
+    @property
+    def bbox_trimesh(self):
+        # built on first use only, it is not needed for training
+        if self._bbox_trimesh is None:
+            self._bbox_trimesh = trimesh.PointCloud(self.points).bounding_box.copy()
+        return self._bbox_trimesh
 
+    def get_mnfld_points(self):
+        # Returns points on the manifold, centered and scaled
+        points, normals = read_point_cloud(self.file_path)
+        points, self.cp, self.scale = normalize_points(points)
         return points, normals
 
     def sample_gaussian_noise_around_shape(self):
-        kd_tree = spatial.KDTree(self.points)
-        # query each point for sigma
-        dist, _ = kd_tree.query(self.points, k=51, workers=-1)
-        sigmas = dist[:, -1:]
-        self.sigmas = sigmas
+        # sigma of each point: distance to its 51st nearest neighbour
+        self.sigmas = estimate_sigmas(self.points, self.sigma_method,
+                                      source_path=self.file_path if self.sigma_cache else None)
         return
 
     def __getitem__(self, index):
@@ -74,11 +89,158 @@ class ReconDataset(data.Dataset):
 
     def gen_new_data(self, dense_pts):
         self.points = dense_pts
-        kd_tree = spatial.KDTree(self.points)
-        # query each point for sigma^2
-        dist, _ = kd_tree.query(self.points, k=51, workers=-1)
-        sigmas = dist[:, -1:]
-        self.sigmas = sigmas
+        # query each point for sigma
+        self.sigmas = estimate_sigmas(self.points, self.sigma_method)
 
     def __len__(self):
         return self.n_samples
+
+
+class ChunkedReconDataset(data.Dataset):
+    # Out-of-core counterpart of ReconDataset for point clouds larger than RAM. The cloud is split once into spatial
+    # chunks on disk by point_chunks.build_chunks (normalised points, normals and per-chunk sigmas), and every item
+    # draws its manifold points stratified over the chunks: a multinomial split of n_points by chunk size, then a
+    # random subset of each chunk read through its memory map. Items have the same keys and shapes as ReconDataset.
+    # points / mnfld_n / sigmas hold the in-memory reservoir sample (uniform over the whole cloud), used for the
+    # shape descriptor and by DeviceSampler.
+    def __init__(self, file_path, n_points, n_samples=128, grid_range=1.1, chunk_dir=None, chunk_grid=8,
+                 reservoir_size=1000000, sigma_method='voxel'):
+        self.file_path = file_path
+        self.n_points = n_points
+        self.n_samples = n_samples
+        self.grid_range = grid_range
+        self.sigma_method = sigma_method
+        self.chunk_dir = chunk_dir or chunk_dir_path(file_path)
+        index = load_chunks(file_path, self.chunk_dir, grid=chunk_grid, sigma_method=sigma_method)
+        if index is None:
+            index = build_chunks(file_path, self.chunk_dir, grid=chunk_grid, sigma_method=sigma_method,
+                                 reservoir_size=reservoir_size)
+        self.cp = np.asarray(index['cp'], dtype=np.float32)
+        self.scale = index['scale']
+        self.bbox = np.asarray(index['bbox'], dtype=np.float32)
+        self.total_points = index['n_points']
+        self.cells = np.array([int(cell) for cell in index['chunks']], dtype=np.int64)
+        self.chunk_sizes = np.array([index['chunks'][str(cell)] for cell in self.cells], dtype=np.int64)
+        self.chunk_probs = self.chunk_sizes / self.chunk_sizes.sum()
+        self._chunks = {}
+
+        reservoir = np.load(os.path.join(self.chunk_dir, 'reservoir.npy'))
+        self.points, self.mnfld_n, self.sigmas = reservoir[:, :3], reservoir[:, 3:6], reservoir[:, 6:7]
+
+    def chunk(self, i):
+        # memory maps are opened lazily, so every DataLoader worker opens its own
+        if i not in self._chunks:
+            self._chunks[i] = np.load(chunk_file(self.chunk_dir, self.cells[i]), mmap_mode='r')
+        return self._chunks[i]
+
+    def sample_rows(self, n):
+        # stratified sample of n rows (xyz, normal, sigma) over the chunks, without replacement inside a chunk
+        per_chunk = np.random.multinomial(n, self.chunk_probs)
+        rows = []
+        for i in np.nonzero(per_chunk)[0]:
+            k, size = per_chunk[i], self.chunk_sizes[i]
+            # sorted indices keep the reads of a chunk sequential
+            idx = np.sort(np.random.choice(size, k, replace=k > size))
+            rows.append(self.chunk(i)[idx])
+        rows = np.concatenate(rows, axis=0)
+        return rows[np.random.permutation(n)]
+
+    def __getitem__(self, index):
+        rows = self.sample_rows(self.n_points)
+        manifold_points, manifold_normals, sigmas = rows[:, :3], rows[:, 3:6], rows[:, 6:7]
+        nonmnfld_points = np.random.uniform(-self.grid_range, self.grid_range,
+                                            size=(self.n_points, 3)).astype(np.float32)
+        near_points = (manifold_points + sigmas * np.random.randn(manifold_points.shape[0],
+                                                                  manifold_points.shape[1])).astype(np.float32)
+        return {'points': np.ascontiguousarray(manifold_points), 'mnfld_n': np.ascontiguousarray(manifold_normals),
+                'nonmnfld_points': nonmnfld_points, 'near_points': near_points}
+
+    def __getstate__(self):
+        # do not pickle open memory maps into DataLoader workers
+        state = self.__dict__.copy()
+        state['_chunks'] = {}
+        return state
+
+    def __len__(self):
+        return self.n_samples
+
+
+class DeviceSampler:
+    # Device-resident replacement for DataLoader(ReconDataset) when fitting a single shape: points, normals and sigmas
+    # live on the device and every batch is drawn with the on-device RNG, so there are no worker processes, no
+    # pickling and no host-to-device copies per iteration. Iterating yields len(self) batches shaped like the
+    # DataLoader ones: dicts of (batch_size, n_points, 3) tensors.
+    def __init__(self, dataset, batch_size=1, device='cpu', seed=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        # np.array copies out of a read-only memory-mapped bundle before handing the data to torch
+        self.points = torch.as_tensor(np.array(dataset.points), dtype=torch.float32, device=self.device)
+        self.mnfld_n = torch.as_tensor(np.array(dataset.mnfld_n), dtype=torch.float32, device=self.device)
+        self.sigmas = torch.as_tensor(np.array(dataset.sigmas), dtype=torch.float32, device=self.device)
+        self.generator = torch.Generator(device=self.device)
+        if seed is not None:
+            self.generator.manual_seed(seed)
+
+    def __len__(self):
+        # follows dataset.n_samples so a shortened (warm-start) schedule is picked up
+        return (self.dataset.n_samples + self.batch_size - 1) // self.batch_size
+
+    def sample_indices(self):
+        n_points = min(self.dataset.n_points, self.points.shape[0])
+        # random subset without replacement, like np.random.permutation(...)[:n_points] in __getitem__
+        return torch.stack([torch.randperm(self.points.shape[0], generator=self.generator,
+                                           device=self.device)[:n_points] for _ in range(self.batch_size)])
+
+    def sample(self):
+        mnfld_idx = self.sample_indices()
+        manifold_points = self.points[mnfld_idx]  # (batch_size, n_points, 3)
+        manifold_normals = self.mnfld_n[mnfld_idx]
+        nonmnfld_points = (torch.rand((self.batch_size, self.dataset.n_points, 3), generator=self.generator,
+                                      device=self.device) * 2 - 1) * self.dataset.grid_range
+        near_points = manifold_points + self.sigmas[mnfld_idx] * torch.randn(manifold_points.shape,
+                                                                             generator=self.generator,
+                                                                             device=self.device)
+        return {'points': manifold_points, 'mnfld_n': manifold_normals, 'nonmnfld_points': nonmnfld_points,
+                'near_points': near_points, 'mnfld_idx': mnfld_idx}
+
+    def __iter__(self):
+        for _ in range(len(self)):
+            yield self.sample()
+
+
+class ImportanceSampler(DeviceSampler):
+    # DeviceSampler that draws manifold points in proportion to a per-point score instead of uniformly, so the
+    # points the network still fits badly (sharp features, thin parts) are visited more often. The score is an
+    # exponential moving average of the MorseLoss per-point residuals of the iterations that sampled the point,
+    # normalised by the running mean residual so unvisited points keep the neutral score 1. Scores live in a SumTree
+    # on the device: updating the sampled points and drawing a batch are both O(log n) vectorised tensor ops.
+    # A uniform_fraction of every sample set stays uniform so that no region is starved.
+    def __init__(self, dataset, batch_size=1, device='cpu', seed=None, uniform_fraction=0.5, decay=0.9):
+        super().__init__(dataset, batch_size=batch_size, device=device, seed=seed)
+        self.uniform_fraction = uniform_fraction
+        self.decay = decay
+        self.mean_residual = None
+        self.tree = SumTree(torch.ones(self.points.shape[0]), device=self.device)
+
+    def sample_indices(self):
+        n_points = min(self.dataset.n_points, self.points.shape[0])
+        n_uniform = int(round(n_points * self.uniform_fraction))
+        # the uniform part stays without replacement, like DeviceSampler
+        uniform_idx = torch.stack([torch.randperm(self.points.shape[0], generator=self.generator,
+                                                  device=self.device)[:n_uniform] for _ in range(self.batch_size)])
+        weighted_idx = self.tree.sample((self.batch_size, n_points - n_uniform), generator=self.generator)
+        return torch.cat([uniform_idx, weighted_idx], dim=-1)
+
+    def update(self, mnfld_idx, residuals):
+        '''Folds the per-point residuals (batch_size, n_points) of the batch drawn with mnfld_idx into the scores'''
+        residuals = residuals.to(self.device).float()
+        batch_mean = residuals.mean()
+        if self.mean_residual is None:
+            self.mean_residual = batch_mean
+        else:
+            self.mean_residual = self.decay * self.mean_residual + (1 - self.decay) * batch_mean
+        scores = residuals / (self.mean_residual + 1e-12)
+        idx = mnfld_idx.to(self.device)
+        self.tree.update(idx, self.decay * self.tree.priorities[idx.flatten()].view_as(scores) +
+                         (1 - self.decay) * scores)
@@ -0,0 +1,74 @@
+import os
+import sys
+import gc
+import json
+import threading
+import traceback
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import torch
+
+# importing the trainer pays the torch / kaolin / open3d / trimesh start-up cost once per worker process
+import train_surface_reconstruction as trainer
+
+
+class JsonLinesWriter:
+    # stdout replacement that wraps every printed line into an 'output' message on the protocol channel;
+    # locked because the snapshot evaluator prints from its own thread
+    def __init__(self, channel):
+        self.channel = channel
+        self.buffer = ''
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock:
+            self.buffer += text
+            while '\n' in self.buffer:
+                line, self.buffer = self.buffer.split('\n', 1)
+                emit(self.channel, {'type': 'output', 'content': line})
+        return len(text)
+
+    def flush(self):
+        with self.lock:
+            if self.buffer:
+                emit(self.channel, {'type': 'output', 'content': self.buffer})
+                self.buffer = ''
+            self.channel.flush()
+
+
+def emit(channel, message):
+    channel.write(json.dumps(message) + '\n')
+    channel.flush()
+
+
+def main():
+    """
+    Long-lived reconstruction worker.
+    Reads one JSON task per line from stdin: {"job_id": ..., "work_dir": ..., "config": {...}}
+    and writes JSON lines to stdout: 'ready' once, 'output' for every printed line, then 'done' or 'failed' per task.
+    """
+    channel = sys.stdout
+    sys.stdout = JsonLinesWriter(channel)
+    emit(channel, {'type': 'ready', 'pid': os.getpid()})
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        task = json.loads(line)
+        try:
+            os.chdir(task['work_dir'])
+            result = trainer.reconstruct(task['config'])
+            result['min_cd'] = float(result['min_cd'])
+            sys.stdout.flush()
+            emit(channel, {'type': 'done', 'job_id': task['job_id'], 'result': result})
+        except Exception:
+            sys.stdout.flush()
+            emit(channel, {'type': 'failed', 'job_id': task['job_id'], 'error': traceback.format_exc()})
+        finally:
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+
+if __name__ == '__main__':
+    main()
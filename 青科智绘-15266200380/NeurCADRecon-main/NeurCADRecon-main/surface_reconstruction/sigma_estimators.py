@@ -0,0 +1,149 @@
+import os
+import hashlib
+
+import numpy as np
+import scipy.spatial as spatial
+
+# sigma of a point is the distance to its k-th nearest neighbour (the point itself being the first)
+SIGMA_K = 51
+
+
+def kdtree_sigmas(points, k=SIGMA_K):
+    # exact: k-NN query of every point on a KDTree of all points
+    kd_tree = spatial.KDTree(points)
+    dist, _ = kd_tree.query(points, k=k, workers=-1)
+    return dist[:, -1:]
+
+
+def _voxelize(points, voxel_size):
+    # returns the voxel index of every point, the number of points per voxel and the voxel centroids
+    keys = np.floor(points / voxel_size).astype(np.int64)
+    _, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    centroids = np.stack([np.bincount(inverse, weights=points[:, i]) for i in range(3)], axis=-1)
+    return inverse, counts, centroids / counts[:, None]
+
+
+def voxel_sigmas(points, k=SIGMA_K, target_voxels=200000, n_neighbours=32):
+    '''
+    Approximate k-NN distance on a voxel-downsampled cloud. Every voxel is represented by its centroid weighted by
+    its point count; the sigma of a voxel is the distance to the nearest neighbouring centroids whose accumulated
+    counts reach k, and every point takes the sigma of its voxel. Only the voxel centroids go into the KDTree, so
+    the cost is one np.unique over the points plus a small k-NN query.
+    '''
+    n = points.shape[0]
+    if n <= target_voxels:
+        return kdtree_sigmas(points, k)
+
+    # pick the voxel size so that about target_voxels voxels are occupied; surface occupancy scales as 1/size^2
+    extent = np.ptp(points, axis=0).max()
+    voxel_size = extent / np.sqrt(target_voxels)
+    for attempt in range(3):
+        inverse, counts, centroids = _voxelize(points, voxel_size)
+        ratio = len(counts) / target_voxels
+        if 0.5 < ratio < 2.0 or attempt == 2:
+            # keep voxel_size equal to the size counts was computed with, the disk radius below depends on it
+            break
+        voxel_size *= np.sqrt(ratio)
+
+    n_neighbours = min(n_neighbours, len(counts))
+    dist, idx = spatial.KDTree(centroids).query(centroids, k=n_neighbours, workers=-1)
+    cumulative = np.cumsum(counts[idx], axis=1)
+    reached = cumulative >= k
+    first = np.where(reached.any(axis=1), reached.argmax(axis=1), n_neighbours - 1)
+    voxel_sigma = dist[np.arange(len(counts)), first]
+    # a voxel that alone holds k points: use the radius of a disk holding k of its points
+    own = first == 0
+    voxel_sigma[own] = voxel_size * np.sqrt(k / (np.pi * counts[own]))
+    return voxel_sigma[inverse][:, None]
+
+
+def grid_sigmas(points, k=SIGMA_K, target_cells=200000):
+    '''
+    Grid-hash estimate without any tree: count the points in the 3x3x3 block of cells around each point's cell,
+    treat them as spread over a surface patch of area (3h)^2 and return the radius of the disk holding k points,
+    sqrt(k / (pi * density)). Linear in the number of points apart from the sort of the occupied cells.
+    '''
+    extent = np.ptp(points, axis=0).max()
+    cell = extent / np.sqrt(target_cells)
+    keys = np.floor(points / cell).astype(np.int64)
+    keys -= keys.min(axis=0)
+    dims = keys.max(axis=0) + 3
+    flat = ((keys[:, 0] + 1) * dims[1] + keys[:, 1] + 1) * dims[2] + keys[:, 2] + 1
+    cells, inverse, counts = np.unique(flat, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+
+    neighbourhood = np.zeros(len(cells), dtype=np.int64)
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                shifted = cells + (dx * dims[1] + dy) * dims[2] + dz
+                pos = np.clip(np.searchsorted(cells, shifted), 0, len(cells) - 1)
+                neighbourhood += np.where(cells[pos] == shifted, counts[pos], 0)
+
+    density = neighbourhood / (3 * cell) ** 2
+    cell_sigma = np.sqrt(k / (np.pi * density))
+    return cell_sigma[inverse][:, None]
+
+
+ESTIMATORS = {'kdtree': kdtree_sigmas, 'voxel': voxel_sigmas, 'grid': grid_sigmas}
+
+
+def sigma_cache_path(file_path, method, k=SIGMA_K):
+    return '{}.sigmas_{}_k{}.npz'.format(file_path, method, k)
+
+
+# fingerprints already known in this process, keyed by the file's identity: (path, inode, size, mtime_ns)
+_fingerprints = {}
+
+
+def _file_key(path):
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def register_fingerprint(path, digest):
+    '''Records the SHA-256 of path computed elsewhere (the server hashes every upload), so it is never re-read'''
+    _fingerprints[_file_key(path)] = digest
+
+
+def file_fingerprint(path, block_size=1 << 20):
+    # SHA-256 of the whole file, read in blocks: any edit invalidates the caches, touching the file does not. The
+    # bundle, chunk and sigma caches all check it, so it is computed once per file version and process
+    key = _file_key(path)
+    if key not in _fingerprints:
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                hasher.update(block)
+        _fingerprints[key] = hasher.hexdigest()
+    return _fingerprints[key]
+
+
+def estimate_sigmas(points, method='kdtree', k=SIGMA_K, source_path=None):
+    '''
+    Per-point sigmas (n, 1) with the selected estimator. With source_path (the file the points were read from), the
+    array is cached next to it and reused while the file fingerprint matches and it has one entry per point.
+    '''
+    cache_path, fingerprint = None, None
+    if source_path is not None:
+        cache_path = sigma_cache_path(source_path, method, k)
+        fingerprint = file_fingerprint(source_path)
+        try:
+            with np.load(cache_path) as cached:
+                if str(cached['fingerprint']) == fingerprint and cached['sigmas'].shape == (points.shape[0], 1):
+                    return cached['sigmas']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    sigmas = ESTIMATORS[method](points, k).astype(np.float32)
+
+    if cache_path is not None:
+        try:
+            tmp_path = cache_path + '.tmp.npz'
+            np.savez(tmp_path, sigmas=sigmas, fingerprint=fingerprint)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # the input may live in a read-only directory; the cache is only an optimisation
+            pass
+    return sigmas
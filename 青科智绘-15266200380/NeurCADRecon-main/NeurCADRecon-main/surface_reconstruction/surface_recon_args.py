@@ -8,11 +8,35 @@ def add_args(parser):
     parser.add_argument('--data_path', type=str,
                             default='../../../converted_ply/1.ply',
                         help='path to input dir')
+    parser.add_argument('--data_sha256', type=str, default=None,
+                        help='SHA-256 of the input file if already known, used as its cache fingerprint')
     parser.add_argument('--mesh_dir', type=str, default='../data/fandisk/gt', help='path to the gt folder')
     parser.add_argument('--n_samples', type=int, default=10000,
                         help='numbers of epochs')
     parser.add_argument('--n_points', type=int, default=10000, help='number of points in each point cloud')
     parser.add_argument('--grid_res', type=int, default=128, help='uniform grid resolution')
+    parser.add_argument('--sigma_method', type=str, default='kdtree', choices=['kdtree', 'voxel', 'grid'],
+                        help='near-surface sigma estimator: kdtree (exact 51-NN) | voxel (k-NN on a voxel-downsampled '
+                             'cloud) | grid (grid-hash density)')
+    parser.add_argument('--sigma_cache', action='store_true',
+                        help='if true, cache the sigma array next to the input file and reuse it')
+    parser.add_argument('--out_of_core', action='store_true',
+                        help='if true, split the point cloud into spatial chunks on disk and sample them out of core, '
+                             'for point clouds larger than RAM')
+    parser.add_argument('--chunk_dir', type=str, default=None,
+                        help='directory of the out-of-core chunks, defaults to <data_path>.chunks')
+    parser.add_argument('--chunk_grid', type=int, default=8, help='chunks per axis of the out-of-core split')
+    parser.add_argument('--reservoir_size', type=int, default=1000000,
+                        help='size of the in-memory uniform subsample kept by the out-of-core dataset')
+    parser.add_argument('--sampler', type=str, default='dataloader', choices=['dataloader', 'device'],
+                        help='dataloader: CPU sampling through a DataLoader | device: sample on the training device')
+    parser.add_argument('--importance_sampling', action='store_true',
+                        help='if true, draw manifold points in proportion to their running loss residual (uses the '
+                             'device sampler)')
+    parser.add_argument('--importance_uniform_fraction', type=float, default=0.5,
+                        help='fraction of every sample set that stays uniformly sampled under importance sampling')
+    parser.add_argument('--importance_decay', type=float, default=0.9,
+                        help='moving average decay of the per-point importance scores')
     parser.add_argument('--nonmnfld_sample_type', type=str, default='gaussian',
                         help='how to sample points off the manifold - grid | gaussian | combined')
 
@@ -22,6 +46,38 @@ def add_args(parser):
     parser.add_argument('--grad_clip_norm', type=float, default=10.0, help='Value to clip gradients to')
     parser.add_argument('--batch_size', type=int, default=1, help='number of samples in a minibatch')
     parser.add_argument('--load_path', type=str, default=None)
+    parser.add_argument('--checkpoint_library', type=str, default=None,
+                        help='if set, warm-start from the closest stored checkpoint and add the final weights to it')
+    parser.add_argument('--warm_start_n_samples', type=int, default=2000,
+                        help='number of iterations when warm-starting from a library checkpoint')
+    parser.add_argument('--warm_start_max_distance', type=float, default=0.1,
+                        help='maximum shape descriptor distance for a library checkpoint to be used')
+    parser.add_argument('--mesh_extractor', type=str, default='flexicubes', choices=['flexicubes', 'narrow_band'],
+                        help='mesh extraction during training: flexicubes (dense grid) | narrow_band (coarse-to-fine, '
+                             'evaluates only cells near the surface, then marching cubes)')
+    parser.add_argument('--coarse_res', type=int, default=32,
+                        help='resolution of the coarsest level of the narrow_band extractor')
+    parser.add_argument('--inference_dtype', type=str, default='float32', choices=['float32', 'bfloat16', 'float16'],
+                        help='dtype of the fused SIREN forward used for mesh extraction; bfloat16 is faster but only '
+                             'accurate to ~1e-2 of the SDF')
+    parser.add_argument('--sync_eval', action='store_true',
+                        help='if true, extract and evaluate meshes inline, blocking the optimizer')
+    parser.add_argument('--early_stop', action='store_true',
+                        help='if true, stop once the smoothed losses stop improving')
+    parser.add_argument('--early_stop_patience', type=int, default=1000,
+                        help='iterations without relative improvement before stopping')
+    parser.add_argument('--early_stop_min_rel_improvement', type=float, default=0.01,
+                        help='relative decrease of a smoothed metric that counts as an improvement')
+    parser.add_argument('--early_stop_warmup', type=int, default=1000, help='never stop before this many iterations')
+    parser.add_argument('--early_stop_interval', type=int, default=50,
+                        help='evaluate the stopping criterion every n iterations')
+    parser.add_argument('--early_stop_metrics', nargs='+', type=str, default=['loss', 'sdf_term'],
+                        help='loss_dict entries that must all plateau, e.g. loss sdf_term')
+    parser.add_argument('--log_interval', type=int, default=10, help='print the training losses every n iterations')
+    parser.add_argument('--progress_file', type=str, default=None,
+                        help='if set, append JSON-lines progress records (losses, it/s, ETA) to this file')
+    parser.add_argument('--progress_interval', type=float, default=1.0,
+                        help='minimum number of seconds between two progress records')
 
     # Network architecture and loss
     parser.add_argument('--init_type', type=str, default='siren',
@@ -46,6 +102,9 @@ def add_args(parser):
     parser.add_argument('--bidirectional_morse', action='store_true',
                         help='if true, add morse constraints to both input point and sampling point')
     parser.add_argument('--morse_near', default=True)
+    parser.add_argument('--hessian_engine', type=str, default='autograd', choices=['autograd', 'analytic', 'func'],
+                        help='Hessian of the morse term: autograd (reverse passes in the loss) | analytic (closed-form '
+                             'propagation through the SIREN layers) | func (torch.func jacfwd over grad, vmapped)')
     parser.add_argument('--weight_for_morse', action='store_true',
                         help='if true, Weighting A according to the distance of the sampling point')
     parser.add_argument('--use_morse_nonmnfld_grad', type=bool, default=False,
@@ -55,8 +114,18 @@ def add_args(parser):
     return parser
 
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser()
     parser = add_args(parser)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    return args
+
+
+def get_args_from_config(config):
+    # build the args namespace from the defaults, overridden by the entries of a config dict
+    args = get_args([])
+    for key, value in config.items():
+        if not hasattr(args, key):
+            raise ValueError('unknown reconstruction argument: {}'.format(key))
+        setattr(args, key, value)
     return args
@@ -6,188 +6,260 @@ os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import numpy as np
-import trimesh
 import torch
 import torch.optim as optim
 from torchinfo import summary
 
 from models import Network, MorseLoss
+import models.hessian as hessian
 import utils.utils as utils
 import utils.visualizations as vis
+from utils.progress import ProgressWriter
+from utils.checkpoints import CheckpointLibrary, shape_descriptor, architecture
+from utils.early_stopping import EarlyStopping
+from utils.snapshot_eval import SnapshotEvaluator
 import surface_recon_args
 import recon_dataset as dataset
+from sigma_estimators import register_fingerprint
 import kaolin as kal
 
-args = surface_recon_args.get_args()
-
-file_name = os.path.splitext(args.data_path.split('/')[-1])[0]
-gt_path = glob.glob(os.path.join(args.mesh_dir, os.path.splitext(args.data_path.split('/')[-1])[0] + '*'))
-logdir = os.path.join(args.logdir, file_name)
-os.makedirs(logdir, exist_ok=True)
-
-# set up logging
-log_file, log_writer_train, log_writer_test, model_outdir = utils.setup_logdir(logdir, args)
-os.system('cp %s %s' % (__file__, logdir))  # backup the current training file
-os.system('cp %s %s' % ('recon_dataset.py', logdir))  # backup the current training file
-os.system('cp %s %s' % ('../models/DiGS.py', logdir))  # backup the models files
-os.system('cp %s %s' % ('../models/losses.py', logdir))  # backup the losses files
-
-device = 'cpu' if not torch.cuda.is_available() else 'cuda'
-
-# get data loaders
-utils.same_seed(args.seed)
-train_set = dataset.ReconDataset(args.data_path, args.n_points, args.n_samples, args.grid_res,
-                                 args.nonmnfld_sample_type)
-
-train_dataloader = torch.utils.data.DataLoader(train_set, batch_size=args.batch_size, shuffle=True, num_workers=4,
-                                               pin_memory=True)
-# get model
-net = Network(in_dim=3, decoder_hidden_dim=args.decoder_hidden_dim, nl=args.nl,
-              decoder_n_hidden_layers=args.decoder_n_hidden_layers, init_type=args.init_type,
-              sphere_init_params=args.sphere_init_params, udf=args.udf)
-net.to(device)
-if args.load_path is not None:
-    net.load_state_dict(torch.load(args.load_path))
-    print('Loaded model from %s' % args.load_path)
-summary(net.decoder, (1, 1024, 3))
-
-n_parameters = utils.count_parameters(net)
-utils.log_string("Number of parameters in the current model:{}".format(n_parameters), log_file)
-
-# Setup Adam optimizers
-optimizer = optim.Adam(net.parameters(), lr=args.lr, weight_decay=0.0)
-n_iterations = args.n_samples * (args.num_epochs)
-print('n_iterations: ', n_iterations)
-
-net.to(device)
-
-criterion = MorseLoss(weights=args.loss_weights, loss_type=args.loss_type, div_decay=args.morse_decay,
-                      div_type=args.morse_type, bidirectional_morse=args.bidirectional_morse, udf=args.udf)
-
-num_batches = len(train_dataloader)
-refine_flag = True
-min_cd = np.inf
-max_f1 = -np.inf
-# For each epoch
-for epoch in range(args.num_epochs):
-    # For each batch in the dataloader
-    for batch_idx, data in enumerate(train_dataloader):
-        if batch_idx != 0 and (batch_idx % 500 == 0 or batch_idx == len(train_dataloader) - 1):
-            output_dir = os.path.join(logdir, 'vis')
-            os.makedirs(output_dir, exist_ok=True)
-            # vis.plot_cuts_iso(net.decoder, save_path=os.path.join(output_dir, str(batch_idx) + '.html'))
-            try:
-                shapename = file_name
-                output_dir = os.path.join(logdir, 'result_meshes')
-                os.makedirs(output_dir, exist_ok=True)
-                cp, scale, bbox = train_set.cp, train_set.scale, train_set.bbox
-                mesh_dict = None
-                # mesh = utils.implicit2mesh(net.decoder, None,
-                #                            args.grid_res,
-                #                            translate=-cp,
-                #                            scale=1 / scale,
-                #                            get_mesh=True, device=device, bbox=bbox)
-                
-
-                mesh = utils.flexicubes2mesh(net.decoder, None,
-                                           args.grid_res,
-                                           translate=-cp,
-                                           scale=1 / scale,
-                                           get_mesh=True, device=device)
-
-                pred_mesh = mesh.copy()
-                cd_l1 = np.inf
-                f1_mu = np.inf
-                if len(gt_path) != 0:
-                    print('gt_path:', gt_path[0])
-                    gt = trimesh.load(gt_path[0], process=False)
-                    if isinstance(gt, trimesh.Scene):
-                        gt = trimesh.load(gt_path[0], process=False, force='mesh')
-                    nc_ind, cd_l1, cd_l2, f1_mu, euler_num = utils.eval_reconstruct_gt(pred_mesh, gt)
-                    print(
-                        'iter: {}, cd_l1: {:.7f}, cd_l2: {:.7f}, f1_mu: {:.7f}, euler_num: {:.7f}'.format(batch_idx,
-                                                                                                          cd_l1, cd_l2,
-                                                                                                          f1_mu,
-                                                                                                          euler_num),
-                        log_file)
-                    utils.log_string(
-                        'iter: {}, cd_l1: {:.7f}, cd_l2: {:.7f}, f1_mu: {:.7f} , euler_num: {:.7f}'.format(batch_idx,
-                                                                                                           cd_l1, cd_l2,
-                                                                                                           f1_mu,
-                                                                                                           euler_num),
-                        log_file)
-                    if cd_l1 < min_cd:
-                        min_cd = cd_l1
-                        # save model
-                        utils.log_string(
-                            "saving model to file :{}".format(
-                                '%s_generator_model_%d.pth' % (args.model_name, batch_idx)),
-                            log_file)
-                        # torch.save(net.state_dict(),
-                        #            os.path.join(model_outdir,
-                        #                         '%s_model_%d_%.5f.pth' % (args.model_name, batch_idx, min_cd)))
-                        best_path = os.path.join(output_dir,
-                                                 shapename + '.ply'.format(batch_idx,
-                                                                                                              euler_num,
-                                                                                                              str(min_cd),
-                                                                                                              f1_mu))
-                        mesh.export(best_path)
-
-                if args.output_any:
-                    output_ply_filepath = os.path.join(output_dir,
-                                                       shapename + '.ply')
-                    print('Saving to ', output_ply_filepath)
-                    mesh.export(output_ply_filepath)
-            except Exception as e:
-                print(e)
-                print('Could not generate mesh\n')
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def reconstruct(config):
+    """
+    Fit a neural SDF to one point cloud and extract its mesh.
+    :param config: argparse.Namespace from surface_recon_args, or a dict of overrides of its defaults
+    :return: dict with the log directory, the exported mesh path, the final weights path and the best chamfer distance
+    """
+    if isinstance(config, dict):
+        args = surface_recon_args.get_args_from_config(config)
+    else:
+        args = config
+
+    file_name = os.path.splitext(args.data_path.split('/')[-1])[0]
+    gt_path = glob.glob(os.path.join(args.mesh_dir, os.path.splitext(args.data_path.split('/')[-1])[0] + '*'))
+    logdir = os.path.join(args.logdir, file_name)
+    os.makedirs(logdir, exist_ok=True)
+
+    # set up logging
+    log_file, log_writer_train, log_writer_test, model_outdir = utils.setup_logdir(logdir, args)
+    os.system('cp %s %s' % (__file__, logdir))  # backup the current training file
+    os.system('cp %s %s' % (os.path.join(SCRIPT_DIR, 'recon_dataset.py'), logdir))  # backup the current training file
+    os.system('cp %s %s' % (os.path.join(SCRIPT_DIR, '../models/DiGS.py'), logdir))  # backup the models files
+    os.system('cp %s %s' % (os.path.join(SCRIPT_DIR, '../models/losses.py'), logdir))  # backup the losses files
+
+    device = 'cpu' if not torch.cuda.is_available() else 'cuda'
+
+    if args.data_sha256:
+        # the server already hashed the input: the bundle, chunk and sigma caches reuse that digest
+        register_fingerprint(args.data_path, args.data_sha256)
+
+    # get data loaders
+    utils.same_seed(args.seed)
+    if args.out_of_core:
+        train_set = dataset.ChunkedReconDataset(args.data_path, args.n_points, args.n_samples,
+                                                chunk_dir=args.chunk_dir, chunk_grid=args.chunk_grid,
+                                                reservoir_size=args.reservoir_size, sigma_method=args.sigma_method)
+    else:
+        train_set = dataset.ReconDataset(args.data_path, args.n_points, args.n_samples, args.grid_res,
+                                         args.nonmnfld_sample_type, sigma_method=args.sigma_method,
+                                         sigma_cache=args.sigma_cache)
+
+    # warm-start from the checkpoint of the most similar previously fitted shape, with a shorter schedule
+    library, descriptor, warm_start = None, None, None
+    if args.checkpoint_library is not None:
+        library = CheckpointLibrary(args.checkpoint_library)
+        descriptor = shape_descriptor(train_set.points)
+        if args.load_path is None:
+            nearest_path, distance = library.nearest(descriptor, architecture(args),
+                                                     max_distance=args.warm_start_max_distance)
+            if nearest_path is not None:
+                args.load_path = nearest_path
+                args.n_samples = min(args.n_samples, args.warm_start_n_samples)
+                train_set.n_samples = args.n_samples
+                warm_start = {'load_path': nearest_path, 'distance': distance}
+                utils.log_string('Warm-starting from {} (descriptor distance {:.4f}), {} iterations'.format(
+                    nearest_path, distance, args.n_samples), log_file)
+
+    # the device samplers only see the in-memory reservoir of an out-of-core dataset, so that one keeps the DataLoader
+    if args.importance_sampling and not args.out_of_core:
+        # loss-driven sampling needs the scores in the training process, next to the loss
+        train_dataloader = dataset.ImportanceSampler(train_set, batch_size=args.batch_size, device=device,
+                                                     seed=args.seed, uniform_fraction=args.importance_uniform_fraction,
+                                                     decay=args.importance_decay)
+    elif args.sampler == 'device' and not args.out_of_core:
+        # draw the batches on the training device, no DataLoader workers and no host-to-device copies
+        train_dataloader = dataset.DeviceSampler(train_set, batch_size=args.batch_size, device=device, seed=args.seed)
+    else:
+        train_dataloader = torch.utils.data.DataLoader(train_set, batch_size=args.batch_size, shuffle=True,
+                                                       num_workers=4, pin_memory=True)
+    # get model
+    net = Network(in_dim=3, decoder_hidden_dim=args.decoder_hidden_dim, nl=args.nl,
+                  decoder_n_hidden_layers=args.decoder_n_hidden_layers, init_type=args.init_type,
+                  sphere_init_params=args.sphere_init_params, udf=args.udf)
+    net.to(device)
+    if args.load_path is not None:
+        net.load_state_dict(torch.load(args.load_path, map_location=device))
+        print('Loaded model from %s' % args.load_path)
+    if args.hessian_engine != 'autograd':
+        engine = args.hessian_engine
+        if engine == 'analytic' and not hessian.supports_analytic(net.decoder):
+            engine = 'func'
+        # the engine must reproduce the autograd derivatives before it replaces them
+        parity_points = torch.rand(1, 256, 3, device=device) * 2 - 1
+        error = hessian.check_parity(net.decoder, parity_points, engine)
+        if error < 1e-3:
+            net.hessian_engine = engine
+            utils.log_string('Hessian engine {} (max relative deviation from autograd {:.2e})'.format(engine, error),
+                             log_file)
+        else:
+            utils.log_string('Hessian engine {} deviates from autograd by {:.2e}, using autograd'.format(
+                engine, error), log_file)
+    summary(net.decoder, (1, 1024, 3))
+
+    n_parameters = utils.count_parameters(net)
+    utils.log_string("Number of parameters in the current model:{}".format(n_parameters), log_file)
+
+    # Setup Adam optimizers
+    optimizer = optim.Adam(net.parameters(), lr=args.lr, weight_decay=0.0)
+    # one iteration is one optimizer step over batch_size sample sets, so a larger batch shortens the schedule
+    n_iterations = len(train_dataloader) * args.num_epochs
+    print('n_iterations: ', n_iterations)
+
+    net.to(device)
+
+    criterion = MorseLoss(weights=args.loss_weights, loss_type=args.loss_type, div_decay=args.morse_decay,
+                          div_type=args.morse_type, bidirectional_morse=args.bidirectional_morse, udf=args.udf,
+                          track_residuals=isinstance(train_dataloader, dataset.ImportanceSampler))
+
+    num_batches = len(train_dataloader)
+    refine_flag = True
+    max_f1 = -np.inf
+    # mesh extraction and GT evaluation run on decoder snapshots in a background thread while training continues
+    evaluator = SnapshotEvaluator(os.path.join(logdir, 'result_meshes'), file_name, args.grid_res,
+                                  train_set.cp, train_set.scale, gt_path=gt_path[0] if len(gt_path) != 0 else None,
+                                  output_any=args.output_any, device=device, log_file=log_file,
+                                  asynchronous=not args.sync_eval,
+                                  inference_dtype=None if args.inference_dtype == 'float32' else getattr(torch, args.inference_dtype),
+                                  extractor=args.mesh_extractor, coarse_res=args.coarse_res)
+    progress = ProgressWriter(args.progress_file, n_iterations, interval=args.progress_interval)
+    early_stopping = None
+    if args.early_stop:
+        early_stopping = EarlyStopping(patience=args.early_stop_patience,
+                                       min_rel_improvement=args.early_stop_min_rel_improvement,
+                                       warmup=args.early_stop_warmup, metrics=args.early_stop_metrics)
+    stopped = False
+    iteration = 0
+    final_loss = None
+    # For each epoch
+    for epoch in range(args.num_epochs):
+        # For each batch in the dataloader
+        for batch_idx, data in enumerate(train_dataloader):
+            # snapshot the decoder for mesh extraction / evaluation; the last snapshot is the final mesh,
+            # also when early stopping ends training
+            final_snapshot = batch_idx == len(train_dataloader) - 1 or stopped
+            if batch_idx != 0 and (batch_idx % 500 == 0 or final_snapshot):
+                evaluator.submit(net.decoder, batch_idx, final=final_snapshot)
+            if evaluator.failed or stopped:
                 break
 
-        net.zero_grad()
-        net.train()
-
-        mnfld_points, mnfld_n_gt, nonmnfld_points, near_points = data['points'].to(device), data['mnfld_n'].to(device), \
-            data['nonmnfld_points'].to(device), data['near_points'].to(device)
-
-        mnfld_points.requires_grad_()
-        nonmnfld_points.requires_grad_()
-        near_points.requires_grad_()
-
-        output_pred = net(nonmnfld_points, mnfld_points, near_points=near_points if args.morse_near else None)
-        loss_dict, _ = criterion(output_pred, mnfld_points, nonmnfld_points, mnfld_n_gt,
-                                 near_points=near_points if args.morse_near else None)
-        lr = torch.tensor(optimizer.param_groups[0]['lr'])
-        loss_dict["lr"] = lr
-        utils.log_losses(log_writer_train, epoch, batch_idx, num_batches, loss_dict, args.batch_size)
-
-        loss_dict["loss"].backward()
-
-        if args.grad_clip_norm > 0:
-            torch.nn.utils.clip_grad_norm_(net.parameters(), args.grad_clip_norm)
-
-        optimizer.step()
-
-        # Output training stats
-        if batch_idx % 10 == 0:
-            weights = criterion.weights
-            utils.log_string("Weights: {}, lr={:.3e}".format(weights, lr), log_file)
-            utils.log_string('Epoch: {} [{:4d}/{} ({:.0f}%)] Loss: {:.5f} = L_Mnfld: {:.5f} + '
-                             'L_NonMnfld: {:.5f} + L_Nrml: {:.5f} + L_Eknl: {:.5f} + L_Div: {:.5f} + L_Morse: {:.5f}'.format(
-                epoch, batch_idx * args.batch_size, len(train_set), 100. * batch_idx / len(train_dataloader),
-                loss_dict["loss"].item(), weights[0] * loss_dict["sdf_term"].item(),
-                       weights[1] * loss_dict["inter_term"].item(),
-                       weights[2] * loss_dict["normals_loss"].item(), weights[3] * loss_dict["eikonal_term"].item(),
-                       weights[4] * loss_dict["div_loss"].item(), weights[5] * loss_dict['morse_term'].item(),
-            ),
-                log_file)
-            utils.log_string('Epoch: {} [{:4d}/{} ({:.0f}%)] Unweighted L_s : L_Mnfld: {:.5f},  '
-                             'L_NonMnfld: {:.5f},  L_Nrml: {:.5f},  L_Eknl: {:.5f}, L_Morse: {:.5f}'.format(
-                epoch, batch_idx * args.batch_size, len(train_set), 100. * batch_idx / len(train_dataloader),
-                loss_dict["sdf_term"].item(), loss_dict["inter_term"].item(),
-                loss_dict["normals_loss"].item(), loss_dict["eikonal_term"].item(),
-                loss_dict['morse_term'].item()),
-                log_file)
-            utils.log_string('', log_file)
-
-        criterion.update_morse_weight(epoch * args.n_samples + batch_idx, args.num_epochs * args.n_samples,
-                                      args.decay_params)  # assumes batch size of 1
+            net.zero_grad()
+            net.train()
+
+            mnfld_points, mnfld_n_gt, nonmnfld_points, near_points = data['points'].to(device), data['mnfld_n'].to(device), \
+                data['nonmnfld_points'].to(device), data['near_points'].to(device)
+
+            mnfld_points.requires_grad_()
+            nonmnfld_points.requires_grad_()
+            near_points.requires_grad_()
+
+            output_pred = net(nonmnfld_points, mnfld_points, near_points=near_points if args.morse_near else None)
+            loss_dict, _ = criterion(output_pred, mnfld_points, nonmnfld_points, mnfld_n_gt,
+                                     near_points=near_points if args.morse_near else None)
+            lr = torch.tensor(optimizer.param_groups[0]['lr'])
+            loss_dict["lr"] = lr
+            iteration = epoch * num_batches + batch_idx + 1
+            # tensorboard needs .item() on every loss term: only log when a progress record or log line is due anyway
+            report = progress.due(iteration)
+            if report or batch_idx % args.log_interval == 0:
+                utils.log_losses(log_writer_train, epoch, batch_idx, num_batches, loss_dict, args.batch_size)
+
+            loss_dict["loss"].backward()
+            # kept as a tensor: .item() would sync with the device on every step
+            final_loss = loss_dict["loss"].detach()
+            if criterion.point_residuals is not None:
+                train_dataloader.update(data['mnfld_idx'], criterion.point_residuals)
+
+            if args.grad_clip_norm > 0:
+                torch.nn.utils.clip_grad_norm_(net.parameters(), args.grad_clip_norm)
+
+            optimizer.step()
+
+            # Report structured progress (loss terms, it/s, ETA) to the side file
+            if report:
+                progress.write(epoch, iteration, {k: v.item() for k, v in loss_dict.items()},
+                               morse_weight=criterion.weights[5])
+
+            # Stop once the smoothed losses plateau; only sync the loss tensors every early_stop_interval iterations
+            if early_stopping is not None and iteration % args.early_stop_interval == 0:
+                stopped = early_stopping.update(iteration, {k: loss_dict[k].item() for k in early_stopping.metrics})
+                if stopped:
+                    utils.log_string('Early stopping at iteration {}/{}: no {:.1%} improvement of {} in {} '
+                                     'iterations'.format(iteration, n_iterations, args.early_stop_min_rel_improvement,
+                                                         ', '.join(early_stopping.metrics), args.early_stop_patience),
+                                     log_file)
+
+            # Output training stats
+            if batch_idx % args.log_interval == 0:
+                weights = criterion.weights
+                utils.log_string("Weights: {}, lr={:.3e}".format(weights, lr), log_file)
+                utils.log_string('Epoch: {} [{:4d}/{} ({:.0f}%)] Loss: {:.5f} = L_Mnfld: {:.5f} + '
+                                 'L_NonMnfld: {:.5f} + L_Nrml: {:.5f} + L_Eknl: {:.5f} + L_Div: {:.5f} + L_Morse: {:.5f}'.format(
+                    epoch, batch_idx * args.batch_size, len(train_set), 100. * batch_idx / len(train_dataloader),
+                    loss_dict["loss"].item(), weights[0] * loss_dict["sdf_term"].item(),
+                           weights[1] * loss_dict["inter_term"].item(),
+                           weights[2] * loss_dict["normals_loss"].item(), weights[3] * loss_dict["eikonal_term"].item(),
+                           weights[4] * loss_dict["div_loss"].item(), weights[5] * loss_dict['morse_term'].item(),
+                ),
+                    log_file)
+                utils.log_string('Epoch: {} [{:4d}/{} ({:.0f}%)] Unweighted L_s : L_Mnfld: {:.5f},  '
+                                 'L_NonMnfld: {:.5f},  L_Nrml: {:.5f},  L_Eknl: {:.5f}, L_Morse: {:.5f}'.format(
+                    epoch, batch_idx * args.batch_size, len(train_set), 100. * batch_idx / len(train_dataloader),
+                    loss_dict["sdf_term"].item(), loss_dict["inter_term"].item(),
+                    loss_dict["normals_loss"].item(), loss_dict["eikonal_term"].item(),
+                    loss_dict['morse_term'].item()),
+                    log_file)
+                utils.log_string('', log_file)
+
+            # the schedule advances per optimizer step, independently of the batch size
+            criterion.update_morse_weight(iteration, n_iterations, args.decay_params)
+        if stopped:
+            break
+
+    evaluator.close()
+    min_cd, result_mesh_path = evaluator.min_cd, evaluator.result_mesh_path
+
+    # save the final weights so the server can cache them together with the mesh
+    model_path = os.path.join(model_outdir, '%s_model.pth' % args.model_name)
+    torch.save(net.state_dict(), model_path)
+    utils.log_string("saving model to file :{}".format(model_path), log_file)
+    # a run that did not take a single step (e.g. the evaluator failed at once) has nothing worth warm-starting from
+    if library is not None and final_loss is not None:
+        library.add(model_path, descriptor, architecture(args), data_path=args.data_path,
+                    final_loss=final_loss.item(), n_iterations=n_iterations)
+
+    summary_record = {'iterations_run': iteration, 'saved_iterations': n_iterations - iteration,
+                      'early_stopped': stopped, 'warm_start': warm_start}
+    progress.emit(dict({'type': 'done', 'result_mesh_path': result_mesh_path, 'model_path': model_path,
+                        'min_cd': float(min_cd)}, **summary_record))
+    progress.close()
+    log_file.close()
+    log_writer_train.close()
+    log_writer_test.close()
+    return dict({'logdir': logdir, 'result_mesh_path': result_mesh_path, 'model_path': model_path, 'min_cd': min_cd,
+                 'n_iterations': n_iterations}, **summary_record)
+
+
+if __name__ == '__main__':
+    reconstruct(surface_recon_args.get_args())
@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import uuid
+import shutil
+
+import numpy as np
+
+# architecture arguments that must match for a state_dict to be loadable
+ARCH_KEYS = ('decoder_hidden_dim', 'decoder_n_hidden_layers', 'init_type', 'nl', 'udf')
+
+
+def shape_descriptor(points):
+    '''
+    Cheap descriptor of a point cloud that was centred and scaled like ReconDataset does (points in [-1, 1]):
+    the per-axis bounding box extents, the per-axis standard deviations and the log point count.
+    The network is fitted in this normalised frame, so shapes with close descriptors have close SDFs.
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    extents = points.max(axis=0) - points.min(axis=0)
+    stds = points.std(axis=0)
+    return [float(v) for v in extents] + [float(v) for v in stds] + [float(np.log10(max(len(points), 1))) / 10.]
+
+
+def architecture(args):
+    return {key: getattr(args, key) for key in ARCH_KEYS}
+
+
+class CheckpointLibrary:
+    '''
+    Directory of state_dicts of finished runs, each stored as <id>.pth next to an <id>.json record holding the shape
+    descriptor, the network architecture and the final loss. There is no shared index file, so several training
+    processes can add and query entries concurrently; writes are made atomic with os.replace.
+    '''
+
+    def __init__(self, root, max_entries=200):
+        self.root = root
+        self.max_entries = max_entries
+        os.makedirs(self.root, exist_ok=True)
+
+    def _records(self):
+        records = []
+        for filename in os.listdir(self.root):
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(self.root, filename)
+            try:
+                with open(path, 'r') as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                continue
+            record['model_path'] = os.path.join(self.root, record['id'] + '.pth')
+            if os.path.exists(record['model_path']):
+                records.append(record)
+        return records
+
+    def nearest(self, descriptor, arch, max_distance=np.inf):
+        '''Returns (model_path, distance) of the closest compatible checkpoint, or (None, inf)'''
+        best_path, best_distance = None, np.inf
+        for record in self._records():
+            if record['arch'] != arch:
+                continue
+            distance = float(np.linalg.norm(np.asarray(record['descriptor']) - np.asarray(descriptor)))
+            if distance < best_distance and distance <= max_distance:
+                best_path, best_distance = record['model_path'], distance
+        return best_path, best_distance
+
+    def add(self, model_path, descriptor, arch, **meta):
+        '''Copies a saved state_dict into the library and evicts the oldest entries beyond max_entries'''
+        entry_id = '%d_%s' % (int(time.time()), uuid.uuid4().hex[:8])
+        tmp_model = os.path.join(self.root, '.%s.pth.tmp' % entry_id)
+        shutil.copyfile(model_path, tmp_model)
+        os.replace(tmp_model, os.path.join(self.root, entry_id + '.pth'))
+
+        record = {'id': entry_id, 'descriptor': [float(v) for v in descriptor], 'arch': arch,
+                  'time': time.time()}
+        record.update(meta)
+        tmp_record = os.path.join(self.root, '.%s.json.tmp' % entry_id)
+        with open(tmp_record, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_record, os.path.join(self.root, entry_id + '.json'))
+
+        self.evict()
+        return entry_id
+
+    def evict(self):
+        records = sorted(self._records(), key=lambda record: record['time'])
+        for record in records[:max(0, len(records) - self.max_entries)]:
+            for path in (os.path.join(self.root, record['id'] + '.json'), record['model_path']):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
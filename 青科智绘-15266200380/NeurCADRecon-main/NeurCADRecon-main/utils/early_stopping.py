@@ -0,0 +1,46 @@
+class EarlyStopping:
+    '''
+    Convergence-based early stopping for the SDF fitting loop.
+    Every tracked metric is smoothed with an exponential moving average; a metric improves when its average drops
+    below (1 - min_rel_improvement) times its best value so far. Training stops once none of the metrics has
+    improved for `patience` iterations, and never before `warmup` iterations.
+    The default metrics are the total loss and the unweighted manifold term 'sdf_term' (mean |f(x)| on the input
+    points), a free proxy of how well the zero level set already fits the surface.
+    '''
+
+    def __init__(self, patience=1000, min_rel_improvement=0.01, warmup=1000, smoothing=0.1,
+                 metrics=('loss', 'sdf_term')):
+        self.patience = patience
+        self.min_rel_improvement = min_rel_improvement
+        self.warmup = warmup
+        self.smoothing = smoothing
+        self.metrics = tuple(metrics)
+        self.averages = {}
+        self.best = {}
+        self.last_improvement = 0
+        self.stopped = False
+        self.stop_iteration = None
+
+    def update(self, iteration, values):
+        '''
+        :param iteration: 1-based iteration count
+        :param values: dict of python floats, must contain every tracked metric
+        :return: True if training should stop
+        '''
+        if self.stopped:
+            return True
+        improved = False
+        for name in self.metrics:
+            value = values[name]
+            average = self.averages.get(name, value)
+            average = (1 - self.smoothing) * average + self.smoothing * value
+            self.averages[name] = average
+            if name not in self.best or average < self.best[name] * (1 - self.min_rel_improvement):
+                self.best[name] = average
+                improved = True
+        if improved:
+            self.last_improvement = iteration
+        elif iteration >= self.warmup and iteration - self.last_improvement >= self.patience:
+            self.stopped = True
+            self.stop_iteration = iteration
+        return self.stopped
@@ -0,0 +1,51 @@
+import json
+import time
+
+
+class ProgressWriter:
+    '''Writes training progress as JSON lines to a side file, at most once every `interval` seconds.
+    Each record carries the iteration, the loss terms, the throughput (it/s) and the ETA, so consumers do not
+    have to parse the training log. With path=None every call is a no-op.
+    '''
+
+    def __init__(self, path, total_iterations, interval=1.0):
+        self.total_iterations = total_iterations
+        self.interval = interval
+        self.file = open(path, 'a') if path else None
+        self.start_time = time.time()
+        self.last_time = self.start_time
+        self.last_iteration = 0
+
+    def due(self, iteration):
+        # only pay for .item() synchronisation of the loss tensors when a record will actually be written
+        if self.file is None:
+            return False
+        return iteration >= self.total_iterations or time.time() - self.last_time >= self.interval
+
+    def write(self, epoch, iteration, losses=None, **extra):
+        if self.file is None:
+            return
+        now = time.time()
+        window = now - self.last_time
+        it_per_s = (iteration - self.last_iteration) / window if window > 0 else 0.0
+        eta = (self.total_iterations - iteration) / it_per_s if it_per_s > 0 else None
+        record = {'type': 'progress', 'epoch': epoch, 'iteration': iteration,
+                  'total_iterations': self.total_iterations,
+                  'percentage': 100. * iteration / max(self.total_iterations, 1),
+                  'it_per_s': it_per_s, 'eta_s': eta, 'elapsed_s': now - self.start_time,
+                  'losses': losses or {}}
+        record.update(extra)
+        self.emit(record)
+        self.last_time = now
+        self.last_iteration = iteration
+
+    def emit(self, record):
+        if self.file is None:
+            return
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
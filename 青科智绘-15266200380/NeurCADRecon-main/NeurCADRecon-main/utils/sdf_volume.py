@@ -0,0 +1,229 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+# surface extraction back-ends for a dense SDF volume
+BACKENDS = ('mcubes', 'skimage', 'flexicubes')
+
+
+def grid_axes(resolution=100, bbox=1.2 * np.array([[-1, 1], [-1, 1], [-1, 1]]), eps=0.1):
+    '''
+    Coordinates of a uniform grid along x, y and z: the shortest side of bbox (padded by eps) gets resolution samples,
+    the other axes use the same spacing.
+    reimplemented from SAL : https://github.com/matanatz/SAL/blob/master/code/utils/plots.py
+    '''
+    shortest_axis = np.argmin(bbox[:, 1] - bbox[:, 0])
+    axes = [None, None, None]
+    axes[shortest_axis] = np.linspace(bbox[shortest_axis, 0] - eps, bbox[shortest_axis, 1] + eps, resolution)
+    length = np.max(axes[shortest_axis]) - np.min(axes[shortest_axis])
+    step = length / (resolution - 1)
+    for i in range(3):
+        if i != shortest_axis:
+            axes[i] = np.arange(bbox[i, 0] - eps, bbox[i, 1] + step + eps, step)
+    return axes, length, shortest_axis
+
+
+def open_volume(shape, path=None):
+    '''float32 volume to stream into: in memory, or an .npy memmap at path that keeps the volume on disk'''
+    if path is None:
+        return np.empty(shape, dtype=np.float32)
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=tuple(shape))
+
+
+def _slabs(axes, batch_size, device=None, dtype=None):
+    # yields (first x index, points) per slab of x-planes of about batch_size points, at least one plane
+    x, y, z = (torch.as_tensor(a if dtype is None else a.astype(dtype), dtype=torch.float32, device=device)
+               for a in axes)
+    yz = torch.stack(torch.meshgrid(y, z, indexing='ij'), dim=-1).reshape(-1, 2)
+    planes = max(1, batch_size // yz.shape[0])
+    for start in tqdm(range(0, x.shape[0], planes)):
+        xs = x[start:start + planes]
+        yield start, torch.cat((xs.repeat_interleave(yz.shape[0])[:, None], yz.repeat(xs.shape[0], 1)), dim=1)
+
+
+def _write_slab(out, start, values):
+    values = values.detach()
+    if isinstance(out, torch.Tensor):
+        out[start:start + values.shape[0]] = values.to(out.device)
+    else:
+        out[start:start + values.shape[0]] = values.cpu().numpy()
+
+
+def stream_volume(sdf_fn, axes, out=None, batch_size=65536, device=None, dtype=None):
+    '''
+    Evaluates sdf_fn on the grid axes[0] x axes[1] x axes[2] and writes the values into out, indexed [x, y, z].
+    The coordinates are generated per slab of x-planes (about batch_size points, at least one plane), so neither the
+    grid points nor the values are ever concatenated; every slab is copied into out once.
+    :param sdf_fn: callable mapping points (n, 3) to SDF values (n,)
+    :param out: float32 np.ndarray / np.memmap or torch tensor of shape (nx, ny, nz); allocated in memory when None
+    :param dtype: numpy dtype the coordinates are rounded to before evaluation, like get_3d_grid's float16 grid
+    '''
+    shape = tuple(len(a) for a in axes)
+    if out is None:
+        out = open_volume(shape)
+    for start, points in _slabs(axes, batch_size, device, dtype):
+        values = torch.cat([sdf_fn(chunk).reshape(-1).float() for chunk in torch.split(points, batch_size)])
+        _write_slab(out, start, values.reshape((-1,) + shape[1:]))
+    return out
+
+
+def stream_field(fn, axes, values=None, grads=None, batch_size=65536, device=None, dtype=None):
+    '''
+    stream_volume for a field and its gradient w.r.t. the points, as the UDF extraction needs them. Each chunk is
+    differentiated once with create_graph=False, so no graph outlives its chunk and no second-order state is kept.
+    :param values: float32 volume (nx, ny, nz), allocated in memory when None
+    :param grads: float32 volume (nx, ny, nz, 3), allocated in memory when None
+    '''
+    shape = tuple(len(a) for a in axes)
+    if values is None:
+        values = open_volume(shape)
+    if grads is None:
+        grads = open_volume(shape + (3,))
+    for start, points in _slabs(axes, batch_size, device, dtype):
+        slab_values, slab_grads = [], []
+        for chunk in torch.split(points, batch_size):
+            with torch.enable_grad():
+                chunk = chunk.detach().requires_grad_()
+                pred = fn(chunk).reshape(-1)
+                grad = torch.autograd.grad(pred.sum(), chunk)[0]
+            slab_values.append(pred.detach().float())
+            slab_grads.append(grad.float())
+        _write_slab(values, start, torch.cat(slab_values).reshape((-1,) + shape[1:]))
+        _write_slab(grads, start, torch.cat(slab_grads).reshape((-1,) + shape[1:] + (3,)))
+    return values, grads
+
+
+def _to_numpy(volume):
+    if isinstance(volume, torch.Tensor):
+        return volume.detach().cpu().numpy()
+    return np.asarray(volume)
+
+
+def _mcubes(volume, level, device):
+    import mcubes
+    return mcubes.marching_cubes(_to_numpy(volume), level)
+
+
+def _skimage(volume, level, device):
+    from skimage import measure
+    volume = _to_numpy(volume)
+    if not volume.min() <= level <= volume.max():
+        # skimage refuses a level outside the data range instead of returning an empty surface
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+    verts, faces, _, _ = measure.marching_cubes(volume, level=level, method='lewiner')
+    return verts, faces
+
+
+def _flexicubes(volume, level, device):
+    from kaolin.non_commercial.flexicubes import FlexiCubes
+    fc = FlexiCubes(device=device)
+    res = tuple(s - 1 for s in volume.shape)
+    verts, cubes = fc.construct_voxel_grid(res)
+    # construct_voxel_grid returns the lattice of the unit cube centred at 0: map its vertices to volume indices
+    idx = torch.round((verts + 0.5) * torch.tensor(res, dtype=verts.dtype, device=verts.device)).long()
+    sdf = torch.as_tensor(volume, device=idx.device)[idx[:, 0], idx[:, 1], idx[:, 2]] - level
+    mesh_v, mesh_f, _ = fc(idx.float(), sdf, cubes, res)
+    return mesh_v.detach().cpu().numpy().astype(np.float64), mesh_f.detach().cpu().numpy()
+
+
+def extract_surface(volume, backend='mcubes', level=0.0, device=None):
+    '''
+    Level set of a volume indexed [x, y, z] with a pluggable back-end: mcubes (PyMCubes) | skimage (lewiner marching
+    cubes) | flexicubes (kaolin FlexiCubes on the full voxel grid).
+    :return: vertices in index coordinates (multiply by the cell size and add the grid origin), faces
+    '''
+    if backend == 'mcubes':
+        return _mcubes(volume, level, device)
+    elif backend == 'skimage':
+        return _skimage(volume, level, device)
+    elif backend == 'flexicubes':
+        return _flexicubes(volume, level, device)
+    raise ValueError('unknown surface extraction backend: {}'.format(backend))
+
+
+def _boundary_keys(verts, plane):
+    # vertices on a slab boundary lie on edges of that grid plane: their x is exactly the plane index and both slabs
+    # interpolate them from the same two values, so their (y, z) identify them across slabs
+    on_plane = np.nonzero(verts[:, 0] == plane)[0]
+    keys = np.round(verts[on_plane, 1:] * 1e5).astype(np.int64)
+    return on_plane, [tuple(k) for k in keys]
+
+
+def _write_ply(path, vertex_file, n_vertices, face_file, n_faces):
+    header = ('ply\nformat binary_little_endian 1.0\nelement vertex {}\nproperty float x\nproperty float y\n'
+              'property float z\nelement face {}\nproperty list uchar int vertex_indices\nend_header\n').format(
+        n_vertices, n_faces)
+    with open(path, 'wb') as f:
+        f.write(header.encode('ascii'))
+        for part in (vertex_file, face_file):
+            with open(part, 'rb') as src:
+                shutil.copyfileobj(src, f, 1 << 24)
+
+
+def stream_mesh(sdf_fn, axes, path, transform=None, slab_planes=32, batch_size=65536, backend='mcubes', level=0.0,
+                device=None, dtype=None):
+    '''
+    Out-of-core marching cubes: the grid is evaluated and polygonised in slabs of slab_planes x-planes, consecutive
+    slabs sharing one plane of values. Vertices on a shared plane are produced by both slabs and are stitched to one
+    index, the others are appended to disk as soon as their slab is done. Only one slab of values and the boundary
+    vertices of the previous slab are held in memory, O(grid_res^2) instead of the whole volume.
+    :param path: binary PLY the mesh is written to
+    :param transform: callable mapping vertices (n, 3) in index coordinates to output coordinates
+    :return: number of vertices and faces written
+    '''
+    if backend not in ('mcubes', 'skimage'):
+        raise ValueError('slab-wise extraction supports the mcubes and skimage backends, not {}'.format(backend))
+    nx, ny, nz = (len(a) for a in axes)
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+    vertex_file, face_file = os.path.join(work_dir, 'vertices.bin'), os.path.join(work_dir, 'faces.bin')
+    n_vertices = n_faces = 0
+    boundary = {}
+    slab = np.empty((slab_planes + 1, ny, nz), dtype=np.float32)
+    evaluated = 0
+    try:
+        with open(vertex_file, 'wb') as vf, open(face_file, 'wb') as ff:
+            for start in range(0, nx - 1, slab_planes):
+                end = min(start + slab_planes, nx - 1)
+                if start == 0:
+                    stream_volume(sdf_fn, [axes[0][:end + 1], axes[1], axes[2]], out=slab[:end + 1],
+                                  batch_size=batch_size, device=device, dtype=dtype)
+                else:
+                    # the last plane of the previous slab is the first plane of this one
+                    slab[0] = slab[evaluated - 1]
+                    stream_volume(sdf_fn, [axes[0][start + 1:end + 1], axes[1], axes[2]],
+                                  out=slab[1:end - start + 1], batch_size=batch_size, device=device, dtype=dtype)
+                evaluated = end - start + 1
+                verts, faces = extract_surface(slab[:evaluated], backend, level)
+                if len(verts) == 0:
+                    boundary = {}
+                    continue
+                verts = np.asarray(verts, dtype=np.float64)
+
+                local_to_global = np.full(len(verts), -1, dtype=np.int64)
+                if start > 0:
+                    on_plane, keys = _boundary_keys(verts, 0)
+                    for i, key in zip(on_plane, keys):
+                        local_to_global[i] = boundary.get(key, -1)
+                new = np.nonzero(local_to_global < 0)[0]
+                local_to_global[new] = n_vertices + np.arange(len(new))
+                n_vertices += len(new)
+
+                on_plane, keys = _boundary_keys(verts, evaluated - 1)
+                boundary = dict(zip(keys, local_to_global[on_plane]))
+
+                verts[:, 0] += start
+                new_verts = verts[new] if transform is None else transform(verts[new])
+                vf.write(np.ascontiguousarray(new_verts, dtype='<f4').tobytes())
+                face_rows = np.empty(len(faces), dtype=[('n', 'u1'), ('v', '<i4', (3,))])
+                face_rows['n'] = 3
+                face_rows['v'] = local_to_global[np.asarray(faces)]
+                ff.write(face_rows.tobytes())
+                n_faces += len(faces)
+        _write_ply(path, vertex_file, n_vertices, face_file, n_faces)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return n_vertices, n_faces
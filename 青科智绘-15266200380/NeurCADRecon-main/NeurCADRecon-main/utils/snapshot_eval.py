@@ -0,0 +1,179 @@
+import os
+import copy
+import threading
+
+import numpy as np
+import torch
+import trimesh
+
+import utils.utils as utils
+
+
+class SnapshotEvaluator:
+    '''
+    Extracts and evaluates meshes from snapshots of the decoder while training continues.
+    submit() copies the decoder on the training thread, which is only a device memcpy: a SIREN decoder is exported to
+    its fused inference module (Decoder.export_inference), any other decoder is deep-copied. A background thread
+    then extracts the mesh from the copy (flexicubes2mesh, or narrow_band2mesh with extractor='narrow_band') and runs
+    the GT evaluation, on its own CUDA stream when available, and keeps the best-mesh selection
+    (min_cd / result_mesh_path) exactly like the inline evaluation did.
+    At most one snapshot waits behind the one being evaluated; a newer snapshot replaces a waiting one, so a slow
+    evaluation never makes snapshots pile up. Final snapshots are never dropped.
+    With asynchronous=False the evaluation runs inline in submit(), which is the original behaviour.
+    '''
+
+    def __init__(self, output_dir, shapename, grid_res, cp, scale, gt_path=None, output_any=True, device=None,
+                 log_file=None, asynchronous=True, inference_dtype=None, extractor='flexicubes', coarse_res=32):
+        self.output_dir = output_dir
+        self.shapename = shapename
+        self.grid_res = grid_res
+        self.cp = cp
+        self.scale = scale
+        self.gt_path = gt_path
+        self.output_any = output_any
+        self.device = device
+        self.log_file = log_file
+        self.asynchronous = asynchronous
+        self.inference_dtype = inference_dtype
+        self.extractor = extractor
+        self.coarse_res = coarse_res
+        self.min_cd = np.inf
+        self.result_mesh_path = None
+        self.error = None
+        self._gt = None
+
+        self._condition = threading.Condition()
+        self._pending = None
+        self._busy = False
+        self._closed = False
+        self._stream = None
+        self._thread = None
+        if asynchronous:
+            if device is not None and str(device).startswith('cuda'):
+                self._stream = torch.cuda.Stream(device=device)
+            self._thread = threading.Thread(target=self._run, name='snapshot-evaluator')
+            self._thread.daemon = True
+            self._thread.start()
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+    def submit(self, decoder, batch_idx, final=False):
+        '''Snapshots the decoder weights and schedules mesh extraction + evaluation of the snapshot'''
+        if not self.asynchronous:
+            self._evaluate(decoder, batch_idx)
+            return
+        if self.failed or not self._thread.is_alive():
+            # nothing would ever evaluate the snapshot
+            return
+        if hasattr(decoder, 'export_inference'):
+            # the fused inference copy is the snapshot: its folded weights do not alias the training parameters
+            snapshot = decoder.export_inference(dtype=self.inference_dtype)
+        else:
+            snapshot = copy.deepcopy(decoder)
+            for param in snapshot.parameters():
+                param.requires_grad_(False)
+        ready = None
+        if self._stream is not None:
+            # the evaluation stream must not read the copy before the training stream has written it
+            ready = torch.cuda.Event()
+            ready.record()
+        with self._condition:
+            if self._pending is not None and self._pending[3] and not final:
+                return
+            if self._pending is not None:
+                print('Dropping stale snapshot of iteration {}'.format(self._pending[1]))
+            self._pending = (snapshot, batch_idx, ready, final)
+            self._condition.notify_all()
+
+    def close(self):
+        '''Waits for the outstanding snapshots; afterwards min_cd and result_mesh_path are final'''
+        if not self.asynchronous:
+            return
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            # a dead evaluator thread never notifies, so poll its liveness instead of waiting forever
+            while (self._busy or self._pending is not None) and self._thread.is_alive():
+                self._condition.wait(timeout=1.0)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                snapshot, batch_idx, ready, _ = self._pending
+                self._pending = None
+                self._busy = True
+            try:
+                if self._stream is not None:
+                    self._stream.wait_event(ready)
+                    with torch.cuda.stream(self._stream):
+                        self._evaluate(snapshot, batch_idx)
+                    self._stream.synchronize()
+                else:
+                    self._evaluate(snapshot, batch_idx)
+            except Exception as e:
+                # _evaluate handles its own errors; this is the stream handling around it. Record it so training
+                # stops submitting, the following snapshots are skipped by _evaluate
+                print(e)
+                print('Snapshot evaluation failed\n')
+                if self.error is None:
+                    self.error = e
+            finally:
+                del snapshot
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+
+    def _load_gt(self):
+        # the GT mesh does not change during training, load it once instead of at every evaluation
+        if self._gt is None:
+            print('gt_path:', self.gt_path)
+            gt = trimesh.load(self.gt_path, process=False)
+            if isinstance(gt, trimesh.Scene):
+                gt = trimesh.load(self.gt_path, process=False, force='mesh')
+            self._gt = gt
+        return self._gt
+
+    def _evaluate(self, decoder, batch_idx):
+        if self.failed:
+            return
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            if self.extractor == 'narrow_band':
+                mesh = utils.narrow_band2mesh(decoder, None, self.grid_res, translate=-self.cp, scale=1 / self.scale,
+                                              get_mesh=True, device=self.device, coarse_res=self.coarse_res,
+                                              inference_dtype=self.inference_dtype)
+            else:
+                mesh = utils.flexicubes2mesh(decoder, None, self.grid_res, translate=-self.cp, scale=1 / self.scale,
+                                             get_mesh=True, device=self.device, inference_dtype=self.inference_dtype)
+
+            if self.gt_path is not None:
+                pred_mesh = mesh.copy()
+                nc_ind, cd_l1, cd_l2, f1_mu, euler_num = utils.eval_reconstruct_gt(pred_mesh, self._load_gt())
+                message = 'iter: {}, cd_l1: {:.7f}, cd_l2: {:.7f}, f1_mu: {:.7f}, euler_num: {:.7f}'.format(
+                    batch_idx, cd_l1, cd_l2, f1_mu, euler_num)
+                if self.log_file is not None:
+                    utils.log_string(message, self.log_file)
+                else:
+                    print(message)
+                if cd_l1 < self.min_cd:
+                    self.min_cd = cd_l1
+                    best_path = os.path.join(self.output_dir, self.shapename + '.ply')
+                    mesh.export(best_path)
+                    self.result_mesh_path = best_path
+
+            if self.output_any:
+                output_ply_filepath = os.path.join(self.output_dir, self.shapename + '.ply')
+                print('Saving to ', output_ply_filepath)
+                mesh.export(output_ply_filepath)
+                self.result_mesh_path = output_ply_filepath
+        except Exception as e:
+            print(e)
+            print('Could not generate mesh\n')
+            self.error = e
@@ -0,0 +1,85 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+def level_resolutions(grid_res, coarse_res=32):
+    '''
+    Resolutions (cells per axis) of the coarse-to-fine levels, every level doubling the previous one. The coarsest
+    level is close to coarse_res and chosen so that the finest one is the first multiple at or above grid_res.
+    '''
+    n_levels = max(0, int(math.floor(math.log2(max(grid_res / coarse_res, 1)))))
+    base = int(math.ceil(grid_res / (1 << n_levels)))
+    return [base << level for level in range(n_levels + 1)]
+
+
+def _active_cells(volume, threshold):
+    # a cell can only contain the zero level set if the SDF changes sign over its corners or the smallest |SDF| of a
+    # corner is within the cell diagonal (the decoder is trained to be a distance, so it changes by at most that much)
+    v = volume[None, None]
+    vmax = F.max_pool3d(v, 2, stride=1)[0, 0]
+    vmin = -F.max_pool3d(-v, 2, stride=1)[0, 0]
+    closest = torch.minimum(vmax.abs(), vmin.abs())
+    return ((vmin < 0) & (vmax > 0)) | (closest < threshold)
+
+
+def _cell_to_vertex_mask(cells):
+    '''Vertices of the next level (2c+1 per axis) that are corners of the children of the active cells (c per axis)'''
+    mask = cells
+    for dim in range(3):
+        shape = list(mask.shape)
+        shape[dim] = 2 * shape[dim] + 1
+        out = torch.zeros(shape, dtype=torch.bool, device=cells.device)
+        lead = (slice(None),) * dim
+        # along this axis, cell i spans the vertices 2i, 2i+1 and 2i+2 of the next level
+        out[lead + (slice(1, None, 2),)] = mask
+        out[lead + (slice(0, -1, 2),)] |= mask
+        out[lead + (slice(2, None, 2),)] |= mask
+        mask = out
+    return mask
+
+
+def narrow_band_volume(sdf_fn, grid_res, origin, extent, coarse_res=32, band=1.0, batch_size=65536, device=None):
+    '''
+    SDF volume of (res + 1)^3 vertices over the cube [origin, origin + extent]^3, evaluated coarse to fine.
+    The coarsest level is evaluated densely. Each following level halves the cells, but only the children of cells
+    whose |SDF| is within band * cell diagonal (or whose corners change sign) are evaluated; all other vertices take
+    the trilinear interpolation of the coarser level, which keeps their sign because such a cell has one sign at all
+    corners. The decoder cost therefore grows with the surface area instead of the volume.
+    :param sdf_fn: callable mapping points (n, 3) to SDF values (n,)
+    :return: volume (res + 1, res + 1, res + 1) float32 indexed [x, y, z], cell size, number of evaluated points
+    '''
+    resolutions = level_resolutions(grid_res, coarse_res)
+    origin = torch.as_tensor(origin, dtype=torch.float32, device=device).reshape(3)
+    n_evaluated = 0
+
+    def evaluate(idx, res):
+        points = origin + idx.float() * (float(extent) / res)
+        values = torch.empty(points.shape[0], dtype=torch.float32, device=device)
+        for start in range(0, points.shape[0], batch_size):
+            values[start:start + batch_size] = sdf_fn(points[start:start + batch_size]).reshape(-1)
+        return values
+
+    res = resolutions[0]
+    axis = torch.arange(res + 1, device=device)
+    idx = torch.stack(torch.meshgrid(axis, axis, axis, indexing='ij'), dim=-1).reshape(-1, 3)
+    volume = evaluate(idx, res).reshape(res + 1, res + 1, res + 1)
+    n_evaluated += idx.shape[0]
+    del idx
+
+    for res in resolutions[1:]:
+        coarse_cell = float(extent) / (res // 2)
+        cells = _active_cells(volume, band * math.sqrt(3) * coarse_cell)
+        volume = F.interpolate(volume[None, None], size=(res + 1,) * 3, mode='trilinear',
+                               align_corners=True)[0, 0]
+        mask = _cell_to_vertex_mask(cells)
+        del cells
+        # vertices with even indices on all axes are the coarse corners of active cells, which are already exact
+        mask[::2, ::2, ::2] = False
+        idx = torch.nonzero(mask)
+        del mask
+        volume[idx[:, 0], idx[:, 1], idx[:, 2]] = evaluate(idx, res)
+        n_evaluated += idx.shape[0]
+        del idx
+    return volume, float(extent) / resolutions[-1], n_evaluated
@@ -0,0 +1,50 @@
+import torch
+
+
+class SumTree:
+    '''
+    Segment tree of non-negative priorities over n items, stored as one tensor on the sampling device.
+    Leaves live at [size, 2 * size) with size the next power of two, every inner node holds the sum of its children.
+    Both operations are vectorised over a batch of items and cost O(log n) tensor ops:
+    update() rewrites a batch of leaves and recomputes their ancestors level by level, sample() descends from the root
+    for all draws at once. Unlike an alias table, nothing has to be rebuilt when a few priorities change.
+    '''
+
+    def __init__(self, priorities, device='cpu'):
+        priorities = torch.as_tensor(priorities, dtype=torch.float32, device=device).flatten()
+        self.n = priorities.shape[0]
+        self.depth = max(1, (self.n - 1).bit_length())
+        self.size = 1 << self.depth
+        self.tree = torch.zeros(2 * self.size, dtype=torch.float32, device=device)
+        self.tree[self.size:self.size + self.n] = priorities
+        for level in range(self.depth - 1, -1, -1):
+            start, end = 1 << level, 2 << level
+            self.tree[start:end] = self.tree[2 * start:2 * end:2] + self.tree[2 * start + 1:2 * end:2]
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    @property
+    def priorities(self):
+        return self.tree[self.size:self.size + self.n]
+
+    def update(self, idx, priorities):
+        '''Sets the priorities of the items idx (any shape, duplicates allowed: one of the values is kept)'''
+        nodes = idx.flatten().long() + self.size
+        self.tree[nodes] = priorities.flatten().to(self.tree.dtype).clamp_min(0)
+        for _ in range(self.depth):
+            nodes = torch.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def sample(self, shape, generator=None):
+        '''Draws item indices with probability proportional to their priority, with replacement'''
+        mass = torch.rand(shape, generator=generator, device=self.tree.device) * self.total
+        nodes = torch.ones(shape, dtype=torch.long, device=self.tree.device)
+        for _ in range(self.depth):
+            left = self.tree[2 * nodes]
+            go_right = mass >= left
+            mass = torch.where(go_right, mass - left, mass)
+            nodes = 2 * nodes + go_right.long()
+        # rounding can walk past the last item into the zero padding
+        return (nodes - self.size).clamp_max(self.n - 1)
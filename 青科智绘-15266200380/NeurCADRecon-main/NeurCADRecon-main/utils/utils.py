@@ -23,6 +23,8 @@ import torch.backends.cudnn as cudnn
 import torch.nn as nn
 
 import utils.utils_mp as utils_mp
+import utils.sparse_grid as sparse_grid
+import utils.sdf_volume as sdf_volume
 
 # from PyMCubes
 import mcubes
@@ -838,27 +840,11 @@ def get_3d_grid(resolution=100, bbox=1.2 * np.array([[-1, 1], [-1, 1], [-1, 1]])
     # generate points on a uniform grid within  a given range
     # reimplemented from SAL : https://github.com/matanatz/SAL/blob/master/code/utils/plots.py
     # and IGR : https://github.com/amosgropp/IGR/blob/master/code/utils/plots.py
+    # mesh extraction streams the grid slab by slab instead (sdf_volume.stream_volume)
 
-    shortest_axis = np.argmin(bbox[:, 1] - bbox[:, 0])
-    if (shortest_axis == 0):
-        x = np.linspace(bbox[0, 0] - eps, bbox[0, 1] + eps, resolution)
-        length = np.max(x) - np.min(x)
-        y = np.arange(bbox[1, 0] - eps, bbox[1, 1] + length / (x.shape[0] - 1) + eps, length / (x.shape[0] - 1))
-        z = np.arange(bbox[2, 0] - eps, bbox[2, 1] + length / (x.shape[0] - 1) + eps, length / (x.shape[0] - 1))
-    elif (shortest_axis == 1):
-        y = np.linspace(bbox[1, 0] - eps, bbox[1, 1] + eps, resolution)
-        length = np.max(y) - np.min(y)
-        x = np.arange(bbox[0, 0] - eps, bbox[0, 1] + length / (y.shape[0] - 1) + eps, length / (y.shape[0] - 1))
-        z = np.arange(bbox[2, 0] - eps, bbox[2, 1] + length / (y.shape[0] - 1) + eps, length / (y.shape[0] - 1))
-    elif (shortest_axis == 2):
-        z = np.linspace(bbox[2, 0] - eps, bbox[2, 1] + eps, resolution)
-        length = np.max(z) - np.min(z)
-        x = np.arange(bbox[0, 0] - eps, bbox[0, 1] + length / (z.shape[0] - 1) + eps, length / (z.shape[0] - 1))
-        y = np.arange(bbox[1, 0] - eps, bbox[1, 1] + length / (z.shape[0] - 1) + eps, length / (z.shape[0] - 1))
+    (x, y, z), length, shortest_axis = sdf_volume.grid_axes(resolution, bbox, eps)
 
     xx, yy, zz = np.meshgrid(x.astype(dtype), y.astype(dtype), z.astype(dtype))  #
-    # grid_points = get_cuda_ifavailable(torch.tensor(np.vstack([xx.ravel(), yy.ravel(), zz.ravel()]).T, dtype=torch.float16),
-    #                                          device=device)
     grid_points = torch.tensor(np.vstack([xx.ravel(), yy.ravel(), zz.ravel()]).T, dtype=torch.float32)
     return {"grid_points": grid_points,
             "shortest_axis_length": length,
@@ -964,177 +950,193 @@ def load_reconstruction_data(file_path, n_points=30000, sample_type='vertices'):
     # points = points / scale
     return np.array(points).astype('float32')
 
+def available_memory(device=None):
+    '''Bytes that can still be allocated on the device: free CUDA memory, or the available RAM for the CPU'''
+    device = torch.device(device) if device is not None else torch.device('cpu')
+    if device.type == 'cuda':
+        return torch.cuda.mem_get_info(device)[0]
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 1 << 30
+
+
+def auto_batch_size(decoder, n_points, device=None, memory_fraction=0.25, min_batch=4096, max_batch=1 << 22,
+                    cpu_batch=1 << 14):
+    '''
+    Points per forward pass when evaluating a decoder on n_points without gradients: as many as fit into
+    memory_fraction of the free memory. Per point, the input, the linear output and the activation of the widest layer
+    are alive at the same time. The fraction leaves room for the training step, which keeps running while snapshots
+    are extracted.
+    On the CPU there is no launch overhead to amortise and batches that stay in cache are faster, so the size is
+    capped at cpu_batch.
+    '''
+    if device is None or torch.device(device).type == 'cpu':
+        max_batch = min(max_batch, cpu_batch)
+    tensors = [t for t in list(decoder.parameters()) + list(decoder.buffers()) if t.dim() == 2]
+    if len(tensors) == 0:
+        return max(min_batch, min(n_points, max_batch))
+    width = max(max(t.shape) for t in tensors)
+    bytes_per_point = 3 * width * tensors[0].element_size() + 32
+    batch = int(available_memory(device) * memory_fraction) // bytes_per_point
+    return max(min_batch, min(batch, n_points, max_batch))
+
+
+def decoder_sdf_fn(decoder, mods=None, feat=None, hash_tree=None, inference_dtype=None):
+    '''
+    Callable mapping points (n, 3) to decoder values (n,) for the plain, feature-grid and hash-tree decoders, as the
+    mesh extractors evaluate them. A SIREN decoder is replaced by its fused inference module (export_inference).
+    '''
+    decoder.eval()
+    if mods is None and feat is None and hash_tree is None and hasattr(decoder, 'export_inference'):
+        # fused no-grad SIREN forward: omega_0 folded into the weights, addmm + in-place sine per layer
+        decoder = decoder.export_inference(dtype=inference_dtype)
+
+    def sdf_fn(points):
+        points = points[None]
+        if feat is not None:
+            query_feat = decoder.encoder.query_feature(feat, points)
+            return decoder.decoder(points, query_feat).reshape(-1)
+        elif hash_tree is not None:
+            query_feat = decoder.encoder.query_feature(hash_tree, feat, points)
+            return decoder.decoder(points, query_feat).reshape(-1)
+        return decoder(points, mods).reshape(-1)
+
+    sdf_fn.decoder = decoder
+    return sdf_fn
+
+
 def flexicubes2mesh(decoder, mods, grid_res, translate=[0., 0., 0.], scale=1.0, get_mesh=True, device=None,
-                        feat=None, hash_tree=None, batch_size = 1000):
+                        feat=None, hash_tree=None, batch_size=None, inference_dtype=None):
     print('in flexicubes2mesh')
-    
+
     padding = 0.1  # 自行调整
     print(grid_res, translate, scale, padding, batch_size)
-    decoder.eval()
-    from kaolin.non_commercial.flexicubes import FlexiCubes
-    fc = FlexiCubes(device=device)
-
-    # Step 1: Construct grid coordinates
-    voxelgrid_vertices, cube_idx = fc.construct_voxel_grid(grid_res)  # (N, 3)
-    voxelgrid_vertices = voxelgrid_vertices * scale * 1.1 + torch.tensor(translate, device=device)
-
-    # Step 2: Evaluate SDF values at grid vertices
-    sdf_values_list = []
+    sdf_fn = decoder_sdf_fn(decoder, mods, feat, hash_tree, inference_dtype)
+    if batch_size is None:
+        batch_size = auto_batch_size(sdf_fn.decoder, (grid_res + 1) ** 3, device=device)
+
+    # the FlexiCubes voxel grid spans scale * 1.1 around translate; the values stay on the device for FlexiCubes
+    extent = 1.1 * float(scale)
+    origin = np.asarray(translate, dtype=np.float64) - extent / 2
+    axes = [o + np.linspace(0, extent, grid_res + 1) for o in origin]
+    volume = torch.empty((grid_res + 1,) * 3, dtype=torch.float32, device=device)
     with torch.no_grad():
-        for start in tqdm(range(0, voxelgrid_vertices.shape[0], batch_size), desc="Evaluating SDF"):
-            end = min(start + batch_size, voxelgrid_vertices.shape[0])
-            batch_points = voxelgrid_vertices[start:end].to(device)
-
-            # (1, B, 3) if needed
-            if batch_points.dim() == 2:
-                batch_points = batch_points.unsqueeze(0)
-
-            if feat is not None:
-                query_feat = decoder.encoder.query_feature(feat, batch_points)
-                sdf_pred = decoder.decoder(batch_points, query_feat)
-            elif hash_tree is not None:
-                query_feat = decoder.encoder.query_feature(hash_tree, feat, batch_points)
-                sdf_pred = decoder.decoder(batch_points, query_feat)
-            else:
-                sdf_pred = decoder(batch_points, mods)
+        sdf_volume.stream_volume(sdf_fn, axes, out=volume, batch_size=batch_size, device=device)
+    verts, faces = sdf_volume.extract_surface(volume, 'flexicubes', device=device)
 
-            sdf_values_list.append(sdf_pred.squeeze(0).squeeze(-1).cpu())
+    mesh = None
+    if get_mesh:
+        mesh = trimesh.Trimesh(vertices=verts * (extent / grid_res) + origin, faces=faces, validate=True)
 
-    sdf_values = torch.cat(sdf_values_list, dim=0)  # shape: (N,)
+    return mesh
 
-    # Step 3: Run FlexiCubes
-    mesh_v, mesh_f, _ = fc(voxelgrid_vertices, sdf_values.to(device), cube_idx, grid_res)
 
-    # Step 4: Post-process into trimesh
+def narrow_band2mesh(decoder, mods, grid_res, translate=[0., 0., 0.], scale=1.0, get_mesh=True, device=None,
+                     coarse_res=32, band=1.0, batch_size=None, inference_dtype=None):
+    '''
+    Marching cubes mesh at grid_res from a coarse-to-fine narrow-band evaluation (sparse_grid.narrow_band_volume):
+    only the vertices of cells close to the zero level set are evaluated at the finer levels, so a 512^3 mesh costs
+    about as many decoder calls as a dense 128^3 grid. Same grid box and output frame as flexicubes2mesh.
+    '''
+    print('in narrow_band2mesh')
+    print(grid_res, translate, scale, coarse_res)
+    sdf_fn = decoder_sdf_fn(decoder, mods, inference_dtype=inference_dtype)
+    if batch_size is None:
+        batch_size = auto_batch_size(sdf_fn.decoder, (grid_res + 1) ** 3, device=device)
+
+    extent = 1.1 * float(scale)
+    origin = np.asarray(translate, dtype=np.float32) - extent / 2
+    with torch.no_grad():
+        volume, cell_width, n_evaluated = sparse_grid.narrow_band_volume(
+            sdf_fn, grid_res, origin, extent, coarse_res=coarse_res, band=band, batch_size=batch_size, device=device)
+    print('evaluated {} of {} grid points'.format(n_evaluated, volume.numel()))
+
+    verts, faces = sdf_volume.extract_surface(volume, 'mcubes')
+    verts = verts * cell_width + origin
     mesh = None
     if get_mesh:
-        mesh = trimesh.Trimesh(vertices=mesh_v.detach().cpu().numpy(),
-                               faces=mesh_f.detach().cpu().numpy(),
-                               validate=True)
-
+        mesh = trimesh.Trimesh(verts, faces, validate=True)
     return mesh
 
 
-def implicit2mesh(decoder, mods, grid_res, translate=[0., 0., 0.], scale=1, get_mesh=True, device=None,
-                  bbox=np.array([[-1, 1], [-1, 1], [-1, 1]]), feat=None, hash_tree=None):
-    # compute a mesh from the implicit representation in the decoder.
-    # Uses marching cubes.
-    # reimplemented from SAL get surface trace function : https://github.com/matanatz/SAL/blob/master/code/utils/plots.py
+def sdf_volume2mesh(decoder, mods, grid_res, translate=[0., 0., 0.], scale=1, get_mesh=True, device=None,
+                    bbox=np.array([[-1, 1], [-1, 1], [-1, 1]]), feat=None, hash_tree=None, backend='mcubes',
+                    volume_path=None, batch_size=None):
+    '''
+    Mesh of the zero level set on the get_3d_grid grid over bbox. The grid is streamed slab by slab into one float32
+    volume (an .npy memmap at volume_path keeps it on disk), which the surface extraction back-end reads in place.
+    backend: mcubes | skimage | flexicubes (see sdf_volume.extract_surface)
+    '''
     print('in implicit2mesh')
     print(grid_res, translate, scale, bbox)
-    mesh = None
-    grid_dict = get_3d_grid(resolution=grid_res, bbox=bbox, device=device)
-    print('Finished getting grid_dict')
-    cell_width = grid_dict['xyz'][0][2] - grid_dict['xyz'][0][1]
-    pnts = grid_dict["grid_points"]
-
-    z = []
-    for point in tqdm(torch.split(pnts, 10000, dim=0)):
-        # point: (100000, 3)
-        point = get_cuda_ifavailable(point, device=device)
-        if feat is not None:
-            if point.dim() == 2:
-                point = point.unsqueeze(0)
-            query_feat = decoder.encoder.query_feature(feat, point)
-            z.append(decoder.decoder(point, query_feat).detach().squeeze(0).cpu().numpy())
-        elif hash_tree is not None:
-            if point.dim() == 2:
-                point = point.unsqueeze(0)
-            # query_feat = decoder.encoder.query_feature(feat, point)
-            query_feat = decoder.encoder.query_feature(hash_tree, feat, point)
-            z.append(decoder.decoder(point, query_feat).detach().squeeze(0).cpu().numpy())
-        else:
-            z.append(decoder(point.type(torch.float32), mods).detach().squeeze(0).cpu().numpy())
-    z = np.concatenate(z, axis=0).reshape(grid_dict['xyz'][1].shape[0], grid_dict['xyz'][0].shape[0],
-                                          grid_dict['xyz'][2].shape[0]).transpose([1, 0, 2]).astype(np.float64)
-
-    print(z.min(), z.max())
+    axes, _, _ = sdf_volume.grid_axes(grid_res, bbox)
+    shape = tuple(len(a) for a in axes)
+    sdf_fn = decoder_sdf_fn(decoder, mods, feat, hash_tree)
+    if batch_size is None:
+        batch_size = auto_batch_size(sdf_fn.decoder, int(np.prod(shape)), device=device)
+    volume = sdf_volume.open_volume(shape, volume_path)
+    with torch.no_grad():
+        # coordinates rounded to float16 like get_3d_grid's grid points
+        sdf_volume.stream_volume(sdf_fn, axes, out=volume, batch_size=batch_size, device=device, dtype=np.float16)
+    print(volume.min(), volume.max())
 
-    threshs = [0.00]
-    mesh_list = list()
-    for thresh in threshs:
-        if (np.sum(z > 0.0) < np.sum(z < 0.0)):
-            thresh = -thresh
-        # verts, faces, normals, values = measure.marching_cubes(volume=z, level=thresh,
-        #                                                        spacing=(cell_width, cell_width, cell_width),
-        #                                                        method='lewiner')  # method:'lewiner' or 'lorensen'
-        verts, faces = mcubes.marching_cubes(z, 0)
+    verts, faces = sdf_volume.extract_surface(volume, backend, device=device)
+    cell_width = axes[0][1] - axes[0][0]
+    verts = verts * cell_width + np.array([axes[0][0], axes[1][0], axes[2][0]])
+    verts = verts * (1 / scale) - translate
 
-        verts = verts + np.array([grid_dict['xyz'][0][0], grid_dict['xyz'][1][0], grid_dict['xyz'][2][0]])
-        verts = verts * (1 / scale) - translate
+    mesh = None
+    if get_mesh:
+        mesh = trimesh.Trimesh(verts, faces, validate=True)
+    return mesh
 
-        if get_mesh:
-            # mesh = trimesh.Trimesh(verts, faces, vertex_normals=normals, vertex_colors=values, validate=True)
-            mesh = trimesh.Trimesh(verts, faces, validate=True)
-        mesh_list.append(mesh)
-    return mesh_list[0]
 
+def implicit2mesh_slabs(decoder, mods, grid_res, mesh_path, translate=[0., 0., 0.], scale=1, device=None,
+                        bbox=np.array([[-1, 1], [-1, 1], [-1, 1]]), feat=None, hash_tree=None, backend='mcubes',
+                        slab_planes=32, batch_size=None):
+    '''
+    implicit2mesh for grid resolutions whose volume does not fit in memory (512, 1024): the grid is evaluated and
+    polygonised slab by slab and the mesh is written to mesh_path as it grows (sdf_volume.stream_mesh), so memory
+    stays O(grid_res^2). Same grid and output frame as implicit2mesh.
+    :return: number of vertices and faces written
+    '''
+    print('in implicit2mesh_slabs')
+    print(grid_res, translate, scale, bbox, slab_planes)
+    axes, _, _ = sdf_volume.grid_axes(grid_res, bbox)
+    sdf_fn = decoder_sdf_fn(decoder, mods, feat, hash_tree)
+    if batch_size is None:
+        batch_size = auto_batch_size(sdf_fn.decoder, (slab_planes + 1) * len(axes[1]) * len(axes[2]), device=device)
+    cell_width = axes[0][1] - axes[0][0]
+    origin = np.array([axes[0][0], axes[1][0], axes[2][0]])
+
+    def transform(verts):
+        return (verts * cell_width + origin) * (1 / scale) - translate
 
+    with torch.no_grad():
+        return sdf_volume.stream_mesh(sdf_fn, axes, mesh_path, transform=transform, slab_planes=slab_planes,
+                                      batch_size=batch_size, backend=backend, device=device, dtype=np.float16)
 
 
-def implicit2mesh_skimageMC(decoder, mods, grid_res, translate=[0., 0., 0.], scale=1, get_mesh=True, device=None,
-                            bbox=np.array([[-1, 1], [-1, 1], [-1, 1]]), feat=None, hash_tree=None):
+def implicit2mesh(decoder, mods, grid_res, translate=[0., 0., 0.], scale=1, get_mesh=True, device=None,
+                  bbox=np.array([[-1, 1], [-1, 1], [-1, 1]]), feat=None, hash_tree=None, volume_path=None):
     # compute a mesh from the implicit representation in the decoder.
     # Uses marching cubes.
     # reimplemented from SAL get surface trace function : https://github.com/matanatz/SAL/blob/master/code/utils/plots.py
-    print('in implicit2mesh')
-    print(grid_res, translate, scale, bbox)
-    mesh = None
-    grid_dict = get_3d_grid(resolution=grid_res, bbox=bbox, device=device)
-    print('Finished getting grid_dict')
-    cell_width = grid_dict['xyz'][0][2] - grid_dict['xyz'][0][1]
-    pnts = grid_dict["grid_points"]
-
-    z = []
-    for point in tqdm(torch.split(pnts, 10000, dim=0)):
-        # point: (100000, 3)
-        point = get_cuda_ifavailable(point, device=device)
-        if feat is not None:
-            if point.dim() == 2:
-                point = point.unsqueeze(0)
-            query_feat = decoder.encoder.query_feature(feat, point)
-            z.append(decoder.decoder(point, query_feat).detach().squeeze(0).cpu().numpy())
-        elif hash_tree is not None:
-            if point.dim() == 2:
-                point = point.unsqueeze(0)
-            # query_feat = decoder.encoder.query_feature(feat, point)
-            query_feat = decoder.encoder.query_feature(hash_tree, feat, point)
-            z.append(decoder.decoder(point, query_feat).detach().squeeze(0).cpu().numpy())
-        else:
-            z.append(decoder(point.type(torch.float32), mods).detach().squeeze(0).cpu().numpy())
-    z = np.concatenate(z, axis=0).reshape(grid_dict['xyz'][1].shape[0], grid_dict['xyz'][0].shape[0],
-                                          grid_dict['xyz'][2].shape[0]).transpose([1, 0, 2]).astype(np.float64)
-
-    print(z.min(), z.max())
-
-    threshs = [0.00]
-    mesh_list = list()
-    for thresh in threshs:
-        if (np.sum(z > 0.0) < np.sum(z < 0.0)):
-            thresh = -thresh
-        verts, faces, normals, values = measure.marching_cubes(volume=z, level=thresh,
-                                                               spacing=(cell_width, cell_width, cell_width),
-                                                               method='lewiner')  # method:'lewiner' or 'lorensen'
-
-        # (
-        #     volume=z.reshape(grid['xyz'][1].shape[0], grid['xyz'][0].shape[0],
-        # grid['xyz'][2].shape[0]).transpose([1, 0, 2]),
-        # level = mc_value,
-        # spacing = (grid['xyz'][0][2] - grid['xyz'][0][1],
-        #            grid['xyz'][0][2] - grid['xyz'][0][1],
-        #            grid['xyz'][0][2] - grid['xyz'][0][1]))
-
-        # verts, faces = mcubes.marching_cubes(z, 0)
+    return sdf_volume2mesh(decoder, mods, grid_res, translate=translate, scale=scale, get_mesh=get_mesh,
+                           device=device, bbox=bbox, feat=feat, hash_tree=hash_tree, backend='mcubes',
+                           volume_path=volume_path)
 
-        verts = verts + np.array([grid_dict['xyz'][0][0], grid_dict['xyz'][1][0], grid_dict['xyz'][2][0]])
-        verts = verts * (1 / scale) - translate
 
-        if get_mesh:
-            # mesh = trimesh.Trimesh(verts, faces, vertex_normals=normals, vertex_colors=values, validate=True)
-            mesh = trimesh.Trimesh(verts, faces, validate=True)
-            mesh = normalize_mesh_export(mesh)
-        mesh_list.append(mesh)
-    return mesh_list[0]
+def implicit2mesh_skimageMC(decoder, mods, grid_res, translate=[0., 0., 0.], scale=1, get_mesh=True, device=None,
+                            bbox=np.array([[-1, 1], [-1, 1], [-1, 1]]), feat=None, hash_tree=None, volume_path=None):
+    # same as implicit2mesh with skimage's lewiner marching cubes, the mesh is normalized for export
+    mesh = sdf_volume2mesh(decoder, mods, grid_res, translate=translate, scale=scale, get_mesh=get_mesh,
+                           device=device, bbox=bbox, feat=feat, hash_tree=hash_tree, backend='skimage',
+                           volume_path=volume_path)
+    if mesh is not None:
+        mesh = normalize_mesh_export(mesh)
+    return mesh
 
 
 def mean_curvature(nonmnfld_hessian_term, morse_nonmnfld_grad):
@@ -1166,16 +1168,10 @@ def mean_curvature(nonmnfld_hessian_term, morse_nonmnfld_grad):
 
 
 def gaussian_curvature(nonmnfld_hessian_term, morse_nonmnfld_grad):
-    # hessian = nonmnfld_hessian_term
-    nonmnfld_hessian_term = torch.cat((nonmnfld_hessian_term, morse_nonmnfld_grad[:, :, :, None]), dim=-1)
-    zero_grad = torch.zeros(
-        (morse_nonmnfld_grad.shape[0], morse_nonmnfld_grad.shape[1], 1, 1),
-        device=morse_nonmnfld_grad.device)
-    zero_grad = torch.cat((morse_nonmnfld_grad[:, :, None, :], zero_grad), dim=-1)
-    nonmnfld_hessian_term = torch.cat((nonmnfld_hessian_term, zero_grad), dim=-2)
-
-    morse_nonmnfld = (-1. / (torch.clamp(morse_nonmnfld_grad.norm(dim=-1) ** 4, 0.01) + 1e-12)) * torch.det(
-        nonmnfld_hessian_term)
+    # -det([[H, g], [g^T, 0]]) = g^T adj(H) g, in closed form (models/curvature.py)
+    from models.curvature import adjugate_quadratic_form
+    morse_nonmnfld = adjugate_quadratic_form(nonmnfld_hessian_term, morse_nonmnfld_grad) / (
+            torch.clamp(morse_nonmnfld_grad.norm(dim=-1) ** 4, 0.01) + 1e-12)
 
     morse_nonmnfld = morse_nonmnfld.abs()
 
@@ -1223,79 +1219,12 @@ def get_color(verts, decoder, mods, device):
 
 
 def implicit2mesh_with_vis(decoder, mods, grid_res, translate=[0., 0., 0.], scale=1, get_mesh=True, device=None,
-                           bbox=np.array([[-1, 1], [-1, 1], [-1, 1]]), feat=None, hash_tree=None):
-    # compute a mesh from the implicit representation in the decoder.
-    # Uses marching cubes.
-    # reimplemented from SAL get surface trace function : https://github.com/matanatz/SAL/blob/master/code/utils/plots.py
-    print('in implicit2mesh')
-    print(grid_res, translate, scale, bbox)
-    mesh = None
-    grid_dict = get_3d_grid(resolution=grid_res, bbox=bbox, device=device)
-    print('Finished getting grid_dict')
-    cell_width = grid_dict['xyz'][0][2] - grid_dict['xyz'][0][1]
-    pnts = grid_dict["grid_points"]
-
-    z = []
-    for point in tqdm(torch.split(pnts, 10000, dim=0)):
-        # point: (100000, 3)
-        point = get_cuda_ifavailable(point, device=device)
-        if feat is not None:
-            if point.dim() == 2:
-                point = point.unsqueeze(0)
-            query_feat = decoder.encoder.query_feature(feat, point)
-            z.append(decoder.decoder(point, query_feat).detach().squeeze(0).cpu().numpy())
-        elif hash_tree is not None:
-            if point.dim() == 2:
-                point = point.unsqueeze(0)
-            # query_feat = decoder.encoder.query_feature(feat, point)
-            query_feat = decoder.encoder.query_feature(hash_tree, feat, point)
-            z.append(decoder.decoder(point, query_feat).detach().squeeze(0).cpu().numpy())
-        else:
-            z.append(decoder(point.type(torch.float32), mods).detach().squeeze(0).cpu().numpy())
-    z = np.concatenate(z, axis=0).reshape(grid_dict['xyz'][1].shape[0], grid_dict['xyz'][0].shape[0],
-                                          grid_dict['xyz'][2].shape[0]).transpose([1, 0, 2]).astype(np.float64)
+                           bbox=np.array([[-1, 1], [-1, 1], [-1, 1]]), feat=None, hash_tree=None, volume_path=None):
+    # same extraction as implicit2mesh; vertex colours for visualisation can be added with get_color(mesh.vertices, ...)
+    return sdf_volume2mesh(decoder, mods, grid_res, translate=translate, scale=scale, get_mesh=get_mesh,
+                           device=device, bbox=bbox, feat=feat, hash_tree=hash_tree, backend='mcubes',
+                           volume_path=volume_path)
 
-    print(z.min(), z.max())
-
-    threshs = [0.00]
-    mesh_list = list()
-    for thresh in threshs:
-        if (np.sum(z > 0.0) < np.sum(z < 0.0)):
-            thresh = -thresh
-        # verts, faces, normals, values = measure.marching_cubes(volume=z, level=thresh,
-        #                                                        spacing=(cell_width, cell_width, cell_width),
-        #                                                        method='lewiner')  # method:'lewiner' or 'lorensen'
-        verts, faces = mcubes.marching_cubes(z, 0)
-
-        # colors = get_color(verts, decoder, mods, device)
-        #
-        # import open3d as o3d
-        # pts_o3d = o3d.geometry.PointCloud()
-        # pts_o3d.points = o3d.utility.Vector3dVector(verts.astype(np.float32))
-        # pts_o3d.colors = o3d.utility.Vector3dVector(colors)
-        # o3d.io.write_point_cloud('/home/qiujie/Morse/surface_reconstruction/debug_add_smooth_fun/1.ply', pts_o3d)
-
-        verts = verts + np.array([grid_dict['xyz'][0][0], grid_dict['xyz'][1][0], grid_dict['xyz'][2][0]])
-        verts = verts * (1 / scale) - translate
-
-        if get_mesh:
-            # mesh = trimesh.Trimesh(verts, faces, vertex_normals=normals, vertex_colors=values, validate=True)
-            mesh = trimesh.Trimesh(verts, faces, validate=True)
-            # mesh = trimesh.Trimesh(verts, faces, vertex_colors=colors, validate=True)
-        mesh_list.append(mesh)
-
-    # mesh = mesh_list[0]
-    # # out_dir = '/home/qiujie/Morse/surface_reconstruction/debug_add_smooth_fun/1_norm.obj'
-    # # mesh = normalize_mesh_export(mesh)
-    #
-    # # mesh = trimesh.load_mesh(out_dir, process=False, force='mesh')
-    # mesh_normliza = normalize_mesh_export(mesh)
-    #
-    # colors = get_color(mesh_normliza.vertices, decoder, mods, device)
-    # mesh_normliza.visual.vertex_colors = colors
-    # return mesh_normliza
-
-    return mesh_list[0]
 
 # @nb.jit()
 def surface_extraction_single(ndf, grad, b_max, b_min, resolution):
@@ -1458,80 +1387,70 @@ def plot_cuts_axis(points, decoder, latent, path, epoch, near_zero, axis=1, file
         offline.plot(fig1, filename=filename, auto_open=False)
 
 
-def inner_iteration(ndf_loc, grad_loc, i, j, k):
-    ndf_loc = np.ascontiguousarray(ndf_loc)
-    grad_loc = np.ascontiguousarray(grad_loc)
-    res = np.ones((2, 2, 2))
-    for ii in range(2):
-        for jj in range(2):
-            for kk in range(2):
-                if np.dot(grad_loc[0][0][0], grad_loc[ii][jj][kk]) < 0:
-                    res[ii][jj][kk] = -ndf_loc[ii][jj][kk]
-                else:
-                    res[ii][jj][kk] = ndf_loc[ii][jj][kk]
-    shape_dict = dict()
-    if res.min() < 0:
-        v, f, _, _ = measure.marching_cubes(res, 0.0)
-        # v, f = mcubes(res, 0)
-        v[:, 0] = v[:, 0] + i
-        v[:, 1] = v[:, 1] + j
-        v[:, 2] = v[:, 2] + k
-        shape_dict['v'] = v
-        shape_dict['f'] = f
-    else:
-        shape_dict['v'] = None
-        shape_dict['f'] = None
-
-    return shape_dict
-
-
-import numba
-
-
-@numba.jit(nopython=True, fastmath=True)
-def map(ndf, grad, resolution=128, threshold=0.01):
-    call_params = list()
-    for i in range(resolution - 1):
-        for j in range(resolution - 1):
-            for k in range(resolution - 1):
-                ndf_loc = ndf[i:i + 2]
-                ndf_loc = ndf_loc[:, j:j + 2, :]
-                ndf_loc = ndf_loc[:, :, k:k + 2]
-                if np.min(ndf_loc) > threshold:
-                    continue
-                grad_loc = grad[i:i + 2]
-                grad_loc = grad_loc[:, j:j + 2, :]
-                grad_loc = grad_loc[:, :, k:k + 2]
-                call_params.append((ndf_loc, grad_loc, i, j, k))
-    return call_params
-
-
-def reduce(res_dict_list):
-    v_all = list()
-    f_all = list()
-    v_num = 0
-    for res in res_dict_list:
-        if res['v'] is not None:
-            v_all.append(res['v'])
-            f_all.append(res['f'] + v_num)
-            v_num += res['v'].shape[0]
-    v_all = np.concatenate(v_all)
-    f_all = np.concatenate(f_all)
-    mesh = trimesh.Trimesh(v_all, f_all)
-    return mesh
+# corner offsets of a grid cell, in the [ii][jj][kk] order of a 2x2x2 block
+_CELL_CORNERS = np.array([[i, j, k] for i in range(2) for j in range(2) for k in range(2)])
 
 
-def surface_extraction_mp(ndf, grad, resolution):
+def surface_extraction_vectorized(ndf, grad, resolution, threshold=0.01):
     '''
-    Modified From CAP-UDF (https://github.com/junshengzhou/CAP-UDF)
+    UDF to mesh as in CAP-UDF (https://github.com/junshengzhou/CAP-UDF): every cell with a corner UDF below threshold
+    is signed locally (corners whose gradient points against the gradient at the cell's first corner are negated) and
+    polygonised on its own. The candidate cells and their signs are computed with array operations over the whole
+    volume. The signed 2x2x2 blocks are then packed side by side into one volume and extracted by a single skimage
+    marching cubes call, whose mask (set at the last corner of a cube) restricts it to the packed cells, so the cubes
+    straddling two blocks produce nothing. Gives the same mesh as the former per-cell loop.
     '''
-    from .utils_mp import start_process_pool
-    num_processes = 8
-
-    call_params = map(ndf, grad, resolution)
-    res_dict_list = start_process_pool(inner_iteration, call_params, num_processes)
-    mesh = reduce(res_dict_list)
-
+    r = resolution - 1
+    # 2x2x2 minimum of the UDF, one volume instead of a stack of the eight shifted views
+    cell_min = np.minimum(ndf[:r, :r, :r], ndf[1:, 1:, 1:])
+    for i, j, k in _CELL_CORNERS[1:-1]:
+        np.minimum(cell_min, ndf[i:i + r, j:j + r, k:k + r], out=cell_min)
+    cells = np.nonzero(cell_min <= threshold)
+    del cell_min
+    values = np.stack([ndf[cells[0] + i, cells[1] + j, cells[2] + k] for i, j, k in _CELL_CORNERS],
+                      axis=1).astype(np.float64)
+    corner_grad = np.stack([grad[cells[0] + i, cells[1] + j, cells[2] + k] for i, j, k in _CELL_CORNERS], axis=1)
+    flip = np.einsum('nd,ncd->nc', corner_grad[:, 0], corner_grad) < 0
+    values = np.where(flip, -values, values)
+    keep = values.min(-1) < 0
+    values = values[keep]
+    origins = np.stack(cells, axis=-1)[keep]
+    if len(values) == 0:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+
+    side = int(np.ceil(len(values) ** (1 / 3)))
+    slot = np.stack(np.unravel_index(np.arange(len(values)), (side, side, side)), axis=-1)
+    volume = np.ones((2 * side, 2 * side, 2 * side), dtype=np.float64)
+    for c, (i, j, k) in enumerate(_CELL_CORNERS):
+        volume[2 * slot[:, 0] + i, 2 * slot[:, 1] + j, 2 * slot[:, 2] + k] = values[:, c]
+    mask = np.zeros(volume.shape, dtype=bool)
+    mask[2 * slot[:, 0] + 1, 2 * slot[:, 1] + 1, 2 * slot[:, 2] + 1] = True
+    verts, faces, _, _ = measure.marching_cubes(volume, 0.0, mask=mask)
+
+    # move every vertex from its packed block back to the cell it came from. The float32 vertices carry the rounding
+    # error of the packed position, so a vertex shared by two cells would not weld: a vertex on a cell edge gets its
+    # offset along the edge recomputed from the corner values, which gives the same bits in both cells
+    # (|a| / (|a| + |b|) either way). The vertices lewiner adds inside ambiguous cells are not shared and stay as is.
+    block = np.minimum(np.floor(verts / 2).astype(np.int64), side - 1)
+    cell = np.ravel_multi_index(block.T, (side, side, side))
+    local = verts.astype(np.float64) - 2 * block
+    off_grid = np.abs(local - np.round(local))
+    on_edge = np.nonzero((off_grid > 1e-3).sum(axis=1) <= 1)[0]
+    axis = off_grid[on_edge].argmax(axis=1)
+    lo = np.clip(np.round(local[on_edge]), 0, 1).astype(np.int64)
+    rows = np.arange(len(on_edge))
+    lo[rows, axis] = 0
+    hi = lo.copy()
+    hi[rows, axis] = 1
+    a = values[cell[on_edge], lo @ np.array([4, 2, 1])]
+    b = values[cell[on_edge], hi @ np.array([4, 2, 1])]
+    crossing = a != b
+    t = np.where(crossing, a / np.where(crossing, a - b, 1.0), local[on_edge, axis])
+    local[on_edge] = lo
+    local[on_edge, axis] = t
+    verts = local + origins[cell]
+
+    mesh = trimesh.Trimesh(verts, faces)
     mesh.remove_duplicate_faces()
     mesh.remove_degenerate_faces()
     mesh.fill_holes()
@@ -1546,37 +1465,21 @@ def udf2mesh(decoder, latent, grid_res, translate=[0., 0., 0.], scale=1, get_mes
     print(grid_res, translate, scale, bbox)
     mesh = None
 
-    def get_query_point(device, bd=1.05, resolution=128):
-        shape = (resolution, resolution, resolution)
-        vxs = torch.arange(-bd, bd, bd * 2 / resolution)
-        vys = torch.arange(-bd, bd, bd * 2 / resolution)
-        vzs = torch.arange(-bd, bd, bd * 2 / resolution)
-        pxs = vxs.view(-1, 1, 1).expand(*shape).contiguous().view(resolution ** 3)
-        pys = vys.view(1, -1, 1).expand(*shape).contiguous().view(resolution ** 3)
-        pzs = vzs.view(1, 1, -1).expand(*shape).contiguous().view(resolution ** 3)
-        p = torch.stack([pxs, pys, pzs], dim=1).reshape(resolution ** 3, 3).to(device)
-        return p
-
-    pnts = get_query_point(resolution=grid_res, device=device)
-    z = []
-    n = []
-    for point in tqdm(torch.split(pnts, 100000, dim=0)):
-        # point: (100000, 3)
+    # the MeshUDF query grid: resolution points per axis from -1.05 with a spacing of 2.1 / resolution
+    bd = 1.05
+    axis = torch.arange(-bd, bd, bd * 2 / grid_res).numpy()
+
+    def udf_fn(points):
         if latent is not None:
-            point = torch.cat([point, latent.unsqueeze(0).repeat(point.shape[0], 1), ], dim=1)
-        point = get_cuda_ifavailable(point, device=device)
-        point.requires_grad_()
-        pred = decoder(point.type(torch.float32))
-        normals = gradient(point, pred).detach()
-        z.append(pred.detach().cpu().float().numpy())
-        n.append(normals.detach().cpu().float().numpy())
-    z = np.concatenate(z, axis=0).reshape(grid_res, grid_res, grid_res).astype(np.float32)
-    n = np.concatenate(n, axis=0).reshape(grid_res, grid_res, grid_res, 3).astype(np.float32)
+            points = torch.cat([points, latent.unsqueeze(0).repeat(points.shape[0], 1), ], dim=1)
+        return decoder(points)
+
+    # values and normals are streamed slab by slab into preallocated float32 volumes, without keeping any graph
+    z, n = sdf_volume.stream_field(udf_fn, [axis, axis, axis], batch_size=100000, device=device)
     print(z.min(), z.max())
 
-    pnts = pnts.detach().cpu().float().numpy().reshape(grid_res, grid_res, grid_res, 3)
     # verts, faces = surface_extraction_single(z, n, resolution=grid_res, b_min=bbox.min(1), b_max=bbox.max(1))
-    verts, faces = surface_extraction_mp(z, n, resolution=grid_res)
+    verts, faces = surface_extraction_vectorized(z, n, resolution=len(axis))
     # verts, faces = EMC(grids_coords=pnts, grids_udf=z, grids_udf_grad=n,
     #                    voxel_size=2. / grid_res, res=grid_res)
 
@@ -9,6 +9,7 @@ import os
 import sys
 import json
 import subprocess
+import shutil
 import threading
 import time
 from flask import Flask, request, jsonify, Response, stream_template, send_file
@@ -17,7 +18,13 @@ import traceback
 import queue
 import tempfile
 import uuid
-import re
+
+from neurcad_scheduler import JobScheduler
+from neurcad_store import ArtifactStore
+from neurcad_worker_pool import WarmWorkerPool
+from neurcad_mesh_io import read_triangle_mesh, read_ply_element_counts, encode_mesh_binary
+from neurcad_events import EventBus, SSEServer, format_sse, parse_last_event_id
+from neurcad_result_cache import ResultCache
 
 # 设置虚拟环境路径
 VIRTUAL_ENV_PATH = os.path.expanduser("~/miniconda3/envs/CrownCAD")
@@ -33,11 +40,76 @@ NEURCAD_PATH = os.path.join(os.path.dirname(__file__), "NeurCADRecon-main", "Neu
 if os.path.exists(NEURCAD_PATH):
     sys.path.insert(0, NEURCAD_PATH)
 
+# 调度器配置，可通过环境变量覆盖
+MAX_CONCURRENT_JOBS = int(os.environ.get('NEURCAD_MAX_JOBS', 2))
+CPUS_PER_JOB = int(os.environ.get('NEURCAD_CPUS_PER_JOB', 4))
+MEM_PER_JOB_GB = float(os.environ.get('NEURCAD_MEM_PER_JOB_GB', 4.0))
+MAX_QUEUE_SIZE = int(os.environ.get('NEURCAD_MAX_QUEUE', 64))
+
+# 产物存储配置：上传文件和任务结果的保留时间
+ARTIFACTS_ROOT = os.environ.get('NEURCAD_ARTIFACTS_ROOT', os.path.join(NEURCAD_PATH, 'artifacts'))
+ARTIFACT_TTL_SECONDS = int(os.environ.get('NEURCAD_ARTIFACT_TTL', 24 * 3600))
+ARTIFACT_GC_INTERVAL = int(os.environ.get('NEURCAD_ARTIFACT_GC_INTERVAL', 600))
+
+# 训练进度上报间隔(秒)和训练日志打印间隔(迭代数)，日志间隔越大标准输出流量越小
+PROGRESS_INTERVAL = float(os.environ.get('NEURCAD_PROGRESS_INTERVAL', 1.0))
+TRAIN_LOG_INTERVAL = int(os.environ.get('NEURCAD_TRAIN_LOG_INTERVAL', 100))
+
+# 训练采样方式：device 在训练设备上直接生成样本(无DataLoader进程和主机到设备拷贝)，dataloader 为原始CPU采样
+TRAIN_SAMPLER = os.environ.get('NEURCAD_SAMPLER', 'device')
+# 重要性采样：按各点当前损失残差(表面距离+曲率项)的滑动平均抽取表面点，尖锐特征和薄壁部位被更频繁地采到。
+# 抽样在损失中没有做重要性加权，拟合目标会随之改变，在有倒角距离/F1随迭代数的对比结果之前默认关闭
+USE_IMPORTANCE_SAMPLING = os.environ.get('NEURCAD_IMPORTANCE_SAMPLING', '0') == '1'
+
+# Morse曲率项的Hessian计算方式：autograd 反向模式逐分量求导 | analytic SIREN逐层解析传播 | func torch.func前向模式；
+# 非autograd方式在训练开始时与autograd结果比对，偏差过大时自动退回autograd
+HESSIAN_ENGINE = os.environ.get('NEURCAD_HESSIAN_ENGINE', 'autograd')
+
+# 网格提取时融合SIREN前向(omega_0折进权重、无梯度)的计算精度：float32 | bfloat16(更快，SDF误差约1e-2)
+INFERENCE_DTYPE = os.environ.get('NEURCAD_INFERENCE_DTYPE', 'float32')
+
+# 训练中的网格提取方式：flexicubes 稠密网格 | narrow_band 由粗到细只细分靠近零等值面的单元，再做marching cubes
+MESH_EXTRACTOR = os.environ.get('NEURCAD_MESH_EXTRACTOR', 'flexicubes')
+
+# 近表面采样尺度(sigma)的估计方式：voxel 体素降采样近似 | grid 网格哈希 | kdtree 精确51近邻；结果缓存在输入文件旁
+SIGMA_METHOD = os.environ.get('NEURCAD_SIGMA_METHOD', 'voxel')
+
+# 上传后在后台把点云预处理为可内存映射的数据包(<文件>.bundle.npz)：归一化点、法向、sigma一次算好，训练时零拷贝加载
+PREPROCESS_UPLOADS = os.environ.get('NEURCAD_PREPROCESS_UPLOADS', '1') == '1'
+
+# 超过该大小(MB)的点云按空间分块存盘、训练时分块采样(out-of-core)，不再整体载入内存；0 表示关闭
+OUT_OF_CORE_MB = float(os.environ.get('NEURCAD_OUT_OF_CORE_MB', 2048))
+
+# 预热训练进程池：1 使用常驻进程执行训练，0 退回每个任务单独启动训练脚本
+USE_WARM_WORKERS = os.environ.get('NEURCAD_WARM_WORKERS', '1') == '1'
+MAX_JOBS_PER_WORKER = int(os.environ.get('NEURCAD_MAX_JOBS_PER_WORKER', 20))
+
+# 事件总线：每个任务保留的事件条数、任务结束后频道的保留时间(秒)，以及异步SSE服务端口
+EVENT_BUFFER_SIZE = int(os.environ.get('NEURCAD_EVENT_BUFFER', 1000))
+EVENT_RETENTION_SECONDS = int(os.environ.get('NEURCAD_EVENT_RETENTION', 600))
+SSE_PORT = int(os.environ.get('NEURCAD_SSE_PORT', 5002))
+
+# 结果缓存：相同点云+相同参数直接返回已有网格和权重，按LRU淘汰
+USE_RESULT_CACHE = os.environ.get('NEURCAD_RESULT_CACHE', '1') == '1'
+RESULT_CACHE_MAX_MB = int(os.environ.get('NEURCAD_RESULT_CACHE_MAX_MB', 2048))
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('NEURCAD_RESULT_CACHE_MAX_ENTRIES', 256))
+
+# 热启动：从形状最相近的历史任务权重初始化，并使用更短的迭代计划
+USE_WARM_START = os.environ.get('NEURCAD_WARM_START', '1') == '1'
+CHECKPOINT_LIBRARY = os.environ.get('NEURCAD_CHECKPOINT_LIBRARY', os.path.join(ARTIFACTS_ROOT, 'checkpoints'))
+WARM_START_ITERATIONS = int(os.environ.get('NEURCAD_WARM_START_ITERATIONS', 2000))
+WARM_START_MAX_DISTANCE = float(os.environ.get('NEURCAD_WARM_START_MAX_DISTANCE', 0.1))
+
+# 提前停止：平滑后的损失在 NEURCAD_EARLY_STOP_PATIENCE 次迭代内没有明显下降时结束训练
+USE_EARLY_STOP = os.environ.get('NEURCAD_EARLY_STOP', '1') == '1'
+EARLY_STOP_PATIENCE = int(os.environ.get('NEURCAD_EARLY_STOP_PATIENCE', 1000))
+EARLY_STOP_MIN_REL_IMPROVEMENT = float(os.environ.get('NEURCAD_EARLY_STOP_MIN_REL_IMPROVEMENT', 0.01))
+
 app = Flask(__name__)
 CORS(app)  # 允许跨域请求
 
-# 全局变量存储输出队列
-output_queues = {}
+# 任务事件总线，支持多个订阅者和断线补发
+event_bus = EventBus(buffer_size=EVENT_BUFFER_SIZE, retention_seconds=EVENT_RETENTION_SECONDS)
 
 # 存储上传的文件信息
 uploaded_files = {}
@@ -45,59 +117,192 @@ uploaded_files = {}
 class OutputCapture:
     def __init__(self, queue_id):
         self.queue_id = queue_id
-        self.queue = queue.Queue()
-        output_queues[queue_id] = self.queue
-        # 匹配NeurCAD输出格式: Epoch: 0 [ 220/5000 (4%)] Loss: ...
-        self.progress_pattern = re.compile(r'Epoch: (\d+) \[(\s*\d+)/(\d+) \((\d+)%\)\]')
+        event_bus.open(queue_id)
         
     def write(self, text):
         if text.strip():
-            # 发送输出日志
-            self.queue.put({
+            # 发送输出日志（进度信息由ProgressFollower从结构化进度文件获取）
+            event_bus.publish(self.queue_id, {
                 'type': 'output',
                 'content': text.strip()
             })
-            
-            # 解析进度信息
-            self._parse_progress(text.strip())
-    
-    def _parse_progress(self, line):
-        """解析NeurCAD输出中的进度信息"""
-        match = self.progress_pattern.search(line)
-        if match:
-            epoch = int(match.group(1))
-            current_iter = int(match.group(2))
-            total_iter = int(match.group(3))
-            percentage = int(match.group(4))
-            
-            # 发送进度信息
-            self.queue.put({
-                'type': 'progress',
-                'percentage': percentage,
-                'message': f'训练中... 迭代 {current_iter}/{total_iter}',
-                'currentEpoch': epoch,
-                'totalEpochs': epoch + 1,
-                'currentIteration': current_iter,
-                'totalIterations': total_iter
-            })
-            
-            print(f"解析到进度: Epoch {epoch}, 迭代 {current_iter}/{total_iter} ({percentage}%)")
     
     def flush(self):
         pass
 
-def run_neurcad_reconstruction(config_data, queue_id):
-    """在后台线程中运行NeurCAD重建"""
+class ProgressFollower:
+    """跟踪训练进程写出的JSON行进度文件，转换为SSE进度事件"""
+    
+    def __init__(self, queue_id, progress_file, poll_interval=0.5):
+        self.queue_id = queue_id
+        self.progress_file = progress_file
+        self.poll_interval = poll_interval
+        self._offset = 0
+        self.done_record = None  # 训练结束时写出的汇总记录
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'progress-{queue_id}')
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def stop(self):
+        """停止跟踪，并读取剩余的进度记录"""
+        self._stopped.set()
+        self._thread.join()
+        self._poll()
+    
+    def _run(self):
+        while not self._stopped.wait(self.poll_interval):
+            self._poll()
+    
+    def _poll(self):
+        if not os.path.exists(self.progress_file):
+            return
+        with open(self.progress_file, 'r') as f:
+            f.seek(self._offset)
+            while True:
+                line = f.readline()
+                # 只处理完整的行，未写完的行留到下次读取
+                if not line.endswith('\n'):
+                    break
+                self._offset = f.tell()
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('type') == 'progress':
+                    self._publish(record)
+                elif record.get('type') == 'done':
+                    self.done_record = record
+    
+    def _publish(self, record):
+        eta = record.get('eta_s')
+        eta_text = f', 剩余约 {int(eta)} 秒' if eta is not None else ''
+        event_bus.publish(self.queue_id, {
+            'type': 'progress',
+            'percentage': int(record['percentage']),
+            'message': f"训练中... 迭代 {record['iteration']}/{record['total_iterations']}, "
+                       f"{record['it_per_s']:.1f} it/s{eta_text}",
+            'currentEpoch': record['epoch'],
+            'totalEpochs': record['epoch'] + 1,
+            'currentIteration': record['iteration'],
+            'totalIterations': record['total_iterations'],
+            'itPerSec': record['it_per_s'],
+            'etaSeconds': eta,
+            'losses': record.get('losses', {})
+        })
+
+preprocessing_uploads = set()
+preprocessing_lock = threading.Lock()
+
+def preprocess_upload(file_path, digest=None):
+    """后台预处理上传的点云：普通点云生成数据包(<文件>.bundle.npz)，超过out-of-core阈值的大点云生成空间分块(<文件>.chunks)。
+    已有结果(上传按内容寻址，内容不变)或正在生成时直接返回；未就绪时训练照常解析原始点云"""
+    script_dir = os.path.join(NEURCAD_PATH, "surface_reconstruction")
+    if OUT_OF_CORE_MB > 0 and os.path.getsize(file_path) > OUT_OF_CORE_MB * (1 << 20):
+        output_path = file_path + '.chunks'
+        cmd = [sys.executable, os.path.join(script_dir, "point_chunks.py"), file_path, '--sigma_method', SIGMA_METHOD]
+    else:
+        output_path = file_path + '.bundle.npz'
+        cmd = [sys.executable, os.path.join(script_dir, "point_bundle.py"), file_path, '--sigma_method', SIGMA_METHOD]
+    if digest:
+        # 上传时已计算的SHA256作为缓存指纹，预处理不再重新读取整个文件计算
+        cmd += ['--sha256', digest]
+    if os.path.exists(output_path):
+        artifact_store.touch_upload(file_path)
+        return
+    with preprocessing_lock:
+        if file_path in preprocessing_uploads:
+            return
+        preprocessing_uploads.add(file_path)
+
+    def run():
+        try:
+            result = subprocess.run(cmd, cwd=script_dir, capture_output=True, text=True)
+            if result.returncode == 0:
+                print(f"点云预处理完成: {output_path}")
+            else:
+                print(f"点云预处理失败: {result.stderr[-2000:]}")
+        except Exception as e:
+            print(f"点云预处理时发生错误: {e}")
+        finally:
+            with preprocessing_lock:
+                preprocessing_uploads.discard(file_path)
+
+    thread = threading.Thread(target=run, name=f'preprocess-{os.path.basename(file_path)}')
+    thread.daemon = True
+    thread.start()
+
+def resolve_input_file(config_data):
+    """输入文件路径，相对路径以NeurCAD目录为基准"""
+    return os.path.join(NEURCAD_PATH, config_data.get('input_file', 'input_pld.ply'))
+
+def build_train_config(config_data, work_dir=None):
+    """由前端配置生成训练参数（与train_surface_reconstruction.py的命令行参数同名），同时用于计算结果缓存键"""
+    train_config = {
+        'data_path': resolve_input_file(config_data),
+        'n_samples': int(config_data.get('n_samples', 10000)),
+        'batch_size': int(config_data.get('batch_size', 1)),
+        'grid_res': int(config_data.get('grid_res', 128)),
+        'lr': float(config_data.get('lr', 5e-05)),
+        'init_type': config_data.get('init_type', 'siren'),
+        'decoder_hidden_dim': int(config_data.get('decoder_hidden_dim', 256)),
+        'decoder_n_hidden_layers': int(config_data.get('decoder_n_hidden_layers', 4)),
+        'morse_type': config_data.get('morse_type', 'l1'),
+        'morse_decay': config_data.get('morse_decay', 'linear'),
+        'loss_weights': [float(w) for w in config_data.get('loss_weights', [7000, 600, 100, 50, 0, 10])],
+        'sampler': TRAIN_SAMPLER,
+        'sigma_method': SIGMA_METHOD,
+        'sigma_cache': True,
+        'hessian_engine': HESSIAN_ENGINE,
+        'inference_dtype': INFERENCE_DTYPE,
+        'mesh_extractor': MESH_EXTRACTOR,
+        'progress_file': os.path.join(work_dir, 'progress.jsonl') if work_dir else None,
+        'progress_interval': PROGRESS_INTERVAL,
+        'log_interval': TRAIN_LOG_INTERVAL
+    }
+    # 输入点云的SHA256直接交给训练，数据包/分块/sigma缓存用它校验输入，不再各自读取整个文件
+    if config_data.get('input_sha256'):
+        train_config['data_sha256'] = config_data['input_sha256']
+    # 前端可通过 importance_sampling: true/false 按任务开启或关闭，未指定时跟随 NEURCAD_IMPORTANCE_SAMPLING
+    if config_data.get('importance_sampling', USE_IMPORTANCE_SAMPLING):
+        train_config['importance_sampling'] = True
+    # 大点云走分块out-of-core数据集，分块目录建在输入文件旁，同一文件的后续任务直接复用
+    data_path = train_config['data_path']
+    if OUT_OF_CORE_MB > 0 and os.path.exists(data_path) and os.path.getsize(data_path) > OUT_OF_CORE_MB * (1 << 20):
+        train_config['out_of_core'] = True
+    # 前端可通过 early_stop: false 强制跑满全部迭代
+    if USE_EARLY_STOP and config_data.get('early_stop', True):
+        train_config.update({
+            'early_stop': True,
+            'early_stop_patience': EARLY_STOP_PATIENCE,
+            'early_stop_min_rel_improvement': EARLY_STOP_MIN_REL_IMPROVEMENT
+        })
+    # 前端可通过 warm_start: false 强制从头训练
+    if USE_WARM_START and config_data.get('warm_start', True):
+        train_config.update({
+            'checkpoint_library': CHECKPOINT_LIBRARY,
+            'warm_start_n_samples': WARM_START_ITERATIONS,
+            'warm_start_max_distance': WARM_START_MAX_DISTANCE
+        })
+    return train_config
+
+def result_paths(work_dir, input_file):
+    """训练脚本以输入文件名作为结果子目录名，返回 (结果网格路径, 最终权重路径)"""
+    shape_name = os.path.splitext(os.path.basename(input_file))[0]
+    shape_dir = os.path.join(work_dir, 'reconstruction_results', shape_name)
+    return (os.path.join(shape_dir, 'result_meshes', shape_name + '.ply'),
+            os.path.join(shape_dir, 'trained_models', 'model_model.pth'))
+
+def run_neurcad_reconstruction(config_data, queue_id, work_dir):
+    """在调度器工作线程中运行NeurCAD重建，所有中间文件和结果都写入任务自己的工作目录"""
     try:
-        print(f"开始重建线程，队列ID: {queue_id}")
+        print(f"开始重建任务，队列ID: {queue_id}")
         
-        # 确保队列存在
-        if queue_id not in output_queues:
-            print(f"队列 {queue_id} 不存在，创建新队列")
-            output_queues[queue_id] = queue.Queue()
+        # 确保事件频道存在
+        event_bus.open(queue_id)
         
         # 发送初始进度信息
-        output_queues[queue_id].put({
+        event_bus.publish(queue_id, {
             'type': 'progress',
             'percentage': 0,
             'message': '正在初始化重建环境...',
@@ -105,8 +310,8 @@ def run_neurcad_reconstruction(config_data, queue_id):
             'totalEpochs': 1
         })
         
-        # 创建临时配置文件
-        config_file = 'temp_config.json'
+        # 创建任务私有的配置文件
+        config_file = os.path.join(work_dir, 'temp_config.json')
         with open(config_file, 'w') as f:
             json.dump(config_data, f, indent=2)
         
@@ -117,78 +322,79 @@ def run_neurcad_reconstruction(config_data, queue_id):
         output_capture = OutputCapture(queue_id)
         
         # 构建命令
-        neurcad_dir = os.path.join(os.path.dirname(__file__), "NeurCADRecon-main", "NeurCADRecon-main")
+        neurcad_dir = NEURCAD_PATH
         script_path = os.path.join(neurcad_dir, "surface_reconstruction", "train_surface_reconstruction.py")
         
         print(f"NeurCAD目录: {neurcad_dir}")
+        print(f"任务工作目录: {work_dir}")
         print(f"脚本路径: {script_path}")
         print(f"脚本是否存在: {os.path.exists(script_path)}")
         
-        # 保存当前目录
-        original_dir = os.getcwd()
-        
-        # 切换到NeurCAD目录
-        os.chdir(neurcad_dir)
-        print(f"切换到目录: {os.getcwd()}")
-        
-        # 检查输入文件
-        input_file = config_data.get('input_file', 'input_pld.ply')
-        print(f"配置中的输入文件: {input_file}")
-        print(f"当前工作目录: {os.getcwd()}")
-        print(f"输入文件完整路径: {os.path.abspath(input_file)}")
+        # 训练参数，与train_surface_reconstruction.py的命令行参数同名
+        train_config = build_train_config(config_data, work_dir)
+        input_file = train_config['data_path']
+        progress_file = train_config['progress_file']
+        print(f"输入文件完整路径: {input_file}")
         print(f"输入文件是否存在: {os.path.exists(input_file)}")
         
-        # 列出当前目录文件
-        print(f"当前目录文件列表:")
-        for file in os.listdir('.'):
-            if file.endswith('.ply'):
-                print(f"  - {file}")
-        
-        # 构建Python命令，使用正确的参数格式
-        cmd = [
-            python_path,  # 使用当前Python解释器
-            script_path,
-            '--data_path', input_file,
-            '--n_samples', str(config_data.get('n_samples', 10000)),
-            '--grid_res', str(config_data.get('grid_res', 128)),
-            '--lr', str(config_data.get('lr', 5e-05)),
-            '--init_type', config_data.get('init_type', 'siren'),
-            '--decoder_hidden_dim', str(config_data.get('decoder_hidden_dim', 256)),
-            '--decoder_n_hidden_layers', str(config_data.get('decoder_n_hidden_layers', 4)),
-            '--morse_type', config_data.get('morse_type', 'l1'),
-            '--morse_decay', config_data.get('morse_decay', 'linear'),
-            '--loss_weights'
-        ]
-        
-        # 添加loss_weights参数
-        loss_weights = config_data.get('loss_weights', [7000, 600, 100, 50, 0, 10])
-        cmd.extend([str(w) for w in loss_weights])
-        
-        print(f"执行命令: {' '.join(cmd)}")
-        
-        # 启动进程
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            bufsize=1
-        )
-        
-        print(f"进程已启动，PID: {process.pid}")
+        # 训练进度通过JSON行文件传递，不再解析标准输出
+        progress_follower = ProgressFollower(queue_id, progress_file)
         
-        # 实时读取输出
-        for line in iter(process.stdout.readline, ''):
-            if line:
-                print(f"NeurCAD输出: {line.strip()}")
-                output_capture.write(line)
-        
-        # 等待进程完成
-        return_code = process.wait()
-        print(f"进程完成，返回码: {return_code}")
+        if worker_pool is not None:
+            # 在预热进程中执行，无需重新导入torch/kaolin等依赖
+            print(f"使用预热训练进程执行任务: {queue_id}")
+            try:
+                worker_pool.run(queue_id, train_config, work_dir, on_output=output_capture.write)
+            finally:
+                progress_follower.stop()
+            print(f"预热进程任务完成: {queue_id}")
+        else:
+            # 构建Python命令，使用正确的参数格式
+            cmd = [
+                sys.executable,  # 使用当前Python解释器
+                script_path
+            ]
+            for key, value in train_config.items():
+                if isinstance(value, bool):
+                    # store_true 类型的开关参数不带值
+                    if value:
+                        cmd.append('--' + key)
+                    continue
+                cmd.append('--' + key)
+                if isinstance(value, list):
+                    cmd.extend([str(v) for v in value])
+                else:
+                    cmd.append(str(value))
+            
+            print(f"执行命令: {' '.join(cmd)}")
+            
+            try:
+                # 启动进程，工作目录为任务私有目录，不再切换服务器进程的CWD
+                process = subprocess.Popen(
+                    cmd,
+                    cwd=work_dir,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    universal_newlines=True,
+                    bufsize=1
+                )
+            
+                print(f"进程已启动，PID: {process.pid}")
+            
+                # 实时读取输出
+                for line in iter(process.stdout.readline, ''):
+                    if line:
+                        print(f"NeurCAD输出: {line.strip()}")
+                        output_capture.write(line)
+            
+                # 等待进程完成
+                return_code = process.wait()
+            finally:
+                progress_follower.stop()
+            print(f"进程完成，返回码: {return_code}")
         
-        # 读取重建结果文件
-        result_mesh_path = os.path.join('reconstruction_results', 'input_pld', 'result_meshes', 'input_pld.ply')
+        # 读取重建结果文件（训练脚本以输入文件名作为结果子目录名）
+        result_mesh_path, model_path = result_paths(work_dir, input_file)
         print(f"查找结果文件: {result_mesh_path}")
         print(f"结果文件是否存在: {os.path.exists(result_mesh_path)}")
         
@@ -200,46 +406,32 @@ def run_neurcad_reconstruction(config_data, queue_id):
             'final_loss': 0.0,
             'convergence_epoch': 0,
             'mesh_quality': 'Unknown',
-            'mesh_file_path': result_mesh_path if os.path.exists(result_mesh_path) else None
+            'mesh_file_path': result_mesh_path if os.path.exists(result_mesh_path) else None,
+            'model_file_path': model_path if os.path.exists(model_path) else None,
+            'cache_hit': False,
+            'warm_start': None,
+            'iterations_run': None,
+            'saved_iterations': 0,
+            'early_stopped': False
         }
+        # 训练汇总：热启动来源、实际迭代数和提前停止节省的迭代数
+        for key in ('warm_start', 'iterations_run', 'saved_iterations', 'early_stopped'):
+            if progress_follower.done_record and key in progress_follower.done_record:
+                result_data[key] = progress_follower.done_record[key]
+        if result_data['early_stopped']:
+            print(f"提前停止: 实际迭代 {result_data['iterations_run']} 次, 节省 {result_data['saved_iterations']} 次")
         
         # 如果结果文件存在，尝试读取网格信息
         if os.path.exists(result_mesh_path):
             try:
-                import numpy as np
-                from plyfile import PlyData
-                
-                # 读取PLY文件
-                plydata = PlyData.read(result_mesh_path)
-                
-                # 获取顶点和面信息
-                if 'vertex' in plydata:
-                    vertex_count = len(plydata['vertex'])
-                    result_data['vertex_count'] = vertex_count
-                    print(f"读取到顶点数: {vertex_count}")
-                    
-                    # 提取顶点数据
-                    vertices = []
-                    for vertex in plydata['vertex']:
-                        vertices.extend([float(vertex['x']), float(vertex['y']), float(vertex['z'])])
-                    result_data['mesh_data'] = {
-                        'vertices': vertices,
-                        'faces': [],
-                        'normals': []
-                    }
-                
-                if 'face' in plydata:
-                    face_count = len(plydata['face'])
-                    result_data['face_count'] = face_count
-                    print(f"读取到面数: {face_count}")
-                    
-                    # 提取面数据
-                    faces = []
-                    for face in plydata['face']:
-                        # face 是一个tuple，face[0]是索引数组
-                        face_vertices = face[0]
-                        faces.extend([int(idx) for idx in face_vertices[:3]])  # 转换为int类型
-                    result_data['mesh_data']['faces'] = faces
+                # 只读取PLY头部获得顶点数和面数，网格本体由 get-mesh-binary 接口按需传输
+                element_counts = read_ply_element_counts(result_mesh_path)
+                vertex_count = element_counts.get('vertex', 0)
+                face_count = element_counts.get('face', 0)
+                result_data['vertex_count'] = vertex_count
+                result_data['face_count'] = face_count
+                result_data['mesh_binary_url'] = f'/api/neurcad/get-mesh-binary?queue_id={queue_id}'
+                print(f"读取到顶点数: {vertex_count}, 面数: {face_count}")
                 
                 # 根据顶点和面数评估网格质量
                 if vertex_count > 0 and face_count > 0:
@@ -251,7 +443,6 @@ def run_neurcad_reconstruction(config_data, queue_id):
                         result_data['mesh_quality'] = 'Low'
                 
                 print(f"网格质量评估: {result_data['mesh_quality']}")
-                print(f"网格数据已提取: {len(result_data['mesh_data']['vertices'])} 个顶点, {len(result_data['mesh_data']['faces'])} 个面索引")
                 
             except Exception as e:
                 print(f"读取结果文件时发生错误: {e}")
@@ -274,7 +465,7 @@ def run_neurcad_reconstruction(config_data, queue_id):
             print(f"警告: 结果文件不存在: {result_mesh_path}")
             # 列出reconstruction_results目录内容
             try:
-                results_dir = os.path.join('reconstruction_results')
+                results_dir = os.path.join(work_dir, 'reconstruction_results')
                 if os.path.exists(results_dir):
                     print(f"reconstruction_results目录内容:")
                     for root, dirs, files in os.walk(results_dir):
@@ -284,41 +475,131 @@ def run_neurcad_reconstruction(config_data, queue_id):
             except Exception as e:
                 print(f"列出目录内容时发生错误: {e}")
         
+        # 写入结果缓存，之后相同点云+相同参数的提交直接复用
+        if result_cache is not None and config_data.get('input_sha256') and result_data['mesh_file_path']:
+            try:
+                cache_key = ResultCache.make_key(config_data['input_sha256'], train_config)
+                result_cache.put(cache_key, result_mesh_path, result_data['model_file_path'], result_data)
+                print(f"重建结果已写入缓存: {cache_key}")
+            except Exception as e:
+                print(f"写入结果缓存失败: {e}")
+        
         # 发送100%进度
-        if queue_id in output_queues:
-            output_queues[queue_id].put({
-                'type': 'progress',
-                'percentage': 100,
-                'message': '重建完成！正在生成结果...',
-                'currentEpoch': 0,
-                'totalEpochs': 1
-            })
+        event_bus.publish(queue_id, {
+            'type': 'progress',
+            'percentage': 100,
+            'message': '重建完成！正在生成结果...',
+            'currentEpoch': 0,
+            'totalEpochs': 1
+        })
         
         # 发送完成信号，包含真实的结果数据
-        if queue_id in output_queues:
-            output_queues[queue_id].put({
-                'type': 'complete',
-                'result': result_data
-            })
+        event_bus.publish(queue_id, {
+            'type': 'complete',
+            'result': result_data
+        })
         
         # 清理
-        os.chdir(os.path.dirname(neurcad_dir))
-        os.chdir(original_dir)
         if os.path.exists(config_file):
             os.remove(config_file)
+        
+        return result_data
             
     except Exception as e:
         print(f"重建过程中发生错误: {e}")
         import traceback
         traceback.print_exc()
-        # 确保队列存在后再发送错误信息
-        if queue_id in output_queues:
-            output_queues[queue_id].put({
-                'type': 'error',
-                'error': str(e)
-            })
-        else:
-            print(f"无法发送错误信息，队列 {queue_id} 不存在")
+        # 发送错误信息（频道不存在时publish返回None）
+        if event_bus.publish(queue_id, {'type': 'error', 'error': str(e)}) is None:
+            print(f"无法发送错误信息，事件频道 {queue_id} 不存在")
+        raise
+
+
+def serve_cached_result(queue_id, config_data, entry):
+    """缓存命中：把缓存的网格和权重链接到任务目录并登记为已完成任务，立即发送完成事件"""
+    work_dir = artifact_store.job_dir(queue_id)
+    result_mesh_path, model_path = result_paths(work_dir, resolve_input_file(config_data))
+    os.makedirs(os.path.dirname(result_mesh_path), exist_ok=True)
+    os.makedirs(os.path.dirname(model_path), exist_ok=True)
+    try:
+        os.link(entry['mesh_path'], result_mesh_path)
+    except OSError:
+        shutil.copy2(entry['mesh_path'], result_mesh_path)
+    if entry['model_path']:
+        try:
+            os.link(entry['model_path'], model_path)
+        except OSError:
+            shutil.copy2(entry['model_path'], model_path)
+    
+    result_data = dict(entry['meta'])
+    result_data.pop('cached_time', None)
+    result_data.update({
+        'mesh_file_path': result_mesh_path,
+        'model_file_path': model_path if entry['model_path'] else None,
+        'mesh_binary_url': f'/api/neurcad/get-mesh-binary?queue_id={queue_id}',
+        'cache_hit': True
+    })
+    scheduler.add_finished(queue_id, config_data, result_data, work_dir)
+    
+    event_bus.open(queue_id)
+    event_bus.publish(queue_id, {
+        'type': 'progress',
+        'percentage': 100,
+        'message': '命中重建缓存，直接返回已有结果',
+        'currentEpoch': 0,
+        'totalEpochs': 1
+    })
+    event_bus.publish(queue_id, {
+        'type': 'complete',
+        'result': result_data
+    })
+    return result_data
+
+
+def run_scheduled_job(job):
+    """调度器回调：执行一个已准入的重建任务"""
+    # 排队期间时间可能已接近TTL：开始时再刷新一次输入文件及其数据包、sigma缓存和分块
+    input_file = job.payload.get('input_file') if isinstance(job.payload, dict) else None
+    if input_file and os.path.isabs(input_file):
+        artifact_store.touch_upload(input_file)
+    try:
+        return run_neurcad_reconstruction(job.payload, job.job_id, job.work_dir)
+    finally:
+        # 任务结束时刷新目录时间，TTL从结束时刻开始计算
+        artifact_store.touch(job.work_dir)
+
+
+def on_artifacts_collected(expired_jobs, expired_uploads):
+    """产物被回收后同步清理内存中的任务记录和上传文件索引"""
+    for queue_id in expired_jobs:
+        scheduler.forget(queue_id)
+        event_bus.remove(queue_id)
+    expired_uploads = set(expired_uploads)
+    for file_id in [k for k, v in uploaded_files.items() if v['file_path'] in expired_uploads]:
+        del uploaded_files[file_id]
+
+
+artifact_store = ArtifactStore(ARTIFACTS_ROOT, ttl_seconds=ARTIFACT_TTL_SECONDS,
+                               gc_interval=ARTIFACT_GC_INTERVAL,
+                               is_active=lambda queue_id: scheduler.is_active(queue_id),
+                               on_collect=on_artifacts_collected,
+                               active_uploads=lambda: scheduler.active_inputs())
+
+scheduler = JobScheduler(run_scheduled_job, artifact_store.jobs_root, max_workers=MAX_CONCURRENT_JOBS,
+                         cpus_per_job=CPUS_PER_JOB, mem_per_job_gb=MEM_PER_JOB_GB,
+                         max_queue_size=MAX_QUEUE_SIZE)
+
+result_cache = None
+if USE_RESULT_CACHE:
+    result_cache = ResultCache(os.path.join(ARTIFACTS_ROOT, 'cache'), max_bytes=RESULT_CACHE_MAX_MB << 20,
+                               max_entries=RESULT_CACHE_MAX_ENTRIES)
+
+# 预热进程数与调度器并发数一致，保证每个运行中的任务都有空闲进程可用
+worker_pool = None
+if USE_WARM_WORKERS:
+    worker_pool = WarmWorkerPool(sys.executable,
+                                 os.path.join(NEURCAD_PATH, "surface_reconstruction", "reconstruction_worker.py"),
+                                 num_workers=scheduler.capacity, max_jobs_per_worker=MAX_JOBS_PER_WORKER)
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
@@ -327,8 +608,32 @@ def health_check():
         'status': 'ok',
         'python_path': sys.executable,
         'python_version': sys.version,
-        'neurcad_initialized': bool(output_queues),
-        'virtual_env': VIRTUAL_ENV_PATH
+        'neurcad_initialized': event_bus.stats()['channels'] > 0,
+        'virtual_env': VIRTUAL_ENV_PATH,
+        'scheduler': scheduler.stats(),
+        'worker_pool': worker_pool.stats() if worker_pool is not None else None,
+        'artifacts_root': artifact_store.root,
+        'events': event_bus.stats(),
+        'result_cache': result_cache.stats() if result_cache is not None else None,
+        'sse_port': SSE_PORT
+    })
+
+@app.route('/api/neurcad/job-status', methods=['GET'])
+def get_job_status():
+    """查询重建任务状态和排队位置"""
+    queue_id = request.args.get('queue_id')
+    job = scheduler.get(queue_id) if queue_id else None
+    if job is None:
+        return jsonify({
+            'success': False,
+            'error': f'任务 {queue_id} 不存在'
+        }), 404
+    
+    job_info = job.to_dict()
+    job_info['queue_position'] = scheduler.queue_position(queue_id)
+    return jsonify({
+        'success': True,
+        'job': job_info
     })
 
 @app.route('/api/upload-pointcloud', methods=['POST'])
@@ -358,22 +663,19 @@ def upload_pointcloud():
         # 生成唯一文件ID
         file_id = str(uuid.uuid4())
         
-        # 获取NeurCAD目录
-        neurcad_dir = os.path.join(os.path.dirname(__file__), "NeurCADRecon-main", "NeurCADRecon-main")
-        
-        # 保存文件到NeurCAD目录，使用简洁的文件名
-        filename = 'input_pld.ply'  # 固定文件名，覆盖之前的文件
-        file_path = os.path.join(neurcad_dir, filename)
+        # 按内容寻址保存文件，相同内容复用同一份，不同上传互不覆盖
+        ext = os.path.splitext(file.filename)[1].lower() or '.ply'
+        digest, file_path = artifact_store.put_upload(file.stream, ext=ext)
+        filename = os.path.basename(file_path)
         
         print(f"保存文件到: {file_path}")
         
-        # 保存文件
-        file.save(file_path)
-        
         # 检查文件是否保存成功
         if os.path.exists(file_path):
             file_size = os.path.getsize(file_path)
             print(f"文件保存成功，大小: {file_size} 字节")
+            if PREPROCESS_UPLOADS:
+                preprocess_upload(file_path, digest)
             
             # 存储文件信息
             uploaded_files[file_id] = {
@@ -381,6 +683,7 @@ def upload_pointcloud():
                 'original_name': file.filename,
                 'file_path': file_path,
                 'file_size': file_size,
+                'sha256': digest,
                 'upload_time': time.time()
             }
             
@@ -389,6 +692,7 @@ def upload_pointcloud():
                 'file_id': file_id,
                 'filename': filename,
                 'file_size': file_size,
+                'sha256': digest,
                 'message': '文件上传成功'
             })
         else:
@@ -457,29 +761,73 @@ def execute_local_reconstruction():
         # 解析配置
         config_data = json.loads(config_content)
         
-        # 设置输入文件路径
+        # 设置输入文件路径（内容寻址存储中的绝对路径）
         if file_id and file_id in uploaded_files:
-            config_data['input_file'] = uploaded_files[file_id]['filename']
+            config_data['input_file'] = uploaded_files[file_id]['file_path']
+            artifact_store.touch_upload(config_data['input_file'])
             print(f"使用上传文件: {config_data['input_file']}")
         else:
             config_data['input_file'] = 'input_pld.ply'
             print(f"使用默认文件: {config_data['input_file']}")
         
-        # 生成唯一的队列ID
-        queue_id = f"reconstruction_{int(time.time())}"
+        # 输入点云的内容哈希，上传文件在保存时已计算
+        if file_id:
+            config_data['input_sha256'] = uploaded_files[file_id]['sha256']
+        elif os.path.exists(resolve_input_file(config_data)):
+            config_data['input_sha256'] = artifact_store.file_sha256(resolve_input_file(config_data))
         
-        # 在后台线程中启动重建
-        thread = threading.Thread(
-            target=run_neurcad_reconstruction,
-            args=(config_data, queue_id)
-        )
-        thread.daemon = True
-        thread.start()
+        # 生成唯一的队列ID（同一秒内的多个请求也不会冲突）
+        queue_id = f"reconstruction_{int(time.time())}_{uuid.uuid4().hex[:8]}"
+        priority = int(data.get('priority', 0))
+        
+        # 相同点云+相同参数已重建过：直接返回缓存结果，不再排队训练
+        if result_cache is not None and config_data.get('input_sha256'):
+            cache_key = ResultCache.make_key(config_data['input_sha256'], build_train_config(config_data))
+            entry = result_cache.get(cache_key)
+            if entry is not None:
+                print(f"命中重建缓存: {cache_key}")
+                result_data = serve_cached_result(queue_id, config_data, entry)
+                return jsonify({
+                    'success': True,
+                    'queue_id': queue_id,
+                    'queue_position': 0,
+                    'cache_hit': True,
+                    'result': result_data,
+                    'stream_url': f'http://{request.host.split(":")[0]}:{SSE_PORT}/api/neurcad/stream-output?queue_id={queue_id}',
+                    'message': '命中重建缓存',
+                    'input_file': config_data['input_file']
+                })
+        
+        # 先创建事件频道，排队期间前端即可订阅SSE
+        event_bus.open(queue_id)
+        
+        # 提交到调度器，由工作池按优先级和资源情况执行，任务目录由产物存储分配
+        try:
+            scheduler.submit(queue_id, config_data, priority=priority)
+        except queue.Full as e:
+            event_bus.remove(queue_id)
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 503
+        
+        queue_position = scheduler.queue_position(queue_id)
+        if queue_position > 0:
+            event_bus.publish(queue_id, {
+                'type': 'progress',
+                'percentage': 0,
+                'message': f'排队中... 前方还有 {queue_position - 1} 个任务',
+                'currentEpoch': 0,
+                'totalEpochs': 1
+            })
         
         return jsonify({
             'success': True,
             'queue_id': queue_id,
-            'message': '重建已启动',
+            'queue_position': queue_position,
+            'cache_hit': False,
+            'stream_url': f'http://{request.host.split(":")[0]}:{SSE_PORT}/api/neurcad/stream-output?queue_id={queue_id}',
+            'message': '重建已加入队列',
             'input_file': config_data['input_file']
         })
         
@@ -494,71 +842,72 @@ def execute_local_reconstruction():
 
 @app.route('/api/neurcad/stream-output')
 def stream_output():
-    """SSE流式输出"""
+    """SSE流式输出（兼容接口，每个连接占用一个Flask线程；大量订阅者请使用异步SSE端口）"""
     queue_id = request.args.get('queue_id')  # 在request context有效时获取
-    print(f"SSE流请求，queue_id: {queue_id}")
+    last_id = parse_last_event_id(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    print(f"SSE流请求，queue_id: {queue_id}, last_event_id: {last_id}")
     
-    def generate(queue_id):
+    def generate(queue_id, last_id):
         if not queue_id:
             print("SSE流错误: 未提供queue_id")
-            yield f"data: {json.dumps({'type': 'error', 'error': 'Queue ID not provided'})}\n\n"
+            yield format_sse({'type': 'error', 'error': 'Queue ID not provided'})
             return
             
-        if queue_id not in output_queues:
-            print(f"SSE流错误: 队列 {queue_id} 不存在")
-            yield f"data: {json.dumps({'type': 'error', 'error': f'Queue {queue_id} not found'})}\n\n"
+        if event_bus.get(queue_id) is None:
+            print(f"SSE流错误: 事件频道 {queue_id} 不存在")
+            yield format_sse({'type': 'error', 'error': f'Queue {queue_id} not found'})
             return
 
-        q = output_queues[queue_id]
         print(f"开始SSE流，队列ID: {queue_id}")
 
         try:
             while True:
-                try:
-                    data = q.get(timeout=1)
-                    print(f"SSE发送数据: {data.get('type', 'unknown')}")
-                    yield f"data: {json.dumps(data)}\n\n"
-                    
-                    if data.get('type') in ['complete', 'error']:
-                        print(f"重建完成，结束SSE流: {queue_id}")
-                        # 延迟清理，确保前端收到
-                        import time
-                        time.sleep(2)
-                        if queue_id in output_queues:
-                            del output_queues[queue_id]
-                            print(f"已清理队列: {queue_id}")
-                        break
-                except queue.Empty:
+                events, closed = event_bus.wait(queue_id, last_id, timeout=15)
+                for event_id, data in events:
+                    yield format_sse(data, event_id)
+                    last_id = event_id
+                if closed:
+                    print(f"重建结束，关闭SSE流: {queue_id}")
+                    break
+                if not events:
                     # 发送心跳保持连接
-                    yield f"data: {json.dumps({'type': 'heartbeat'})}\n\n"
+                    yield format_sse({'type': 'heartbeat'})
         except Exception as e:
             print(f"SSE流错误: {e}")
-            yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+            yield format_sse({'type': 'error', 'error': str(e)})
         finally:
             print(f"SSE流结束: {queue_id}")
 
     return Response(
-        generate(queue_id), 
+        generate(queue_id, last_id), 
         mimetype='text/event-stream',
         headers={
             'Cache-Control': 'no-cache',
             'Connection': 'keep-alive',
             'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Headers': 'Cache-Control'
+            'Access-Control-Allow-Headers': 'Cache-Control, Last-Event-ID'
         }
     )
 
+def resolve_result_mesh_path(queue_id=None):
+    """根据队列ID查找任务的重建结果文件，未指定时返回旧版固定路径"""
+    if queue_id:
+        job = scheduler.get(queue_id)
+        if job is None or not job.result:
+            return None
+        # 访问结果时刷新任务目录的TTL
+        artifact_store.touch(job.work_dir)
+        return job.result.get('mesh_file_path')
+    return os.path.join(NEURCAD_PATH, 'reconstruction_results', 'input_pld', 'result_meshes', 'input_pld.ply')
+
 @app.route('/api/neurcad/get-mesh-data', methods=['GET'])
 def get_mesh_data():
     """获取重建的网格数据"""
     try:
-        # 获取NeurCAD目录
-        neurcad_dir = os.path.join(os.path.dirname(__file__), "NeurCADRecon-main", "NeurCADRecon-main")
+        # 查找重建结果文件（按队列ID定位任务目录）
+        result_mesh_path = resolve_result_mesh_path(request.args.get('queue_id'))
         
-        # 查找最新的重建结果文件（使用绝对路径）
-        result_mesh_path = os.path.join(neurcad_dir, 'reconstruction_results', 'input_pld', 'result_meshes', 'input_pld.ply')
-        
-        if not os.path.exists(result_mesh_path):
+        if not result_mesh_path or not os.path.exists(result_mesh_path):
             return jsonify({
                 'success': False,
                 'error': '重建结果文件不存在'
@@ -566,35 +915,18 @@ def get_mesh_data():
         
         print(f"读取网格文件: {result_mesh_path}")
         
-        # 读取PLY文件
-        import numpy as np
-        from plyfile import PlyData
-        
-        plydata = PlyData.read(result_mesh_path)
+        # 用NumPy整块读取PLY，不逐顶点构造Python对象
+        vertices, faces = read_triangle_mesh(result_mesh_path)
         
-        # 提取顶点数据
-        vertices = []
-        if 'vertex' in plydata:
-            for vertex in plydata['vertex']:
-                vertices.extend([float(vertex['x']), float(vertex['y']), float(vertex['z'])])
-        
-        # 提取面数据
-        faces = []
-        if 'face' in plydata:
-            for face in plydata['face']:
-                # face 是一个tuple，face[0]是索引数组
-                face_vertices = face[0]
-                faces.extend([int(idx) for idx in face_vertices[:3]])  # 转换为int类型
-        
-        print(f"提取到 {len(vertices)//3} 个顶点, {len(faces)//3} 个面")
+        print(f"提取到 {len(vertices)} 个顶点, {len(faces)} 个面")
         
         return jsonify({
             'success': True,
             'mesh_data': {
-                'vertices': vertices,
-                'faces': faces,
-                'vertex_count': len(vertices) // 3,
-                'face_count': len(faces) // 3
+                'vertices': vertices.ravel().tolist(),
+                'faces': faces.ravel().tolist(),
+                'vertex_count': len(vertices),
+                'face_count': len(faces)
             }
         })
         
@@ -607,20 +939,70 @@ def get_mesh_data():
             'error': str(e)
         }), 500
 
+@app.route('/api/neurcad/get-mesh-binary', methods=['GET'])
+def get_mesh_binary():
+    """以小端序二进制返回重建网格: uint32顶点数, uint32面数, float32顶点, uint32三角面索引"""
+    try:
+        result_mesh_path = resolve_result_mesh_path(request.args.get('queue_id'))
+        
+        if not result_mesh_path or not os.path.exists(result_mesh_path):
+            return jsonify({
+                'success': False,
+                'error': '重建结果文件不存在'
+            }), 404
+        
+        vertices, faces = read_triangle_mesh(result_mesh_path)
+        payload = encode_mesh_binary(vertices, faces)
+        print(f"发送二进制网格: {len(vertices)} 个顶点, {len(faces)} 个面, {len(payload)} 字节")
+        
+        return Response(
+            payload,
+            mimetype='application/octet-stream',
+            headers={
+                'X-Vertex-Count': str(len(vertices)),
+                'X-Face-Count': str(len(faces)),
+                'Access-Control-Expose-Headers': 'X-Vertex-Count, X-Face-Count'
+            }
+        )
+        
+    except Exception as e:
+        print(f"读取二进制网格时发生错误: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/neurcad/download-model', methods=['GET'])
+def download_model():
+    """下载任务训练得到的网络权重"""
+    queue_id = request.args.get('queue_id')
+    job = scheduler.get(queue_id) if queue_id else None
+    model_path = job.result.get('model_file_path') if job is not None and job.result else None
+    if not model_path or not os.path.exists(model_path):
+        return jsonify({
+            'success': False,
+            'error': '模型权重文件不存在'
+        }), 404
+    artifact_store.touch(job.work_dir)
+    return send_file(
+        model_path,
+        as_attachment=True,
+        download_name='model.pth',
+        mimetype='application/octet-stream'
+    )
+
 @app.route('/api/neurcad/download-result', methods=['GET'])
 def download_reconstruction_result():
     """下载重建结果文件"""
     try:
-        # 获取NeurCAD目录
-        neurcad_dir = os.path.join(os.path.dirname(__file__), "NeurCADRecon-main", "NeurCADRecon-main")
-        
-        # 重建结果文件路径
-        result_mesh_path = os.path.join(neurcad_dir, 'reconstruction_results', 'input_pld', 'result_meshes', 'input_pld.ply')
+        # 重建结果文件路径（按队列ID定位任务目录）
+        result_mesh_path = resolve_result_mesh_path(request.args.get('queue_id'))
         
         print(f"请求下载重建结果文件: {result_mesh_path}")
-        print(f"文件是否存在: {os.path.exists(result_mesh_path)}")
         
-        if not os.path.exists(result_mesh_path):
+        if not result_mesh_path or not os.path.exists(result_mesh_path):
             return jsonify({
                 'success': False,
                 'error': '重建结果文件不存在'
@@ -650,5 +1032,8 @@ if __name__ == '__main__':
     print(f"虚拟环境: {VIRTUAL_ENV_PATH}")
     print(f"NeurCAD路径: {NEURCAD_PATH}")
     
-    # 启动服务器
-    app.run(host='0.0.0.0', port=5001, debug=True) 
\ No newline at end of file
+    # 事件流由独立的asyncio服务器提供，空闲连接不占用Flask线程
+    SSEServer(event_bus, port=SSE_PORT).start()
+    
+    # 启动服务器（关闭重载器，否则会重复创建调度器和预热进程）
+    app.run(host='0.0.0.0', port=5001, debug=True, use_reloader=False) 
\ No newline at end of file
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+NeurCADRecon 任务事件总线
+每个任务一个有界环形缓冲区，事件带单调递增的ID：
+- 任意多个订阅者各自按ID读取，互不抢占消息
+- 断线重连时按 Last-Event-ID 补发缓冲区中的后续事件
+- 任务结束后频道保留一段时间，迟到的订阅者仍能收到完成事件
+同时提供基于asyncio的SSE服务器，空闲连接不占用Flask工作线程。
+"""
+
+import json
+import time
+import asyncio
+import threading
+import collections
+from urllib.parse import urlsplit, parse_qs
+
+TERMINAL_EVENT_TYPES = ('complete', 'error')
+
+
+class EventChannel:
+    """单个任务的事件频道"""
+
+    def __init__(self, buffer_size):
+        self.events = collections.deque(maxlen=buffer_size)  # (event_id, event)
+        self.next_id = 1
+        self.closed_time = None
+        self.condition = threading.Condition()
+        self.async_waiters = set()  # (loop, future)
+
+    @property
+    def closed(self):
+        return self.closed_time is not None
+
+    def since(self, last_id):
+        """返回ID大于last_id的事件；缓冲区已丢弃的部分无法补发"""
+        return [(event_id, event) for event_id, event in self.events if event_id > last_id]
+
+
+def _wake_future(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class EventBus:
+    """
+    发布/订阅事件总线
+    - publish 由工作线程调用，唤醒同步订阅者(Condition)和asyncio订阅者(future)
+    - 已结束的频道保留 retention_seconds 秒后在下一次创建频道时清理
+    """
+
+    def __init__(self, buffer_size=1000, retention_seconds=600):
+        self.buffer_size = buffer_size
+        self.retention_seconds = retention_seconds
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def open(self, job_id):
+        """创建任务频道（已存在时直接返回）"""
+        with self._lock:
+            self._prune()
+            channel = self._channels.get(job_id)
+            if channel is None:
+                channel = EventChannel(self.buffer_size)
+                self._channels[job_id] = channel
+            return channel
+
+    def get(self, job_id):
+        return self._channels.get(job_id)
+
+    def remove(self, job_id):
+        with self._lock:
+            channel = self._channels.pop(job_id, None)
+        if channel is not None:
+            self._notify(channel)
+
+    def publish(self, job_id, event):
+        """发布事件，返回事件ID；频道不存在或已结束时返回None"""
+        channel = self._channels.get(job_id)
+        if channel is None or channel.closed:
+            return None
+        with channel.condition:
+            event_id = channel.next_id
+            channel.next_id += 1
+            channel.events.append((event_id, event))
+            if event.get('type') in TERMINAL_EVENT_TYPES:
+                channel.closed_time = time.time()
+        self._notify(channel)
+        return event_id
+
+    def wait(self, job_id, last_id, timeout=None):
+        """同步订阅：阻塞到有新事件或超时，返回 (事件列表, 频道是否已结束)"""
+        channel = self._channels.get(job_id)
+        if channel is None:
+            return [], True
+        with channel.condition:
+            channel.condition.wait_for(lambda: channel.closed or channel.next_id - 1 > last_id, timeout=timeout)
+            return channel.since(last_id), channel.closed
+
+    async def wait_async(self, job_id, last_id, timeout=None):
+        """asyncio订阅：语义同 wait，等待期间不占用线程"""
+        channel = self._channels.get(job_id)
+        if channel is None:
+            return [], True
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with channel.condition:
+            events = channel.since(last_id)
+            if events or channel.closed:
+                return events, channel.closed
+            channel.async_waiters.add(waiter)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with channel.condition:
+                channel.async_waiters.discard(waiter)
+        with channel.condition:
+            return channel.since(last_id), channel.closed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'channels': len(self._channels),
+                'open': sum(1 for channel in self._channels.values() if not channel.closed),
+                'subscribers': sum(len(channel.async_waiters) for channel in self._channels.values())
+            }
+
+    def _notify(self, channel):
+        with channel.condition:
+            channel.condition.notify_all()
+            waiters = list(channel.async_waiters)
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake_future, future)
+
+    def _prune(self):
+        now = time.time()
+        expired = [job_id for job_id, channel in self._channels.items()
+                   if channel.closed and now - channel.closed_time > self.retention_seconds]
+        for job_id in expired:
+            del self._channels[job_id]
+
+
+def format_sse(event, event_id=None):
+    """编码为一条SSE消息，带id时浏览器会在重连时通过Last-Event-ID回传"""
+    prefix = f"id: {event_id}\n" if event_id is not None else ''
+    return f"{prefix}data: {json.dumps(event)}\n\n"
+
+
+def parse_last_event_id(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+class SSEServer:
+    """
+    基于asyncio的轻量SSE服务器，只提供 GET /api/neurcad/stream-output
+    所有连接在一个事件循环线程中处理，数百个空闲的心跳连接只占用socket，不占用线程
+    """
+
+    PATH = '/api/neurcad/stream-output'
+
+    def __init__(self, event_bus, host='0.0.0.0', port=5002, heartbeat_interval=15.0, retry_ms=3000):
+        self.event_bus = event_bus
+        self.host = host
+        self.port = port
+        self.heartbeat_interval = heartbeat_interval
+        self.retry_ms = retry_ms
+        self._thread = None
+
+    def start(self):
+        """在后台线程中运行事件循环"""
+        self._thread = threading.Thread(target=self._run, name='neurcad-sse')
+        self._thread.daemon = True
+        self._thread.start()
+        print(f"SSE服务器已启动: http://{self.host}:{self.port}{self.PATH}")
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+        try:
+            loop.run_forever()
+        finally:
+            server.close()
+            loop.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if not line or line in (b'\r\n', b'\n'):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            if len(request_line) < 2:
+                return
+            method, target = request_line[0], request_line[1]
+            url = urlsplit(target)
+            if method == 'OPTIONS':
+                self._write_head(writer, '204 No Content')
+            elif method != 'GET' or url.path != self.PATH:
+                self._write_head(writer, '404 Not Found')
+            else:
+                query = parse_qs(url.query)
+                queue_id = query.get('queue_id', [None])[0]
+                last_id = parse_last_event_id(headers.get('last-event-id') or query.get('last_event_id', [None])[0])
+                await self._stream(writer, queue_id, last_id)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _write_head(self, writer, status, content_type=None):
+        lines = [f'HTTP/1.1 {status}',
+                 'Access-Control-Allow-Origin: *',
+                 'Access-Control-Allow-Headers: Cache-Control, Last-Event-ID',
+                 'Cache-Control: no-cache']
+        if content_type:
+            lines.append(f'Content-Type: {content_type}')
+            lines.append('Connection: keep-alive')
+        else:
+            lines.append('Content-Length: 0')
+            lines.append('Connection: close')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    async def _stream(self, writer, queue_id, last_id):
+        channel = self.event_bus.get(queue_id) if queue_id else None
+        if channel is not None and channel.closed and not channel.since(last_id):
+            # 已收到全部事件后的自动重连：204让EventSource停止重连
+            self._write_head(writer, '204 No Content')
+            return
+
+        self._write_head(writer, '200 OK', content_type='text/event-stream')
+        writer.write(f"retry: {self.retry_ms}\n\n".encode('utf-8'))
+        if channel is None:
+            error = 'Queue ID not provided' if not queue_id else f'Queue {queue_id} not found'
+            writer.write(format_sse({'type': 'error', 'error': error}).encode('utf-8'))
+            return
+
+        while True:
+            events, closed = await self.event_bus.wait_async(queue_id, last_id, timeout=self.heartbeat_interval)
+            for event_id, event in events:
+                writer.write(format_sse(event, event_id).encode('utf-8'))
+                last_id = event_id
+            if not events and not closed:
+                writer.write(format_sse({'type': 'heartbeat'}).encode('utf-8'))
+            await writer.drain()
+            if closed:
+                return
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+NeurCADRecon 网格读取与二进制编码
+直接用NumPy按PLY头部描述的结构化dtype整块读取顶点和三角面，不逐元素循环
+"""
+
+import struct
+
+import numpy as np
+
+PLY_DTYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'
+}
+
+# 二进制网格格式: uint32 顶点数, uint32 面数, float32[顶点数*3] 顶点, uint32[面数*3] 三角面索引，均为小端序
+MESH_BINARY_HEADER = struct.Struct('<II')
+
+
+def read_ply_header(f):
+    """解析PLY头部，返回 (格式, 元素列表)，元素为 (名称, 数量, 属性列表)"""
+    if f.readline().strip() != b'ply':
+        raise ValueError('不是PLY文件')
+    fmt = None
+    elements = []
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError('PLY头部不完整')
+        tokens = line.decode('ascii', errors='replace').split()
+        if not tokens:
+            continue
+        if tokens[0] == 'format':
+            fmt = tokens[1]
+        elif tokens[0] == 'element':
+            elements.append((tokens[1], int(tokens[2]), []))
+        elif tokens[0] == 'property':
+            if tokens[1] == 'list':
+                # ('list', 计数类型, 元素类型, 名称)
+                elements[-1][2].append(('list', PLY_DTYPES[tokens[2]], PLY_DTYPES[tokens[3]], tokens[4]))
+            else:
+                elements[-1][2].append((tokens[2], PLY_DTYPES[tokens[1]]))
+        elif tokens[0] == 'end_header':
+            return fmt, elements
+
+
+def read_ply_element_counts(path):
+    """只读取头部，返回 {元素名: 数量}"""
+    with open(path, 'rb') as f:
+        _, elements = read_ply_header(f)
+    return {name: count for name, count, _ in elements}
+
+
+def _read_binary_triangle_mesh(f, fmt, elements):
+    endian = '<' if fmt == 'binary_little_endian' else '>'
+    vertices = np.zeros((0, 3), dtype=np.float32)
+    faces = np.zeros((0, 3), dtype=np.uint32)
+    for name, count, props in elements:
+        if all(prop[0] != 'list' for prop in props):
+            data = np.fromfile(f, dtype=np.dtype([(p[0], endian + p[1]) for p in props]), count=count)
+            if name == 'vertex':
+                vertices = np.stack([data['x'], data['y'], data['z']], axis=-1).astype(np.float32)
+        elif name == 'face' and len(props) == 1:
+            _, count_dtype, index_dtype, _ = props[0]
+            data = np.fromfile(f, dtype=np.dtype([('n', endian + count_dtype), ('idx', endian + index_dtype, 3)]),
+                               count=count)
+            if len(data) != count or np.any(data['n'] != 3):
+                raise ValueError('面片不全是三角形')
+            faces = data['idx'].astype(np.uint32)
+        else:
+            raise ValueError(f'不支持的PLY元素: {name}')
+    return vertices, faces
+
+
+def read_triangle_mesh(path):
+    """读取PLY三角网格，返回 (float32 顶点 (N, 3), uint32 三角面 (M, 3))"""
+    with open(path, 'rb') as f:
+        fmt, elements = read_ply_header(f)
+        if fmt in ('binary_little_endian', 'binary_big_endian'):
+            try:
+                return _read_binary_triangle_mesh(f, fmt, elements)
+            except ValueError:
+                pass
+
+    # ASCII或非三角面：退回plyfile，仍然按整列读取
+    from plyfile import PlyData
+    plydata = PlyData.read(path)
+    vertex = plydata['vertex'].data
+    vertices = np.stack([vertex['x'], vertex['y'], vertex['z']], axis=-1).astype(np.float32)
+    faces = np.zeros((0, 3), dtype=np.uint32)
+    if 'face' in plydata and len(plydata['face'].data) > 0:
+        face_data = plydata['face'].data
+        index_lists = face_data[face_data.dtype.names[0]]
+        try:
+            faces = np.vstack(index_lists)[:, :3].astype(np.uint32)
+        except ValueError:
+            # 混合多边形：只取每个面的前三个索引，与旧接口一致
+            faces = np.stack([np.asarray(idx[:3]) for idx in index_lists]).astype(np.uint32)
+    return vertices, faces
+
+
+def encode_mesh_binary(vertices, faces):
+    """编码为小端序二进制: 头部(顶点数, 面数) + float32顶点 + uint32面索引"""
+    vertices = np.ascontiguousarray(vertices, dtype='<f4')
+    faces = np.ascontiguousarray(faces, dtype='<u4')
+    return MESH_BINARY_HEADER.pack(len(vertices), len(faces)) + vertices.tobytes() + faces.tobytes()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+NeurCADRecon 重建结果缓存
+以 输入点云SHA256 + 规范化训练参数 为键，保存结果网格、训练好的权重和结果摘要。
+相同点云、相同参数的重复提交直接返回缓存结果，不再重新训练。
+缓存按最近使用时间(LRU)淘汰，总大小不超过 max_bytes，条目数不超过 max_entries。
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+# 文件路径、输入哈希(已单独计入缓存键)和只影响日志/进度上报的参数，不参与缓存键
+RUNTIME_ONLY_KEYS = ('data_path', 'data_sha256', 'progress_file', 'progress_interval', 'log_interval', 'checkpoint_library')
+
+MESH_FILENAME = 'mesh.ply'
+MODEL_FILENAME = 'model.pth'
+META_FILENAME = 'meta.json'
+
+
+def _normalise(value):
+    # 数值统一为float，避免 1e4 / 10000 / "10000" 产生不同的键
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, (list, tuple)):
+        return [_normalise(v) for v in value]
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    return value
+
+
+def _link_or_copy(src, dst):
+    """同一文件系统上用硬链接，避免复制大文件"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _dir_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+
+class ResultCache:
+
+    def __init__(self, root, max_bytes=2 << 30, max_entries=256):
+        """
+        :param root: 缓存根目录，每个条目一个子目录
+        :param max_bytes: 缓存总大小上限
+        :param max_entries: 条目数上限
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def make_key(input_sha256, train_config):
+        """缓存键: SHA256(输入点云哈希 + 排序后的规范化训练参数)"""
+        params = {k: _normalise(v) for k, v in train_config.items() if k not in RUNTIME_ONLY_KEYS}
+        payload = json.dumps({'input': input_sha256, 'params': params}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        """命中时返回 {'mesh_path', 'model_path', 'meta'} 并刷新LRU时间，未命中返回None"""
+        path = self.entry_dir(key)
+        meta_path = os.path.join(path, META_FILENAME)
+        with self._lock:
+            if not os.path.exists(meta_path):
+                return None
+            try:
+                with open(meta_path, 'r') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                return None
+            os.utime(path, None)
+        model_path = os.path.join(path, MODEL_FILENAME)
+        return {
+            'mesh_path': os.path.join(path, MESH_FILENAME),
+            'model_path': model_path if os.path.exists(model_path) else None,
+            'meta': meta
+        }
+
+    def put(self, key, mesh_path, model_path=None, meta=None):
+        """写入一个条目：先在临时目录中组装，再原子地重命名到位，最后按LRU淘汰"""
+        tmp_dir = tempfile.mkdtemp(dir=self.root, prefix='.tmp-')
+        try:
+            _link_or_copy(mesh_path, os.path.join(tmp_dir, MESH_FILENAME))
+            if model_path and os.path.exists(model_path):
+                _link_or_copy(model_path, os.path.join(tmp_dir, MODEL_FILENAME))
+            with open(os.path.join(tmp_dir, META_FILENAME), 'w') as f:
+                json.dump(dict(meta or {}, cached_time=time.time()), f)
+            with self._lock:
+                path = self.entry_dir(key)
+                if os.path.exists(path):
+                    # 并发的相同任务已经写入，保留先写入的条目
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                else:
+                    os.rename(tmp_dir, path)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        self.evict()
+
+    def evict(self):
+        """按最近使用时间从旧到新删除条目，直到满足大小和数量上限；返回被删除的键"""
+        with self._lock:
+            entries = []
+            for key in os.listdir(self.root):
+                path = self.entry_dir(key)
+                if key.startswith('.') or not os.path.isdir(path):
+                    continue
+                entries.append((os.path.getmtime(path), _dir_size(path), key))
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            evicted = []
+            while entries and (total > self.max_bytes or len(entries) > self.max_entries):
+                _, size, key = entries.pop(0)
+                shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+                total -= size
+                evicted.append(key)
+        if evicted:
+            print(f"结果缓存淘汰 {len(evicted)} 个条目，当前 {len(entries)} 个 / {total / (1 << 20):.1f} MB")
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            keys = [key for key in os.listdir(self.root)
+                    if not key.startswith('.') and os.path.isdir(self.entry_dir(key))]
+            return {
+                'entries': len(keys),
+                'size_mb': round(sum(_dir_size(self.entry_dir(key)) for key in keys) / (1 << 20), 2),
+                'max_mb': round(self.max_bytes / (1 << 20), 2),
+                'max_entries': self.max_entries
+            }
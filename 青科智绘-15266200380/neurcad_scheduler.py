@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+NeurCADRecon 重建任务调度器
+固定大小的工作线程池 + 优先级FIFO队列 + 基于CPU核数/可用内存的准入控制
+"""
+
+import os
+import time
+import queue
+import threading
+import itertools
+import traceback
+
+
+def get_available_memory_gb():
+    """读取系统当前可用内存(GB)，优先使用/proc/meminfo中的MemAvailable"""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / (1024.0 ** 2)
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / (1024.0 ** 3)
+    except (ValueError, OSError, AttributeError):
+        return float('inf')
+
+
+class Job:
+    """单个重建任务的状态记录"""
+
+    def __init__(self, job_id, payload, priority, work_dir):
+        self.job_id = job_id
+        self.payload = payload
+        self.priority = priority
+        self.work_dir = work_dir
+        self.status = 'queued'  # queued | running | finished | failed
+        self.submit_time = time.time()
+        self.seq = None  # 入队序号，与优先级一起决定出队顺序
+        self.start_time = None
+        self.end_time = None
+        self.result = None
+        self.error = None
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'priority': self.priority,
+            'status': self.status,
+            'work_dir': self.work_dir,
+            'submit_time': self.submit_time,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'error': self.error
+        }
+
+
+class JobScheduler:
+    """
+    有界工作池调度器
+    - 优先级数值越小越先执行，同优先级按提交顺序(FIFO)执行
+    - 同时运行的任务数不超过 min(max_workers, CPU核数 // cpus_per_job)
+    - 启动任务前检查可用内存是否满足 mem_per_job_gb，不足时等待其他任务释放
+    - 每个任务拥有独立的工作目录，任务之间不共享CWD和临时文件
+    """
+
+    def __init__(self, runner, jobs_root, max_workers=2, cpus_per_job=4, mem_per_job_gb=4.0,
+                 max_queue_size=64, memory_poll_interval=2.0):
+        self.runner = runner
+        self.jobs_root = jobs_root
+        self.cpus_per_job = max(1, cpus_per_job)
+        self.mem_per_job_gb = mem_per_job_gb
+        self.max_queue_size = max_queue_size
+        self.memory_poll_interval = memory_poll_interval
+
+        cpu_count = os.cpu_count() or 1
+        self.capacity = max(1, min(max_workers, cpu_count // self.cpus_per_job))
+
+        self.jobs = {}
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._admission = threading.Condition(self._lock)
+        self._running = 0
+
+        os.makedirs(self.jobs_root, exist_ok=True)
+        self._workers = []
+        for i in range(self.capacity):
+            worker = threading.Thread(target=self._worker_loop, name=f'neurcad-worker-{i}')
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        print(f"调度器已启动: {self.capacity} 个工作线程, 每任务 {self.cpus_per_job} 核 / {self.mem_per_job_gb} GB")
+
+    def submit(self, job_id, payload, priority=0):
+        """提交任务，队列已满时抛出 queue.Full"""
+        with self._lock:
+            if self.queued_count() >= self.max_queue_size:
+                raise queue.Full(f'重建队列已满 ({self.max_queue_size})')
+            work_dir = os.path.join(self.jobs_root, job_id)
+            os.makedirs(work_dir, exist_ok=True)
+            job = Job(job_id, payload, priority, work_dir)
+            job.seq = next(self._counter)
+            self.jobs[job_id] = job
+            self._queue.put((priority, job.seq, job_id))
+        return job
+
+    def add_finished(self, job_id, payload, result, work_dir):
+        """登记一个无需执行、已有结果的任务（例如命中结果缓存），使状态查询和结果接口对其一致可用"""
+        with self._lock:
+            job = Job(job_id, payload, 0, work_dir)
+            job.status = 'finished'
+            job.start_time = job.end_time = job.submit_time
+            job.result = result
+            self.jobs[job_id] = job
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def is_active(self, job_id):
+        """任务仍在排队或运行中"""
+        job = self.jobs.get(job_id)
+        return job is not None and job.status in ('queued', 'running')
+
+    def active_inputs(self):
+        """排队/运行中任务引用的输入文件路径"""
+        with self._lock:
+            return set(job.payload.get('input_file') for job in self.jobs.values()
+                       if job.status in ('queued', 'running') and isinstance(job.payload, dict)
+                       and job.payload.get('input_file'))
+
+    def forget(self, job_id):
+        """移除已结束任务的记录（工作目录被回收后调用）"""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job.status not in ('queued', 'running'):
+                del self.jobs[job_id]
+
+    def queued_count(self):
+        return sum(1 for job in self.jobs.values() if job.status == 'queued')
+
+    def queue_position(self, job_id):
+        """返回任务在等待队列中的位置(从1开始)，不在队列中时返回0"""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status != 'queued':
+                return 0
+            # 与队列相同的 (priority, seq) 排序，同一时钟刻度内提交的任务也有各自的位置
+            ahead = [j for j in self.jobs.values() if j.status == 'queued' and
+                     (j.priority, j.seq) < (job.priority, job.seq)]
+            return len(ahead) + 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'capacity': self.capacity,
+                'running': self._running,
+                'queued': self.queued_count(),
+                'cpus_per_job': self.cpus_per_job,
+                'mem_per_job_gb': self.mem_per_job_gb,
+                'available_memory_gb': round(get_available_memory_gb(), 2)
+            }
+
+    def _admit(self):
+        """阻塞直到内存满足要求；没有正在运行的任务时总是放行，避免永久等待"""
+        with self._admission:
+            while self._running > 0 and get_available_memory_gb() < self.mem_per_job_gb:
+                self._admission.wait(timeout=self.memory_poll_interval)
+            self._running += 1
+
+    def _release(self):
+        with self._admission:
+            self._running -= 1
+            self._admission.notify_all()
+
+    def _worker_loop(self):
+        while True:
+            _, _, job_id = self._queue.get()
+            job = self.jobs.get(job_id)
+            if job is None:
+                continue
+            self._admit()
+            job.status = 'running'
+            job.start_time = time.time()
+            try:
+                job.result = self.runner(job)
+                job.status = 'finished'
+            except Exception as e:
+                print(f"任务 {job_id} 执行失败: {e}")
+                traceback.print_exc()
+                job.error = str(e)
+                job.status = 'failed'
+            finally:
+                job.end_time = time.time()
+                self._release()
+                self._queue.task_done()
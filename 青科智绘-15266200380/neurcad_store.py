@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+NeurCADRecon 任务/产物存储
+- 上传的点云按内容SHA256寻址保存，相同内容只存一份，不同上传互不覆盖
+- 每个重建任务拥有独立的结果目录
+- 后台线程按TTL回收过期的上传文件和任务目录
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import traceback
+
+
+class ArtifactStore:
+
+    def __init__(self, root, ttl_seconds=24 * 3600, gc_interval=600, is_active=None, on_collect=None,
+                 active_uploads=None):
+        """
+        :param root: 存储根目录
+        :param ttl_seconds: 产物最后一次访问后的保留时间
+        :param gc_interval: 后台回收的间隔(秒)，<=0 时不启动后台线程
+        :param is_active: 回调 is_active(queue_id) -> bool，正在排队/运行的任务不会被回收
+        :param on_collect: 回调 on_collect(expired_jobs, expired_uploads)，用于同步清理内存中的索引
+        :param active_uploads: 回调 active_uploads() -> 上传文件路径集合，被排队/运行任务引用的上传文件不会被回收
+        """
+        self.root = root
+        self.uploads_root = os.path.join(root, 'uploads')
+        self.jobs_root = os.path.join(root, 'jobs')
+        self.ttl_seconds = ttl_seconds
+        self.is_active = is_active if is_active is not None else (lambda queue_id: False)
+        self.active_uploads = active_uploads if active_uploads is not None else (lambda: ())
+        self.on_collect = on_collect
+        self._lock = threading.Lock()
+        # 已知的文件SHA256，以 (路径, inode, 大小, mtime_ns) 为键，内容不变时不再重复读取文件
+        self._digests = {}
+        os.makedirs(self.uploads_root, exist_ok=True)
+        os.makedirs(self.jobs_root, exist_ok=True)
+
+        if gc_interval > 0:
+            gc_thread = threading.Thread(target=self._gc_loop, args=(gc_interval,), name='neurcad-store-gc')
+            gc_thread.daemon = True
+            gc_thread.start()
+
+    # ------------------------------------------------------------------ 上传文件
+    def upload_path(self, digest, ext='.ply'):
+        return os.path.join(self.uploads_root, digest[:2], digest + ext)
+
+    @staticmethod
+    def _file_key(path):
+        st = os.stat(path)
+        return os.path.abspath(path), st.st_ino, st.st_size, st.st_mtime_ns
+
+    def file_sha256(self, path, chunk_size=1 << 20):
+        """文件内容的SHA256，按块读取；文件不变时复用上次的结果。上传文件的SHA256在保存时已计算，直接用上传记录中的值"""
+        key = self._file_key(path)
+        digest = self._digests.get(key)
+        if digest is None:
+            hasher = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    hasher.update(chunk)
+            digest = self._digests[key] = hasher.hexdigest()
+        return digest
+
+    def put_upload(self, stream, ext='.ply', chunk_size=1 << 20):
+        """边写临时文件边计算SHA256，再原子地移动到内容地址；返回 (digest, path)"""
+        hasher = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.uploads_root, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    f.write(chunk)
+            digest = hasher.hexdigest()
+            path = self.upload_path(digest, ext)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with self._lock:
+                if os.path.exists(path):
+                    os.remove(tmp_path)
+                else:
+                    os.replace(tmp_path, path)
+            self.touch(path)
+            return digest, path
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def upload_group(self, path):
+        """上传文件及其旁路文件(数据包 .bundle.npz、sigma缓存 .sigmas_*.npz、分块目录 .chunks)，作为一个整体回收"""
+        dirpath, name = os.path.split(path)
+        try:
+            entries = os.listdir(dirpath)
+        except OSError:
+            return []
+        return [os.path.join(dirpath, e) for e in entries if e == name or e.startswith(name + '.')]
+
+    def touch_upload(self, path):
+        """任务使用上传文件时刷新上传文件及其全部旁路文件(含分块目录中的每个分块)的时间"""
+        for entry in self.upload_group(path):
+            self.touch(entry)
+            if os.path.isdir(entry):
+                for dirpath, _, filenames in os.walk(entry):
+                    for filename in filenames:
+                        self.touch(os.path.join(dirpath, filename))
+
+    # ------------------------------------------------------------------ 任务目录
+    def job_dir(self, queue_id):
+        return os.path.join(self.jobs_root, queue_id)
+
+    def touch(self, path):
+        """刷新访问时间，延长TTL"""
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    # ------------------------------------------------------------------ 垃圾回收
+    def collect_garbage(self, now=None):
+        """删除超过TTL的上传文件和任务目录，返回 (被删除的任务ID列表, 被删除的上传文件路径列表)"""
+        now = time.time() if now is None else now
+        expired_jobs = []
+        expired_uploads = []
+        with self._lock:
+            for queue_id in os.listdir(self.jobs_root):
+                path = os.path.join(self.jobs_root, queue_id)
+                if self.is_active(queue_id):
+                    continue
+                if now - os.path.getmtime(path) > self.ttl_seconds:
+                    shutil.rmtree(path, ignore_errors=True)
+                    expired_jobs.append(queue_id)
+
+            active_uploads = set(os.path.abspath(p) for p in self.active_uploads())
+            for name in os.listdir(self.uploads_root):
+                bucket = os.path.join(self.uploads_root, name)
+                if not os.path.isdir(bucket):
+                    # 上传中断遗留的 .part 临时文件
+                    if now - os.path.getmtime(bucket) > self.ttl_seconds:
+                        os.remove(bucket)
+                    continue
+                entries = os.listdir(bucket)
+                # 上传文件本身不以其他条目加 '.' 为前缀；旁路文件随其上传文件一起按上传文件的时间回收，
+                # 上传文件已不存在的旁路文件按自身时间回收
+                uploads = [e for e in entries
+                           if not any(o != e and e.startswith(o + '.') for o in entries)]
+                for upload in uploads:
+                    path = os.path.join(bucket, upload)
+                    group = [e for e in entries if e == upload or e.startswith(upload + '.')]
+                    if os.path.abspath(path) in active_uploads:
+                        continue
+                    if now - os.path.getmtime(path) > self.ttl_seconds:
+                        for e in group:
+                            self._remove(os.path.join(bucket, e))
+                        expired_uploads.append(path)
+        if expired_jobs or expired_uploads:
+            print(f"已回收过期产物: {len(expired_jobs)} 个任务目录, {len(expired_uploads)} 个上传文件")
+            if self.on_collect is not None:
+                self.on_collect(expired_jobs, expired_uploads)
+        return expired_jobs, expired_uploads
+
+    @staticmethod
+    def _remove(path):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def _gc_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.collect_garbage()
+            except Exception as e:
+                print(f"回收过期产物时发生错误: {e}")
+                traceback.print_exc()
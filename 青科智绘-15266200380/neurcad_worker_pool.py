@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+NeurCADRecon 预热训练进程池
+每个工作进程常驻并预先导入torch/kaolin/open3d等依赖，任务之间复用，
+冷启动开销只在进程创建时支付一次。进程通过stdin/stdout上的JSON行协议通信。
+"""
+
+import json
+import queue
+import threading
+import subprocess
+
+
+class WarmWorker:
+    """单个常驻训练进程"""
+
+    def __init__(self, python_path, script_path):
+        self.jobs_done = 0
+        self.process = subprocess.Popen(
+            [python_path, '-u', script_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            bufsize=1
+        )
+        print(f"预热训练进程已启动，PID: {self.process.pid}")
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def stop(self):
+        if self.is_alive():
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=10)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+
+    def run(self, job_id, config, work_dir, on_output=None):
+        """发送一个任务并阻塞读取输出，直到收到完成/失败消息"""
+        task = {'job_id': job_id, 'work_dir': work_dir, 'config': config}
+        self.process.stdin.write(json.dumps(task) + '\n')
+        self.process.stdin.flush()
+
+        for line in iter(self.process.stdout.readline, ''):
+            try:
+                message = json.loads(line)
+            except ValueError:
+                # 第三方库直接写入fd的内容，不属于协议消息
+                if on_output is not None and line.strip():
+                    on_output(line)
+                continue
+
+            if message['type'] == 'output':
+                if on_output is not None:
+                    on_output(message['content'] + '\n')
+            elif message['type'] == 'done':
+                self.jobs_done += 1
+                return message['result']
+            elif message['type'] == 'failed':
+                self.jobs_done += 1
+                raise RuntimeError(message['error'])
+        raise RuntimeError(f'训练进程意外退出，返回码: {self.process.wait()}')
+
+
+class WarmWorkerPool:
+    """
+    预热训练进程池
+    - 启动时创建 num_workers 个常驻进程
+    - 每个进程执行 max_jobs_per_worker 个任务后重建，避免长期运行的内存碎片/泄漏
+    - 进程崩溃时自动重建，当前任务以失败结束
+    """
+
+    def __init__(self, python_path, script_path, num_workers=2, max_jobs_per_worker=20):
+        self.python_path = python_path
+        self.script_path = script_path
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = []
+        for _ in range(num_workers):
+            worker = WarmWorker(python_path, script_path)
+            self._workers.append(worker)
+            self._idle.put(worker)
+
+    def _replace(self, worker):
+        worker.stop()
+        new_worker = WarmWorker(self.python_path, self.script_path)
+        with self._lock:
+            self._workers[self._workers.index(worker)] = new_worker
+        return new_worker
+
+    def run(self, job_id, config, work_dir, on_output=None):
+        """在空闲的预热进程中执行一次重建，返回训练函数的结果字典"""
+        worker = self._idle.get()
+        try:
+            if not worker.is_alive() or worker.jobs_done >= self.max_jobs_per_worker:
+                worker = self._replace(worker)
+            try:
+                return worker.run(job_id, config, work_dir, on_output=on_output)
+            finally:
+                if not worker.is_alive():
+                    worker = self._replace(worker)
+        finally:
+            self._idle.put(worker)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': len(self._workers),
+                'idle': self._idle.qsize(),
+                'alive': sum(1 for worker in self._workers if worker.is_alive())
+            }
+
+    def shutdown(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.stop()